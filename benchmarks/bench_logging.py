@@ -0,0 +1,85 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+
+Measures the cost of the log calls made for each message at each log level,
+with the log written to the null device.
+
+Usage: python benchmarks/bench_logging.py [--messages N]
+"""
+from __future__ import print_function
+import argparse
+import logging
+import os
+import timeit
+os.environ.setdefault('MQLIGHT_PYTHON_NO_HANDLER', '1')
+from mqlight import logging as mqlight_logging  # noqa: E402
+
+LEVELS = ['FFDC', 'ERROR', 'ENTRY', 'PARMS', 'DATA', 'DEBUG', 'ALL']
+
+
+def make_logger(level, null):
+    """Returns a logger at level that writes to null"""
+    log = mqlight_logging.get_logger('bench_logging.' + level)
+    for handler in list(log._log.handlers):
+        log._log.removeHandler(handler)
+    handler = logging.StreamHandler(null)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(process)s:%(threadName)s] - %(name)s - ' +
+        '%(client_id)s - %(lvl)s %(message)s'))
+    log._log.addHandler(handler)
+    log._log.propagate = False
+    log._level = mqlight_logging.LEVELS[level]
+    return log
+
+
+def log_message(log, body):
+    """Makes the log calls that are made for each message received"""
+    log.entry_often('Client._process_message', 'client')
+    log.parms('client', 'msg:', body)
+    log.entry_often('_MQLightMessenger._write', '*')
+    log.parms('*', 'force:', False)
+    log.exit_often('_MQLightMessenger._write', '*', 0)
+    log.debug('client', 'processing message {0}', 0)
+    log.data('client', 'body:', body)
+    log.exit_often('Client._process_message', 'client', None)
+
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--messages', type=int, default=10000,
+                        help='number of messages to log per run')
+    args = parser.parse_args()
+    body = 'x' * 1024
+
+    print('{0:>10} {1:>16}'.format('level', 'us/message'))
+    with open(os.devnull, 'w') as null:
+        for level in LEVELS:
+            log = make_logger(level, null)
+
+            def run():
+                """logs every message"""
+                for _ in range(args.messages):
+                    log_message(log, body)
+
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print('{0:>10} {1:>16.2f}'.format(
+                level, elapsed * 1e6 / args.messages))
+
+
+if __name__ == '__main__':
+    main()
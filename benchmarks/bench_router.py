@@ -0,0 +1,109 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+
+Compares the cost of matching topics with a TopicTrie against checking every
+pattern in turn, for increasing numbers of patterns.
+
+Usage: python benchmarks/bench_router.py [--topics N]
+"""
+from __future__ import print_function
+import argparse
+import random
+import re
+import timeit
+from mqlight.router import TopicTrie
+
+LEVELS = ['sports', 'news', 'weather', 'finance', 'travel', 'music']
+
+
+def make_patterns(count, rand):
+    """Returns count random topic patterns, about a third with wildcards"""
+    patterns = []
+    for index in range(count):
+        levels = [rand.choice(LEVELS), 'region{0}'.format(index % 50),
+                  'item{0}'.format(index)]
+        choice = rand.random()
+        if choice < 0.15:
+            levels[1] = '+'
+        elif choice < 0.3:
+            levels = levels[:2] + ['#']
+        patterns.append('/'.join(levels))
+    return patterns
+
+
+def make_topics(count, rand, patterns):
+    """Returns count topics, most of which match at least one pattern"""
+    topics = []
+    for _ in range(count):
+        pattern = rand.choice(patterns)
+        topic = pattern.replace('+', 'region0').replace('#', 'extra/level')
+        topics.append(topic)
+    return topics
+
+
+def pattern_regex(pattern):
+    """Returns a compiled regular expression equivalent to a topic pattern"""
+    parts = []
+    for level in pattern.split('/'):
+        if level == '#':
+            parts.append('.*')
+        elif level == '+':
+            parts.append('[^/]*')
+        else:
+            parts.append(re.escape(level))
+    return re.compile('/'.join(parts) + '$')
+
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--topics', type=int, default=1000,
+                        help='number of topics to match per run')
+    args = parser.parse_args()
+    rand = random.Random(42)
+
+    print('{0:>10} {1:>16} {2:>16}'.format(
+        'patterns', 'trie (us/topic)', 'linear (us/topic)'))
+    for count in (10, 100, 1000, 5000, 10000):
+        patterns = make_patterns(count, rand)
+        topics = make_topics(args.topics, rand, patterns)
+
+        trie = TopicTrie()
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        regexes = [(pattern_regex(p), p) for p in patterns]
+
+        def trie_match():
+            """matches every topic using the trie"""
+            for topic in topics:
+                trie.match(topic)
+
+        def linear_match():
+            """matches every topic by checking every pattern"""
+            for topic in topics:
+                [p for regex, p in regexes if regex.match(topic)]
+
+        trie_time = min(timeit.repeat(trie_match, number=1, repeat=3))
+        linear_time = min(timeit.repeat(linear_match, number=1, repeat=3))
+        print('{0:>10} {1:>16.2f} {2:>16.2f}'.format(
+            count,
+            trie_time * 1e6 / len(topics),
+            linear_time * 1e6 / len(topics)))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,13 @@ from .client import __version__, Client
 from .client import QOS_AT_MOST_ONCE, QOS_AT_LEAST_ONCE
 from .client import STARTED, STARTING, STOPPED, STOPPING, RESTARTED, \
     RETRYING, ERROR, MESSAGE, MALFORMED, DRAIN
+from .dedup import DuplicateFilter
+from .delivery import Delivery
+from .dispatch import KeyedDispatcher
+from .metrics import MetricsExporter
+from .reconnect import ReconnectPolicy, set_reconnect_policy
+from .router import TopicRouter, TopicTrie
+from .sharegroup import ShareGroup
 from .exceptions import MQLightError, InvalidArgumentError, RangeError,  \
     NetworkError, ReplacedError, LocalReplacedError, \
     SecurityError, StoppedError, SubscribedError, UnsubscribedError
@@ -36,6 +43,15 @@ __all__ = [
     'MESSAGE',
     'MALFORMED',
     'DRAIN',
+    'Delivery',
+    'DuplicateFilter',
+    'KeyedDispatcher',
+    'MetricsExporter',
+    'ReconnectPolicy',
+    'set_reconnect_policy',
+    'TopicRouter',
+    'TopicTrie',
+    'ShareGroup',
     'MQLightError',
     'InvalidArgumentError',
     'RangeError',
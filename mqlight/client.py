@@ -24,30 +24,39 @@ build your applications with.
 """
 from __future__ import division, absolute_import
 import uuid
+import collections
+import itertools
 import threading
 import os.path
 import re
+import socket
 import sys
-import codecs
 import traceback
 import time
 import Queue
-from json import loads
-from random import random
 from pkg_resources import get_distribution, DistributionNotFound
 import ssl
 try:
-    import httplib
     from urlparse import urlparse
     from urllib import quote
 except ImportError:
-    import http.client as httplib
     from urllib.parse import urlparse
     from urllib.parse import quote
 from .exceptions import MQLightError, InvalidArgumentError, RangeError, \
     NetworkError, NotPermittedError, ReplacedError, LocalReplacedError, \
     StoppedError, SubscribedError, UnsubscribedError, SecurityError
-from .logging import get_logger, NO_CLIENT_ID
+from .dedup import DuplicateFilter
+from .discovery import _ServiceDiscovery, _get_service_function, \
+    _is_discovery_url
+from .delivery import Delivery
+from .dispatch import KeyedDispatcher
+from . import hooks
+from .metrics import MetricsRegistry, OTHER_KEY
+from .reconnect import COORDINATOR
+from .standby import _Standby
+from .timer import call_later, Worker
+from . import trace
+from .logging import get_logger, NO_CLIENT_ID, DATA
 
 CMD = ' '.join(sys.argv)
 if 'setup.py test' in CMD or 'py.test' in CMD or 'unittest' in CMD:
@@ -88,6 +97,27 @@ MESSAGE = 'message'
 MALFORMED = 'malformed'
 DRAIN = 'drain'
 
+# The application properties that a client tracking latency stamps on the
+# messages it sends
+SENT_ID_PROPERTY = 'mqlight_sent_id'
+SENT_TIME_PROPERTY = 'mqlight_sent_time'
+SENT_CLOCK_PROPERTY = 'mqlight_sent_clock'
+SENT_HOST_PROPERTY = 'mqlight_sent_host'
+
+# The stages of sending an at least once message that a client tracking
+# latency times: waiting in the action queue, being put into proton, waiting
+# for proton's outbound buffer to be written, and waiting for the message to
+# be settled by the MQ Light service
+SEND_STAGES = ('queue', 'put', 'write', 'disposition')
+
+# The most topics that a client tracking latency times sends to separately
+MAX_STAGE_TOPICS = 100
+
+# A clock that cannot go backwards, which messages sent and received on the
+# same host are timed with, if there is one
+_MONOTONIC = getattr(time, 'monotonic', None)
+_HOSTNAME = socket.gethostname()
+
 STATES = (
     STARTED,
     STARTING,
@@ -208,120 +238,12 @@ def _should_reconnect(error):
     return result
 
 
-def _get_http_service_function(http, http_url):
+def _service_address(service):
     """
-    Function to take a single HTTP URL and using the JSON retrieved from it to
-    return an array of service URLs.
+    Returns the (hostname, port) address that a service URL connects to
     """
-    LOG.entry('_get_http_service_function', NO_CLIENT_ID)
-    LOG.parms(NO_CLIENT_ID, 'http:', http)
-    LOG.parms(NO_CLIENT_ID, 'http_url:', http_url)
-
-    def _http_service_function(callback):
-        LOG.entry('_http_service_function', NO_CLIENT_ID)
-        LOG.parms(NO_CLIENT_ID, 'callback:', callback)
-
-        func = httplib.HTTPConnection
-        if http_url.scheme == 'https':
-            func = httplib.HTTPSConnection
-        LOG.data(NO_CLIENT_ID, 'using :', func.__name__)
-
-        host = http_url.netloc
-        if http_url.port:
-            host += ':{0}'.format(http_url.port)
-        LOG.data(NO_CLIENT_ID, 'host:', host)
-
-        path = http[http.index(http_url.netloc) + len(http_url.netloc):]
-        LOG.data(NO_CLIENT_ID, 'path:', path)
-        try:
-            conn = func(host)
-            conn.request('GET', path)
-            res = conn.getresponse()
-            if res.status == httplib.OK:
-                try:
-                    json_obj = loads(res.read())
-                    if 'service' in json_obj:
-                        service = json_obj['service']
-                    else:
-                        service = None
-                    callback(None, service)
-                except Exception as exc:
-                    err = TypeError(
-                        '{0} request to {1} returned '
-                        'unparseable JSON: {2}'.format(
-                            http_url.scheme, http, exc))
-                    LOG.error('_http_service_function', NO_CLIENT_ID, err)
-                    callback(err)
-            else:
-                err = NetworkError(
-                    '{0} request to {1} failed with a status code '
-                    'of {2}'.format(http_url.scheme, http, res.status))
-                LOG.error('_http_service_function', NO_CLIENT_ID, err)
-                callback(err, None)
-        except httplib.HTTPException as exc:
-            err = NetworkError(
-                '{0} request to {1} failed: {2}'.format(
-                    http_url.scheme, http, exc))
-            LOG.error('_http_service_function', NO_CLIENT_ID, err)
-            callback(err, None)
-        LOG.exit('_http_service_function', NO_CLIENT_ID, None)
-
-    LOG.exit(
-        '_get_http_service_function',
-        NO_CLIENT_ID,
-        _http_service_function)
-    return _http_service_function
-
-
-def _get_file_service_function(file_url):
-    """
-    Function to take a single FILE URL and using the JSON retrieved from it to
-    return an array of service URLs.
-    """
-    LOG.entry('_get_file_service_function', NO_CLIENT_ID)
-    LOG.parms(NO_CLIENT_ID, 'file_url:', file_url)
-    if not isinstance(file_url, str):
-        err = TypeError('file_url must be a string')
-        LOG.error('_get_file_service_function', NO_CLIENT_ID, err)
-        raise err
-
-    file_path = file_url
-    # Special case for windows drive letters in file URIS, trim the leading /
-    if os.name == 'nt' and re.match(r'^\/[a-zA-Z]:\/', file_path):
-        file_path = file_path[1:]
-
-    def _file_service_function(callback):
-        LOG.entry('_file_service_function', NO_CLIENT_ID)
-        LOG.parms(NO_CLIENT_ID, 'callback:', callback)
-        opened = False
-        with codecs.open(file_path, encoding='utf-8', mode='r') as file_obj:
-            try:
-                opened = True
-                json_obj = loads(file_obj.read())
-                if 'service' in json_obj:
-                    service = json_obj['service']
-                else:
-                    service = None
-                LOG.data(NO_CLIENT_ID, 'service:', service)
-                callback(None, service)
-            except Exception as exc:
-                err = MQLightError(
-                    'The content read from {0} contained '
-                    'unparseable JSON: {1}'.format(file_path, exc))
-                LOG.error('_file_service_function', NO_CLIENT_ID, err)
-                callback(err, None)
-        file_obj.close()
-        if not opened:
-            err = MQLightError(
-                'attempt to read {0} failed'.format(file_path))
-            LOG.error('_file_service_function', NO_CLIENT_ID, err)
-            callback(err, None)
-        LOG.exit('_file_service_function', NO_CLIENT_ID, None)
-    LOG.exit(
-        '_get_file_service_function',
-        NO_CLIENT_ID,
-        _file_service_function)
-    return _file_service_function
+    service_url = urlparse(service)
+    return (service_url.hostname, service_url.port)
 
 
 def _generate_service_list(service, security_options):
@@ -474,6 +396,36 @@ def _generate_service_list(service, security_options):
     return service_list
 
 
+def _message_size(data):
+    """
+    Returns the size of a message body, as counted against a subscription's
+    max_prefetch_bytes budget and in the client's metrics
+    """
+    if data is None:
+        return 0
+    return len(data)
+
+
+def _prefetch_window(subscription):
+    """
+    Returns the number of messages that the byte budget of a subscription
+    allows to be held or in flight, based on the average size of the
+    messages it has received so far
+    """
+    if not subscription['average_size']:
+        # Nothing is known about the size of the messages yet, so probe with
+        # a single message
+        return 1
+    window = int((subscription['max_prefetch_bytes'] -
+                  subscription['held_bytes']) //
+                 subscription['average_size'])
+    if window < 1 and subscription['held_bytes'] <= 0:
+        # Always allow one message, however large, so that the subscription
+        # cannot stall
+        window = 1
+    return window
+
+
 class Client(object):
 
     """
@@ -486,14 +438,19 @@ class Client(object):
             client_id=None,
             security_options=None,
             on_started=None,
-            on_state_changed=None):
+            on_state_changed=None,
+            standby=False,
+            track_latency=False):
         """Constructs and starts a new Client.
 
         :param service: when an instance of string, this is a URL to
             connect to. When an instance of list, this is a list of URLs
             to connect to - each will be tried in turn until either a
             connection is successfully established to one of the URLs, or
-            all of the URLs have been tried. When an instance of function
+            all of the URLs have been tried. The URLs can instead be http(s)
+            or file URLs to fetch the list of services to connect to from,
+            in which case they are all fetched from at once and the lists
+            returned are merged. When an instance of function
             is specified for this argument, then the function is invoked each
             time the Client wants to establish a connection.
         :param client_id: (optional) an identifier that is used to identify
@@ -518,6 +475,19 @@ class Client(object):
             stopping, restarted, retrying, error or drain and ``msg`` is
             ``None`` except if state is error, in this case it is the error
             message.
+        :param standby: (optional) if True, the client keeps a spare
+            connection open to the service it would fail over to, which is
+            the next service in the list, or the same service if there is
+            only one. When the connection in use fails, the client reconnects
+            over the spare connection without waiting for a new TCP
+            connection or TLS handshake. Defaults to False.
+        :param track_latency: (optional) if True, the client stamps the
+            messages it sends with the time they were sent, and records the
+            time taken for each stamped message it receives to arrive, for
+            each topic pattern it subscribes to. It also times the stages of
+            sending each at least once message. The latencies are reported
+            by ``get_latency()``, ``get_send_latency()`` and ``metrics()``.
+            Defaults to False.
         :return: The Client instance.
         :raises TypeError: if the type of any of the arguments is incorrect.
         :raises InvalidArgumentError: if any of the arguments are
@@ -529,27 +499,25 @@ class Client(object):
         LOG.parms(NO_CLIENT_ID, 'security_options:', security_options)
         LOG.parms(NO_CLIENT_ID, 'on_started:', on_started)
         LOG.parms(NO_CLIENT_ID, 'on_state_changed:', on_state_changed)
+        LOG.parms(NO_CLIENT_ID, 'standby:', standby)
+        LOG.parms(NO_CLIENT_ID, 'track_latency:', track_latency)
 
         # Ensure the service is a list or function
         service_function = None
         if hasattr(service, '__call__'):
             service_function = service
         # tolerate both str and unicode input
-        elif isinstance(service, str) or isinstance(service, unicode):
-            service_url = urlparse(service)
-            if service_url.scheme in ('http', 'https'):
-                service_function = _get_http_service_function(
-                    service, service_url)
-            elif service_url.scheme == 'file':
-                if (service_url.hostname and
-                        service_url.hostname != 'localhost'):
-                    error = InvalidArgumentError(
-                        'service contains unsupported file URI of {0}'
-                        ', only file:///path or file://localhost/path are '
-                        ' supported.'.format(service))
-                    LOG.error('Client.__init__', NO_CLIENT_ID, error)
-                    raise error
-                service_function = _get_file_service_function(service_url.path)
+        elif _is_discovery_url(service):
+            service_function = _get_service_function([service])
+        elif isinstance(service, list) and service and \
+                any(_is_discovery_url(url) for url in service):
+            if not all(_is_discovery_url(url) for url in service):
+                error = InvalidArgumentError(
+                    'service list cannot mix http(s) or file URLs with '
+                    'the URLs of services to connect to')
+                LOG.error('Client.__init__', NO_CLIENT_ID, error)
+                raise error
+            service_function = _get_service_function(service)
 
         # If client id has not been specified then generate an id
         if client_id is None:
@@ -633,6 +601,20 @@ class Client(object):
             LOG.error('Client.__init__', NO_CLIENT_ID, error)
             raise error
 
+        if standby not in (True, False):
+            error = TypeError(
+                'standby value {0} is invalid must evaluate to True or '
+                'False'.format(standby))
+            LOG.error('Client.__init__', NO_CLIENT_ID, error)
+            raise error
+
+        if track_latency not in (True, False):
+            error = TypeError(
+                'track_latency value {0} is invalid must evaluate to True or '
+                'False'.format(track_latency))
+            LOG.error('Client.__init__', NO_CLIENT_ID, error)
+            raise error
+
         # Save the required data as client fields
         self._service_function = service_function
         self._service_list = None
@@ -643,7 +625,29 @@ class Client(object):
         self._messenger = _MQLightMessenger(self._id)
         self._sock = None
 
+        # Instrumentation hooks, keyed by hook point. The dictionary is
+        # shared with the messenger, and is empty unless a hook is added.
+        self._hooks = {}
+        self._messenger.hooks = self._hooks
+        # Identifies each send to the hooks, and in latency stamps
+        self._send_ids = itertools.count(1)
+        # The message ids set on the messages sent, which let subscriptions
+        # with the dedup option recognise a message delivered again
+        self._message_id_prefix = uuid.uuid4().hex
+        self._message_ids = itertools.count(1)
+        self._track_latency = track_latency
+        # The spare connection to fail over to, if enabled
+        self._standby = _Standby(
+            self._id,
+            self._security_options,
+            _MQLightSocket) if standby else None
+
         self._queued_chunks = []
+        # Chunks read by the socket's thread, waiting for the action handler
+        # thread to push them into proton. Chunks read while a push is still
+        # pending join it, so a burst of reads is pushed at once.
+        self._inbound_chunks = collections.deque()
+        self._read_pending = False
 
         self._connect_thread = None
 
@@ -671,12 +675,84 @@ class Client(object):
         # An identifier for the connection
         self._connection_id = 0
 
-        # Connection retry timer
+        # Subscribe and unsubscribe requests waiting for the MQ Light service
+        # to attach or detach their links
+        self._pending_links = []
+        self._pending_links_lock = threading.Lock()
+
+        # How long, in seconds, it took to make the subscriptions again after
+        # the last reconnect
+        self._resubscribe_time = None
+
+        # Connection retry timer, and an event set once the retry it posted
+        # to the worker has run
         self._retry_timer = None
+        self._retry_done = None
+
+        # Runs the timed work that can block, such as retrying the
+        # connection, so that it does not hold up the shared timer thread
+        self._worker = Worker('mqlight-worker-' + self._id)
 
         # Queue for pending actions to be processed in a separate thread
         self._action_queue = Queue.Queue()
 
+        # Metrics describing what the client is doing. Gauges are read from
+        # the client's state when the metrics are read, so cost nothing
+        # until then.
+        self._metrics = MetricsRegistry(self._id)
+        self._messages_sent = self._metrics.counter(
+            'messages_sent', 'Messages sent')
+        self._bytes_sent = self._metrics.counter(
+            'bytes_sent', 'Bytes of message data sent')
+        self._send_errors = self._metrics.counter(
+            'send_errors', 'Sends that failed')
+        self._messages_received = self._metrics.counter(
+            'messages_received', 'Messages received')
+        self._bytes_received = self._metrics.counter(
+            'bytes_received', 'Bytes of message data received')
+        self._duplicates_dropped = self._metrics.counter(
+            'duplicates_dropped', 'Duplicate messages dropped')
+        self._reconnects = self._metrics.counter(
+            'reconnects', 'Times the client has reconnected')
+        self._message_sizes = self._metrics.histogram(
+            'received_message_bytes', 'Sizes of the messages received')
+        self._latencies = self._metrics.histogram_set(
+            'latency_seconds',
+            'Time taken for messages to arrive from the client that sent '
+            'them', 'topic_pattern')
+        self._send_stages = None
+        self._send_stage_topics = {}
+        if track_latency:
+            self._send_stages = self._metrics.histogram_set(
+                'send_stage_seconds',
+                'Time taken by each stage of sending at least once messages',
+                'stage')
+            for stage in SEND_STAGES:
+                self._send_stage_topics[stage] = self._metrics.histogram_set(
+                    'send_{0}_seconds'.format(stage),
+                    'Time taken by the {0} stage of sending at least once '
+                    'messages, by topic'.format(stage),
+                    'topic', MAX_STAGE_TOPICS)
+        self._metrics.gauge(
+            'outstanding_sends', 'Sends waiting to complete',
+            lambda: len(self._outstanding_sends))
+        self._metrics.gauge(
+            'queued_sends', 'Sends waiting for the client to reconnect',
+            lambda: len(self._queued_sends))
+        self._metrics.gauge(
+            'action_queue_depth', 'Actions waiting to be processed',
+            self._action_queue.qsize)
+        self._metrics.gauge(
+            'credit', 'Link credit of each subscription',
+            lambda: dict((sub['address'], sub['link_credit'])
+                         for sub in list(self._subscriptions)),
+            'subscription')
+        self._metrics.gauge(
+            'unconfirmed', 'Unconfirmed messages of each subscription',
+            lambda: dict((sub['address'], sub['unconfirmed'])
+                         for sub in list(self._subscriptions)),
+            'subscription')
+
         # Thread to process actions without blocking main thread
         self._action_handler_thread = threading.Thread(
                                                 target=self._action_handler)
@@ -733,13 +809,37 @@ class Client(object):
         LOG.exit('Client.__init__', self._id, None)
 
     def _queue_on_read(self, chunk):
-        self._action_queue.put((self._on_read, chunk))
+        # Called on the socket's thread. The deque is never replaced, so the
+        # chunk cannot be lost to a concurrent _take_inbound_chunks(), and
+        # as the flag is cleared before the chunks are taken, either this
+        # chunk is taken by the pending push or a new push is queued.
+        self._inbound_chunks.append(chunk)
+        if not self._read_pending:
+            self._read_pending = True
+            self._action_queue.put((self._on_read,))
+
+    def _take_inbound_chunks(self):
+        """
+        Moves the chunks read by the socket's thread to the queued chunks,
+        returning the number of bytes moved
+        """
+        self._read_pending = False
+        size = 0
+        while True:
+            try:
+                chunk = self._inbound_chunks.popleft()
+            except IndexError:
+                break
+            size += len(chunk)
+            self._queued_chunks.append(chunk)
+        return size
 
-    def _on_read(self, chunk):
+    def _on_read(self):
         LOG.entry_often('Client._on_read', self._id)
-        # Queue up the chunk
-        self._queued_chunks.append(chunk)
-        self._push_chunks()
+        size = self._take_inbound_chunks()
+        if size:
+            trace.record(trace.READ, self._id, size)
+            self._push_chunks()
         LOG.exit_often('Client._on_read', self._id, None)
 
     def _queue_on_close(self):
@@ -747,6 +847,8 @@ class Client(object):
 
     def _on_close(self):
         LOG.entry('Client._on_close', self._id)
+        trace.record(trace.DISCONNECT, self._id)
+        self._take_inbound_chunks()
         self._push_chunks()
         try:
             self._messenger.closed()
@@ -780,6 +882,9 @@ class Client(object):
             while chunk:
                 # Attempt to push the whole chunk into proton.
                 written = self._messenger.push(chunk)
+                if self._hooks and written > 0:
+                    hooks.call_hooks(self._hooks, hooks.CHUNK_PUSHED,
+                                     self._id, {'bytes': written})
 
                 if written < len(chunk):
                     if written <= 0:
@@ -788,8 +893,10 @@ class Client(object):
                         # shortly.
                         self._queued_chunks.append(chunk)
                         self._messenger.pop(self._sock, True)
-                        timer = threading.Timer(0.5, self._push_chunks)
-                        timer.start()
+                        call_later(
+                            0.5,
+                            self._action_queue.put,
+                            [(self._push_chunks,)])
                         LOG.exit('Client._push_chunks', self._id, pushed)
                         return pushed
                     else:
@@ -809,6 +916,9 @@ class Client(object):
             # Force a messenger tick.
             self._messenger.pop(self._sock, True)
 
+            # The data read may have attached or detached links
+            self._check_pending_links()
+
             # If data has been read, messages may have arrived, so perform
             # a check.
             if self._subscriptions:
@@ -816,7 +926,86 @@ class Client(object):
                         self._check_for_messages()
         LOG.exit('Client._push_chunks', self._id, None)
 
+    def _add_pending_link(self, address, attach, on_complete):
+        """
+        Waits for the MQ Light service to attach, or detach, the link for
+        address, then calls on_complete(err). The link is checked straight
+        away, and then each time data is received.
+        """
+        LOG.entry('Client._add_pending_link', self._id)
+        LOG.parms(self._id, 'address:', address)
+        LOG.parms(self._id, 'attach:', attach)
+        with self._pending_links_lock:
+            self._pending_links.append((address, attach, on_complete))
+        self._check_pending_links()
+        LOG.exit('Client._add_pending_link', self._id, None)
+
+    def _check_pending_links(self):
+        """
+        Completes the subscribe and unsubscribe requests whose links the MQ
+        Light service has finished attaching or detaching
+        """
+        if not self._pending_links:
+            return
+        LOG.entry_often('Client._check_pending_links', self._id)
+        completed = []
+        with self._pending_links_lock:
+            pending = []
+            for link in self._pending_links:
+                address, attach, on_complete = link
+                err = None
+                try:
+                    if attach:
+                        done = self._messenger.subscribed(address)
+                    else:
+                        done = self._messenger.unsubscribed(address)
+                except Exception as exc:
+                    LOG.error('Client._check_pending_links', self._id, exc)
+                    done = True
+                    err = exc
+                if done:
+                    completed.append((on_complete, err))
+                else:
+                    pending.append(link)
+            self._pending_links = pending
+        # Complete the requests outside of the lock, as completing a request
+        # may itself subscribe or unsubscribe
+        for on_complete, err in completed:
+            on_complete(err)
+        if completed:
+            # Write the credit flowed to the links that have just attached
+            self._messenger.pop(self._sock, False)
+        LOG.exit_often('Client._check_pending_links', self._id, len(completed))
+
+    def _clear_pending_links(self, err=None):
+        """
+        Removes every subscribe and unsubscribe request that is waiting for
+        its link, as the connection has been closed. If err is specified the
+        requests are completed with it, otherwise they are abandoned.
+        """
+        LOG.entry('Client._clear_pending_links', self._id)
+        LOG.parms(self._id, 'err:', err)
+        with self._pending_links_lock:
+            pending = self._pending_links
+            self._pending_links = []
+        if err is not None:
+            for _, _, on_complete in pending:
+                on_complete(err)
+        LOG.exit('Client._clear_pending_links', self._id, len(pending))
+
     def _action_handler(self):
+        """
+        Runs the actions queued for the client: pushing the data read from
+        the network into proton, putting and writing the messages passed to
+        send(), settling automatically confirmed messages and sending
+        heartbeats. This is not the only thread that drives proton: the
+        socket's own thread reads from the connection, subscribe(),
+        unsubscribe(), receive() and confirming a delivery call proton on
+        the calling thread, and the client's worker runs the reconnect
+        retries, disconnects and error callbacks that timers post to it.
+        Only pushing data into proton and writing data out take the
+        messenger's lock.
+        """
         while self.state not in STOPPED:
             args = self._action_queue.get()
             callback = args[0]
@@ -1040,22 +1229,31 @@ class Client(object):
                 self._id,
                 'client._queued_subscriptions:',
                 self._queued_subscriptions)
-            while self._queued_subscriptions and self.state == STARTED:
-                sub = self._queued_subscriptions.pop(0)
-                if sub['noop']:
-                    # no-op so just trigger the callback without actually
-                    # subscribing
-                    if sub['on_subscribed']:
-                        sub['on_subscribed'](
-                            err,
-                            sub['topic_pattern'],
-                            sub['original_share_value'])
-                else:
-                    self.subscribe(
-                        sub['topic_pattern'],
-                        sub['share'],
-                        sub['options'],
-                        sub['on_subscribed'])
+            if self._queued_subscriptions and self.state == STARTED:
+                queued = self._queued_subscriptions
+                self._queued_subscriptions = []
+                for sub in queued:
+                    if sub['noop']:
+                        # no-op so just trigger the callback without actually
+                        # subscribing
+                        if sub['on_subscribed']:
+                            sub['on_subscribed'](
+                                err,
+                                sub['topic_pattern'],
+                                sub['original_share_value'])
+                resubscribes = [sub for sub in queued if not sub['noop']]
+                if resubscribes:
+                    # Attach every link in a single write, rather than
+                    # waiting for each in turn
+                    started = time.time()
+
+                    def resubscribed(err):
+                        self._resubscribe_time = time.time() - started
+                        LOG.data(
+                            self._id,
+                            'resubscribed in:',
+                            self._resubscribe_time)
+                    self._subscribe_batch(resubscribes, resubscribed)
             LOG.data(
                 self._id,
                 'client._queued_unsubscribes:',
@@ -1097,6 +1295,56 @@ class Client(object):
 
         LOG.exit('_process_queued_actions', self._id, None)
 
+    def _subscribe_batch(self, subscriptions, on_complete=None):
+        """
+        Subscribes to each of a list of subscriptions, which are dicts holding
+        the arguments to subscribe, writing all of their attaches to the
+        network at once. on_complete(err) is called once every subscription
+        has completed, with the first error, if any.
+        """
+        LOG.entry('Client._subscribe_batch', self._id)
+        LOG.parms(self._id, 'subscriptions:', len(subscriptions))
+        lock = threading.Lock()
+        outcome = {'remaining': len(subscriptions), 'err': None}
+
+        def finished(err):
+            with lock:
+                if err and outcome['err'] is None:
+                    outcome['err'] = err
+                outcome['remaining'] -= 1
+                done = outcome['remaining'] == 0
+            if done and on_complete:
+                on_complete(outcome['err'])
+
+        def counted(on_subscribed):
+            def subscribed(err, topic_pattern, share):
+                try:
+                    if on_subscribed:
+                        on_subscribed(err, topic_pattern, share)
+                finally:
+                    finished(err)
+            return subscribed
+
+        if not subscriptions and on_complete:
+            on_complete(None)
+        for sub in subscriptions:
+            callback = counted(sub.get('on_subscribed'))
+            try:
+                self._subscribe(
+                    sub.get('topic_pattern'),
+                    sub.get('share'),
+                    sub.get('options'),
+                    callback,
+                    sub.get('on_message'),
+                    False,
+                    sub.get('previous'))
+            except Exception as exc:
+                LOG.error('Client._subscribe_batch', self._id, exc)
+                callback(exc, sub.get('topic_pattern'), sub.get('share'))
+        if self.state == STARTED:
+            self._messenger.pop(self._sock, False)
+        LOG.exit('Client._subscribe_batch', self._id, None)
+
     def _check_for_messages(self):
         """
         Function to force the client to check for messages. The on_message
@@ -1111,11 +1359,10 @@ class Client(object):
             if messages:
                 LOG.debug(
                     self._id,
-                    'received {0} messages'.format(len(messages)))
+                    'received {0} messages',
+                    len(messages))
                 for i, message in enumerate(messages):
-                    LOG.debug(
-                        self._id,
-                        'processing message {0}'.format(i))
+                    LOG.debug(self._id, 'processing message {0}', i)
                     self._process_message(message)
                     if i < (len(messages) - 1):
                         # Unless this is the last pass around the loop, call
@@ -1132,8 +1379,7 @@ class Client(object):
                     self._on_state_changed(self, ERROR, exc)
                 if _should_reconnect(exc):
                     self._reconnect()
-            timer = threading.Timer(0.2, next_tick, [exc])
-            timer.start()
+            call_later(0.2, self._worker.post, [next_tick, exc])
 
         LOG.exit_often('Client._check_for_messages', self._id, None)
 
@@ -1143,37 +1389,19 @@ class Client(object):
         """
         LOG.entry_often('Client._process_message', self._id)
         LOG.parms(self._id, 'msg:', msg)
+        trace.record(trace.MESSAGE, self._id)
         msg.connection_id = self._connection_id
 
         data = msg.body
-        topic = msg.address
-        if topic.startswith('amqp://'):
-            topic = topic[topic.index('/', 7) + 1:]
         auto_confirm = True
         qos = QOS_AT_MOST_ONCE
 
-        def filter_func(item):
-            # 1 added to length to account for the / we add
-            address_no_service = item['address'][len(self._service) + 1:]
-            # Possible to have 2 matches work out whether this is
-            # for a share or private topic
-            link_address = None
-            if item['share'] is None and msg.link_address.startswith(
-                    'private:'):
-                # Slice off 'private:' prefix
-                link_address = msg.link_address[8:]
-            elif item['share'] and msg.link_address.startswith('share:'):
-                # Starting after the share: look for the next : denoting the
-                # end of the share name and get everything past that
-                link_address = msg.link_address[
-                    msg.link_address.index(':', 7) + 1:]
-            if address_no_service == link_address:
-                return True
-            else:
-                return False
-
+        # Each subscription records the name of its link, so the message can
+        # be matched to its subscription without parsing the link address
+        link_address = msg.link_address
         matched_subs = [
-            sub for sub in self._subscriptions if filter_func(sub)]
+            sub for sub in self._subscriptions
+            if sub['link'] == link_address]
         # Should only ever be one entry in matched_subs
         if len(matched_subs) > 1:
             err = MQLightError(
@@ -1183,12 +1411,30 @@ class Client(object):
                 'ffdc002',
                 self._id,
                 err)
-        subscription = matched_subs[0]
-        if subscription:
+        if matched_subs:
+            subscription = matched_subs[0]
             qos = subscription['qos']
             if qos == QOS_AT_LEAST_ONCE:
                 auto_confirm = subscription['auto_confirm']
-            subscription['unconfirmed'] += 1
+            size = _message_size(data)
+            self._messages_received.inc()
+            self._bytes_received.inc(size)
+            self._message_sizes.observe(size)
+            if self._track_latency:
+                self._record_latency(subscription, msg)
+            with subscription['lock']:
+                subscription['unconfirmed'] += 1
+                if subscription['link_credit'] > 0:
+                    subscription['link_credit'] -= 1
+                if subscription['max_prefetch_bytes']:
+                    subscription['held_bytes'] += size
+                    # Keep a moving average of the message size, used to
+                    # turn the byte budget into link credit
+                    if subscription['average_size']:
+                        subscription['average_size'] += \
+                            (size - subscription['average_size']) / 8
+                    else:
+                        subscription['average_size'] = size
         else:
             # ideally we shouldn't get here, but it can happen in
             # a timing window if we had received a message from a
@@ -1196,137 +1442,47 @@ class Client(object):
             LOG.debug(
                 self._id,
                 'No subscription matched message: {0} going to address: '
-                '{1}'.format(data, msg.address))
+                '{1}',
+                data,
+                msg.address)
             msg = None
             LOG.exit_often('Client._process_message', self._id, None)
             return
 
-        confirmation = {
-            'delivery_confirmed': False,
-        }
-
-        def _still_settling(sub, msg):
-            LOG.entry_often('Client._process_message._still_settling',
-                            self._id)
-            settled = self._messenger.settled(msg)
-            if settled:
-                sub['unconfirmed'] -= 1
-                sub['confirmed'] += 1
-                LOG.data(
-                    self._id,
-                    '[credit, unconfirmed, confirmed]:',
-                    '[{0}, {1}, {2}]'.format(
-                        sub['credit'],
-                        sub['unconfirmed'],
-                        sub['confirmed']))
-                # Ask to flow more messages if >= 80% of available
-                # credit (e.g. not including unconfirmed messages)
-                # has been used or we have just confirmed
-                # everything
-                available = sub['credit'] - sub['unconfirmed']
-                to_confirm = sub['unconfirmed'] == 0 and sub['confirmed'] > 0
-                if (sub['confirmed'] and available / sub['confirmed'] <=
-                        1.25) or to_confirm:
-                    self._messenger.flow(
-                        self._service + '/' + msg.link_address,
-                        sub['confirmed'],
-                        self._sock)
-                    sub['confirmed'] = 0
-            else:
-                timer = threading.Timer(0.1, _still_settling, [sub, msg])
-                timer.start()
-            LOG.exit_often(
-                'Client._process_message._still_settling',
-                self._id,
-                not settled)
-
-        def _confirm():
-            LOG.entry(
-                'Client._process_message._confirm',
-                self._id)
-            LOG.data(self._id, 'delivery:', delivery)
-            LOG.data(self._id, 'msg:', msg)
-            LOG.data(
-                self._id,
-                'delivery_confirmed:',
-                confirmation['delivery_confirmed'])
-            if self.is_stopped():
-                err = NetworkError('not started')
-                LOG.error(
-                    'Client._process_message._confirm',
-                    self._id,
-                    err)
-                raise err
-            if not confirmation['delivery_confirmed'] and msg:
-                # Also throw NetworkError if the client has
-                # disconnected at some point since this particular
-                # message was received
-                if msg.connection_id != self._connection_id:
-                    err = NetworkError(
-                        'Client has reconnected since this '
-                        'message was received')
-                    LOG.error(
-                        'Client._process_message._confirm',
-                        self._id,
-                        err)
-                    raise err
-                confirmation['delivery_confirmed'] = True
-                self._messenger.settle(msg, self._sock)
-                _still_settling(subscription, msg)
-            LOG.exit(
-                'Client._process_message._confirm',
-                self._id,
-                None)
-
-        delivery = {
-            'message': {
-                'topic': topic,
-            }
-        }
-
-        if qos >= QOS_AT_LEAST_ONCE and not auto_confirm:
-            delivery['message']['confirm_delivery'] = _confirm
-        link_address = msg.link_address
-        if link_address:
-            delivery['destination'] = {}
-            link = link_address
-            if link.startswith('share:'):
-                # Remove 'share:' prefix from link name
-                link = link[6:len(link_address)]
-                # Extract share name and add to delivery information
-                delivery['destination']['share'] = link[0:link.index(':')]
-            # Extract topic_pattern and add to delivery information
-            delivery['destination']['topic_pattern'] = link[
-                link.index(':') + 1:len(link)]
-
-        if msg.ttl > 0:
-            delivery['message']['ttl'] = msg.ttl
-
-        annots = msg.annotations
-        malformed = {
-            'MQMD': {},
-            'condition': None
-        }
-        mal_cond = 'x-opt-message-malformed-condition'
-        mal_desc = 'x-opt-message-malformed-description'
-        mal_ccsi = 'x-opt-message-malformed-MQMD-CodedCharSetId'
-        mal_form = 'x-opt-message-malformed-MQMD.Format'
-
-        for annot in annots:
-            if 'key' in annot:
-                if annots['key'] == mal_cond:
-                    malformed['condition'] = annot['value']
-                elif annot['key'] == mal_desc:
-                    malformed['description'] = annot['value']
-                elif annot['key'] == mal_ccsi:
-                    malformed['MQMD']['CodedCharSetId'] = int(annot['value'])
-                elif annot['key'] == mal_form:
-                    malformed['MQMD']['Format'] = annot['value']
+        if subscription['dedup'] is not None and msg.message_id is not None:
+            key = subscription['dedup'].message_key(
+                msg.message_id, msg.address)
+            if subscription['dedup'].check(key):
+                self._drop_duplicate(subscription, msg, qos, size)
+                LOG.exit_often('Client._process_message', self._id, None)
+                return
 
         state = MESSAGE
-        if malformed['condition']:
+        malformed = None
+        annots = msg.annotations
+        if annots and annots.get('x-opt-message-malformed-condition'):
             state = MALFORMED
-            delivery['malformed'] = malformed
+            malformed = {
+                'MQMD': {},
+                'condition': annots['x-opt-message-malformed-condition']
+            }
+            mal_desc = 'x-opt-message-malformed-description'
+            mal_ccsi = 'x-opt-message-malformed-MQMD-CodedCharSetId'
+            mal_form = 'x-opt-message-malformed-MQMD.Format'
+            if mal_desc in annots:
+                malformed['description'] = annots[mal_desc]
+            if mal_ccsi in annots:
+                malformed['MQMD']['CodedCharSetId'] = int(annots[mal_ccsi])
+            if mal_form in annots:
+                malformed['MQMD']['Format'] = annots[mal_form]
+
+        delivery = Delivery(
+            self,
+            subscription,
+            msg,
+            size,
+            qos >= QOS_AT_LEAST_ONCE and not auto_confirm,
+            malformed)
 
         LOG.state(
             'Client._process_message',
@@ -1334,33 +1490,201 @@ class Client(object):
             state,
             data,
             delivery)
+        if subscription['pull']:
+            self._buffer_message(subscription, msg, qos, auto_confirm, size,
+                                 state, data, delivery)
+            LOG.exit_often('Client._process_message', self._id, None)
+            return
+        if subscription['dispatcher'] is not None:
+            try:
+                subscription['dispatcher'].dispatch(
+                    delivery.topic,
+                    data,
+                    self._dispatched,
+                    (subscription, msg, qos, auto_confirm, size, state, data,
+                     delivery))
+            except StandardError as err:
+                self._message_error('Client._process_message', err)
+                self._settle_handled(subscription, msg, qos, auto_confirm,
+                                     size)
+            LOG.exit_often('Client._process_message', self._id, None)
+            return
+        self._deliver(subscription, state, data, delivery)
+        self._settle_handled(subscription, msg, qos, auto_confirm, size)
+        LOG.exit_often('Client._process_message', self._id, None)
+
+    def _record_latency(self, subscription, msg):
+        """
+        Records the time a message took to arrive, if it was stamped by a
+        client tracking latency. Messages sent from the same host are timed
+        with the monotonic clock, where there is one, and others with the
+        time of day, so depend on the hosts' clocks agreeing.
+        """
+        properties = msg.properties
+        sent_time = properties.get(SENT_TIME_PROPERTY)
+        if sent_time is None:
+            return
+        sent_clock = properties.get(SENT_CLOCK_PROPERTY)
+        if sent_clock is not None and _MONOTONIC is not None and \
+                properties.get(SENT_HOST_PROPERTY) == _HOSTNAME:
+            latency = _MONOTONIC() - sent_clock
+        else:
+            latency = time.time() - sent_time
+        self._latencies.observe(subscription['topic_pattern'], latency)
+
+    def _stamp_written(self):
+        """
+        Records the time that the messages being sent were written from
+        proton's outbound buffer, for those not already stamped
+        """
+        written = None
+        for in_flight in self._outstanding_sends:
+            stages = in_flight.get('stages')
+            if stages is not None and 'written' not in stages:
+                if written is None:
+                    written = hooks.now()
+                stages['written'] = written
+
+    def _record_send_stages(self, in_flight):
+        """
+        Records the time taken by each stage of sending a message that has
+        been settled, for the client and for the message's topic
+        """
+        stages = in_flight['stages']
+        if 'written' not in stages:
+            # settled before the write was stamped, so the write and
+            # disposition times are unknown
+            return
+        settled = hooks.now()
+        written = stages['written']
+        times = (
+            ('queue', stages['dequeued'] - stages['enqueued']),
+            ('put', stages['put'] - stages['dequeued']),
+            ('write', written - stages['put']),
+            ('disposition', settled - written))
+        for stage, elapsed in times:
+            self._send_stages.observe(stage, elapsed)
+            self._send_stage_topics[stage].observe(
+                in_flight['topic'], elapsed)
+
+    def _message_error(self, name, err):
+        """
+        Reports an error raised while passing a message to the application
+        """
+        LOG.error(name, self._id, err)
+        if self._on_state_changed:
+            self._on_state_changed(self, ERROR, err)
+        else:
+            # XXX: if user hasn't set an error handler, print and exit?
+            traceback.print_exc(file=sys.stderr)
+            os._exit(1)
+
+    def _deliver(self, subscription, state, data, delivery):
+        """
+        Passes a message to the on_message function of a subscription
+        """
+        details = None
+        if self._hooks:
+            details = {'topic': delivery.topic,
+                       'subscription': subscription['address'],
+                       'delivery': id(delivery)}
+            hooks.call_hooks(self._hooks, hooks.MESSAGE_DISPATCHED, self._id,
+                             details)
         try:
             if subscription['on_message']:
                 subscription['on_message'](state, data, delivery)
         except StandardError as err:
-            LOG.error(
-                'Client._process_message',
-                self._id,
-                err)
-            if self._on_state_changed:
-                self._on_state_changed(self, ERROR, err)
-            else:
-                # XXX: if user hasn't set an error handler, print and exit?
-                traceback.print_exc(file=sys.stderr)
-                os._exit(1)
+            self._message_error('Client._deliver', err)
+        if details is not None:
+            hooks.call_hooks(self._hooks, hooks.HANDLER_RETURNED, self._id,
+                             details)
+
+    def _dispatched(self, subscription, msg, qos, auto_confirm, size, state,
+                    data, delivery):
+        """
+        Passes a message to the application on a thread of the subscription's
+        dispatcher, then settles the message on the thread that processes
+        messages, so that its credit is only flowed once it has been handled
+        """
+        LOG.entry_often('Client._dispatched', self._id)
+        self._deliver(subscription, state, data, delivery)
+        self._action_queue.put((self._settle_handled, subscription, msg, qos,
+                                auto_confirm, size))
+        LOG.exit_often('Client._dispatched', self._id, None)
 
+    def _settle_handled(self, subscription, msg, qos, auto_confirm, size):
+        """
+        Settles a message that has been passed to the application, unless the
+        application confirms it itself
+        """
         if self.is_stopped():
             LOG.debug(
                 self._id,
                 'client is stopped so not accepting or settling message')
-            msg = None
-        else:
+        elif msg.connection_id != self._connection_id:
+            LOG.debug(
+                self._id,
+                'client has reconnected since the message was received so '
+                'not accepting or settling message')
+        elif qos == QOS_AT_MOST_ONCE or auto_confirm:
+            if qos == QOS_AT_MOST_ONCE:
+                self._messenger.accept(msg)
+            # Settle the message and flow any credit it frees up as part of
+            # the same transport write
+            trace.record(trace.SETTLE, self._id, size)
+            self._messenger.settle(msg, self._sock, False)
+            self._confirmed(subscription, msg.link_address, 1, False, size)
+            self._messenger.pop(self._sock, False)
+
+    def _drop_duplicate(self, subscription, msg, qos, size):
+        """
+        Settles a message that the subscription has already received, without
+        passing it to the application
+        """
+        LOG.entry_often('Client._drop_duplicate', self._id)
+        LOG.data(self._id, 'dropping duplicate message for:',
+                 msg.link_address)
+        self._duplicates_dropped.inc()
+        if not self.is_stopped():
             if qos == QOS_AT_MOST_ONCE:
                 self._messenger.accept(msg)
-            if qos == QOS_AT_MOST_ONCE or auto_confirm:
+            self._messenger.settle(msg, self._sock, False)
+            self._confirmed(subscription, msg.link_address, 1, False, size)
+            self._messenger.pop(self._sock, False)
+        LOG.exit_often('Client._drop_duplicate', self._id, None)
+
+    def _buffer_message(self, subscription, msg, qos, auto_confirm, size,
+                        state, data, delivery):
+        """
+        Holds a message received by a pull subscription until the application
+        calls receive(). At most once messages are settled straight away and
+        auto confirmed at least once messages are settled when they are handed
+        to the application.
+        """
+        LOG.entry_often('Client._buffer_message', self._id)
+        if qos == QOS_AT_MOST_ONCE:
+            if not self.is_stopped():
+                self._messenger.accept(msg)
                 self._messenger.settle(msg, self._sock)
-                subscription['unconfirmed'] -= 1
-                subscription['confirmed'] += 1
+                self._confirmed(subscription, msg.link_address, 1)
+            msg = None
+        elif not auto_confirm:
+            # The application confirms the message itself
+            msg = None
+        subscription['received'].put((state, data, delivery, msg, size))
+        LOG.exit_often('Client._buffer_message', self._id, None)
+
+    def _confirmed(self, subscription, link_address, count, write=True,
+                   size=0):
+        """
+        Records that count messages, totalling size bytes, received by the
+        subscription have been settled, and flows more credit to its link when
+        enough is available
+        """
+        with subscription['lock']:
+            subscription['unconfirmed'] -= count
+            subscription['confirmed'] += count
+            if LOG.is_enabled(DATA):
                 LOG.data(
                     self._id,
                     '[credit, unconfirmed, confirmed]:',
@@ -1368,24 +1692,89 @@ class Client(object):
                         subscription['credit'],
                         subscription['unconfirmed'],
                         subscription['confirmed']))
-                # Ask to flow more messages if >= 80% of available
-                # credit (e.g. not including unconfirmed messages)
-                # has been used. Or we have just confirmed
-                # everything.
+            if subscription['max_prefetch_bytes']:
+                subscription['held_bytes'] -= size
+            if subscription['pull']:
+                # Credit for pull subscriptions is only flowed by receive()
+                subscription['confirmed'] = 0
+                return
+            if subscription['max_prefetch_bytes']:
+                # Flow enough credit to fill the byte budget, once 80% of the
+                # credit it allows has been used
+                subscription['confirmed'] = 0
+                window = min(
+                    subscription['credit'] - subscription['unconfirmed'],
+                    _prefetch_window(subscription))
+                credit = window - subscription['link_credit']
+                if credit <= 0 or subscription['link_credit'] * 5 > window:
+                    return
+            else:
+                # Ask to flow more messages if >= 80% of available credit
+                # (e.g. not including unconfirmed messages) has been used. Or
+                # we have just confirmed everything.
                 available = subscription['credit'] - \
                     subscription['unconfirmed']
-                if (subscription['confirmed'] and
-                        available / subscription[
-                        'confirmed'] <= 1.25) or (subscription[
-                        'unconfirmed'] == 0 and subscription[
-                        'confirmed'] > 0):
-                    self._messenger.flow(
-                        self._service + '/' + msg.link_address,
-                        subscription['confirmed'],
-                        self._sock)
-                    subscription['confirmed'] = 0
-                    msg = None
-        LOG.exit_often('Client._process_message', self._id, None)
+                if not ((subscription['confirmed'] and
+                         available / subscription['confirmed'] <= 1.25) or (
+                        subscription['unconfirmed'] == 0 and
+                        subscription['confirmed'] > 0)):
+                    return
+                credit = subscription['confirmed']
+                subscription['confirmed'] = 0
+            subscription['link_credit'] += credit
+        self._messenger.flow(
+            self._service + '/' + link_address,
+            credit,
+            self._sock,
+            write)
+
+    def _confirm_deliveries(self, deliveries):
+        """
+        Settles the messages for a list of Delivery objects, writing the
+        settlements and any resulting link credit to the network in a single
+        pass. Deliveries that do not need confirming are ignored.
+        """
+        LOG.entry('Client._confirm_deliveries', self._id)
+        LOG.parms(self._id, 'deliveries:', deliveries)
+        if self.is_stopped():
+            err = NetworkError('not started')
+            LOG.error('Client._confirm_deliveries', self._id, err)
+            raise err
+
+        # Check the whole batch before settling anything, so that an error
+        # does not leave the batch partially confirmed
+        to_settle = []
+        for delivery in deliveries:
+            msg = delivery._pending()
+            if msg is None:
+                continue
+            # Throw NetworkError if the client has disconnected at some point
+            # since this particular message was received
+            if msg.connection_id != self._connection_id:
+                err = NetworkError(
+                    'Client has reconnected since this message was received')
+                LOG.error('Client._confirm_deliveries', self._id, err)
+                raise err
+            to_settle.append((delivery, msg))
+
+        if to_settle:
+            # Group the settled messages by subscription, so that credit is
+            # flowed once per link rather than once per message
+            counts = {}
+            for delivery, msg in to_settle:
+                self._messenger.settle(msg, self._sock, False)
+                subscription, link_address, size = delivery._settled()
+                key = id(subscription)
+                if key in counts:
+                    counts[key][2] += 1
+                    counts[key][3] += size
+                else:
+                    counts[key] = [subscription, link_address, 1, size]
+            for subscription, link_address, count, size in counts.values():
+                self._confirmed(
+                    subscription, link_address, count, False, size)
+            self._messenger.pop(self._sock, False)
+        LOG.exit('Client._confirm_deliveries', self._id, len(to_settle))
 
     def stop(self, on_stopped=None):
         """Disconnects the client from the MQ Light service, implicitly closing
@@ -1435,6 +1824,9 @@ class Client(object):
             self._connect_thread.join(1)
         if self._retry_timer:
             self._retry_timer.join(1)
+        retry_done = self._retry_done
+        if retry_done and not self._worker.is_current():
+            retry_done.wait(1)
 
         # Only disconnect when all outstanding send operations are complete
         if not self._outstanding_sends:
@@ -1469,12 +1861,25 @@ class Client(object):
                             'Client._perform_disconnect.next_tick',
                             self._id,
                             None)
-                    timer = threading.Timer(1, next_tick)
-                    timer.start()
+                    call_later(1, self._worker.post, [next_tick])
+
+                # Abandon any subscribe or unsubscribe requests that are
+                # still waiting for their links
+                self._clear_pending_links()
+
+                if self._standby:
+                    self._standby.close()
+
+                # Stop refreshing the service list in the background
+                if isinstance(self._service_function, _ServiceDiscovery):
+                    self._service_function.stop()
 
                 # Clear the active subscriptions list as we were asked to
                 # disconnect
                 LOG.data(self._id, 'self._subscriptions:', self._subscriptions)
+                for sub in self._subscriptions:
+                    if sub['pull']:
+                        sub['received'].put(StoppedError('not started'))
                 self._subscriptions = []
 
                 # Indicate that we've disconnected
@@ -1514,8 +1919,10 @@ class Client(object):
             return
 
         # Try disconnect again
-        timer = threading.Timer(1, self._perform_disconnect, [on_stopped])
-        timer.start()
+        call_later(
+            1,
+            self._worker.post,
+            [self._perform_disconnect, on_stopped])
         LOG.exit('Client._perform_disconnect', self._id, None)
 
     def _stop_messenger(self, stop_processing_callback, callback=None):
@@ -1541,10 +1948,10 @@ class Client(object):
             stop_processing_callback(self, callback)
         else:
             # Otherwise check for the messenger being stopped again
-            timer = threading.Timer(
+            call_later(
                 1,
-                self._stop_messenger, [stop_processing_callback, callback])
-            timer.start()
+                self._worker.post,
+                [self._stop_messenger, stop_processing_callback, callback])
         LOG.exit('Client._stop_messenger', self._id, None)
 
     def _connect_to_service(self, callback):
@@ -1567,10 +1974,18 @@ class Client(object):
             return
         error = None
         connected = False
+        # The shortest time until the coordinator will let a connection
+        # attempt start, for services that were passed over
+        deferred = None
 
         # Try each service in turn until we can successfully connect, or
-        # exhaust the list
-        for i, service in enumerate(self._service_list):
+        # exhaust the list. The service that the standby connection is open
+        # to, if any, is tried first.
+        services = list(enumerate(self._service_list))
+        if self._standby:
+            ready = self._standby.ready()
+            services.sort(key=lambda item: _service_address(item[1]) != ready)
+        for i, service in services:
             try:
                 # check if we will be providing authentication information
                 auth = None
@@ -1611,16 +2026,40 @@ class Client(object):
                 address = (connect_url.hostname, connect_url.port)
                 tls = True if service.startswith('amqps') else False
 
+                # Check that the other clients in the process are not already
+                # making as many attempts to connect to the endpoint as it is
+                # allowed, and that it is not known to be down
+                wait = COORDINATOR.acquire(address)
+                if wait:
+                    LOG.data(
+                        self._id,
+                        'deferring connect to: {0} for {1} seconds'.format(
+                            log_url, wait))
+                    deferred = wait if deferred is None else min(
+                        deferred, wait)
+                    continue
+
                 try:
-                    self._sock = _MQLightSocket(
-                        address,
-                        tls,
-                        self._security_options,
-                        self._queue_on_read,
-                        self._queue_on_close)
+                    self._sock = None
+                    if self._standby:
+                        self._sock = self._standby.take(
+                            address,
+                            self._queue_on_read,
+                            self._queue_on_close)
+                        if self._sock:
+                            LOG.data(self._id, 'using standby connection')
+                    if self._sock is None:
+                        self._sock = _MQLightSocket(
+                            address,
+                            tls,
+                            self._security_options,
+                            self._queue_on_read,
+                            self._queue_on_close)
                     self._messenger.connect(urlparse(connect_service))
 
-                    # Wait for client to start
+                    # Wait for client to start, checking often at first as
+                    # the service usually responds within a round trip
+                    delay = 0.01
                     while not self._messenger.started():
                         # Pass any data to proton.
                         self._messenger.pop(self._sock, False)
@@ -1629,7 +2068,8 @@ class Client(object):
                             # starting state
                             LOG.data(self._id, 'client no longer starting')
                             break
-                        time.sleep(0.5)
+                        time.sleep(delay)
+                        delay = min(delay * 2, 0.5)
                     else:
                         connected = True
                 except Exception as exc:
@@ -1641,13 +2081,27 @@ class Client(object):
                         self._id,
                         'failed to connect to: {0} due to error: {1}'.format(
                             log_url, error))
+                COORDINATOR.release(
+                    address,
+                    connected,
+                    _should_reconnect(error))
                 if connected:
                     LOG.data(
                         self._id,
                         'successfully connected to:',
                         log_url)
+                    trace.record(trace.CONNECT, self._id, i, self._retry_count)
                     self._service = self._service_list[i]
 
+                    if self._standby:
+                        # Open the spare connection to the service to fail
+                        # over to
+                        standby_service = self._service_list[
+                            (i + 1) % len(self._service_list)]
+                        self._standby.prepare(
+                            _service_address(standby_service),
+                            standby_service.startswith('amqps'))
+
                     # Indicate that we're connected
                     self._set_state(STARTED)
                     event_to_emit = None
@@ -1691,20 +2145,20 @@ class Client(object):
                                 self._id)
                             if self._messenger:
                                 self._messenger.heartbeat(self._sock)
-                                self._heartbeat_timeout = threading.Timer(
+                                self._heartbeat_timeout = call_later(
                                     interval,
-                                    perform_heartbeat,
-                                    [interval])
-                                self._heartbeat_timeout.start()
+                                    self._action_queue.put,
+                                    [(perform_heartbeat, interval)])
                             LOG.exit(
                                 'Client._connect_to_service.perform_heartbeat',
                                 self._id,
                                 None)
-                        self._heartbeat_timeout = threading.Timer(
+                        # The heartbeat is written by the action handler
+                        # thread, which drives proton
+                        self._heartbeat_timeout = call_later(
                             interval,
-                            perform_heartbeat,
-                            [interval])
-                        self._heartbeat_timeout.start()
+                            self._action_queue.put,
+                            [(perform_heartbeat, interval)])
 
             except Exception as exc:
                 # Should never get here, as it means that messenger.connect has
@@ -1718,10 +2172,18 @@ class Client(object):
                 raise MQLightError(exc)
 
         if not connected and not self.is_stopped():
+            retry_done = threading.Event()
+
             def retry():
                 LOG.entry_often('Client._connect_to_service.retry', self._id)
-                if not self.is_stopped():
-                    self._perform_connect(callback, self._service_list, False)
+                try:
+                    if not self.is_stopped():
+                        self._perform_connect(
+                            callback,
+                            self._service_list,
+                            False)
+                finally:
+                    retry_done.set()
                 LOG.exit_often(
                     'Client._connect_to_service.retry',
                     self._id,
@@ -1732,23 +2194,27 @@ class Client(object):
                 # before trying again
                 self._set_state(RETRYING)
 
-                self._retry_count += 1
-                retry_cap = 60
-                # limit to the power of 8 as anything above this will put the
-                # interval higher than the cap straight away.
-                exponent = self._retry_count if self._retry_count <= 8 else 8
-                upper_bound = pow(2, exponent)
-                lower_bound = 0.75 * upper_bound
-                jitter = random() * (0.25 * upper_bound)
-                interval = min(retry_cap, (lower_bound + jitter))
-                # times by CONNECT_RETRY_INTERVAL for unittest purposes
-                interval = round(interval) * CONNECT_RETRY_INTERVAL
+                if error is None and deferred is not None:
+                    # No service could be tried yet, so try again as soon as
+                    # the coordinator allows
+                    interval = deferred
+                else:
+                    self._retry_count += 1
+                    interval = COORDINATOR.retry_delay(
+                        [_service_address(service)
+                         for service in self._service_list],
+                        self._retry_count)
+                    # times by CONNECT_RETRY_INTERVAL for unittest purposes
+                    interval = round(interval) * CONNECT_RETRY_INTERVAL
                 LOG.data(
                     self._id,
                     'trying to connect again after {0} seconds'.format(
                         interval))
-                self._retry_timer = threading.Timer(interval, retry)
-                self._retry_timer.start()
+
+                def start_retry():
+                    self._retry_done = retry_done
+                    self._worker.post(retry)
+                self._retry_timer = call_later(interval, start_retry)
 
             if error:
                 def next_tick():
@@ -1758,8 +2224,7 @@ class Client(object):
                         error)
                     if self._on_state_changed:
                         self._on_state_changed(self, ERROR, error)
-                timer = threading.Timer(1, next_tick)
-                timer.start()
+                call_later(1, self._worker.post, [next_tick])
         LOG.exit('Client._connect_to_service', self._id, None)
 
     def _reconnect(self):
@@ -1780,6 +2245,7 @@ class Client(object):
                 LOG.exit('Client._reconnect', self._id, self)
                 return self
         self._set_state(RETRYING)
+        self._reconnects.inc()
 
         # Stop the messenger to free the object then attempt a reconnect
         def stop_processing(client, callback=None):
@@ -1788,16 +2254,40 @@ class Client(object):
             if client._heartbeat_timeout:
                 client._heartbeat_timeout.cancel()
 
-            # clear the subscriptions list, if the cause of the reconnect
-            # happens during check for messages we need a 0 length so it will
-            # check once reconnected.
-            client._queued_subscriptions = client._queued_subscriptions
+            # requests waiting for links on the old connection will never
+            # complete, so fail them, which queues them to be retried once
+            # reconnected
+            client._clear_pending_links(NetworkError('Not connected'))
+            # queue the subscriptions to be made again once reconnected. They
+            # stay in the subscriptions list, so that receive() keeps waiting
+            # on them, and are updated in place as their links attach.
+            queued = set(id(sub.get('previous'))
+                         for sub in client._queued_subscriptions)
+            for sub in client._subscriptions:
+                if id(sub) in queued:
+                    continue
+                client._queued_subscriptions.append({
+                    'noop': False,
+                    'address': sub['address'],
+                    'qos': sub['qos'],
+                    'auto_confirm': sub['auto_confirm'],
+                    'topic_pattern': sub['topic_pattern'],
+                    'share': sub['share'],
+                    'options': sub['options'],
+                    'on_subscribed': None,
+                    'on_message': sub['on_message'],
+                    'previous': sub
+                })
             # also clear any left over outstanding sends
             client._outstanding_sends = []
-            client._perform_connect(
-                self._process_queued_actions,
-                self._service,
-                False)
+
+            def reconnected(client):
+                """
+                Called, like on_started, with the client once it has
+                reconnected, to make the queued subscriptions and sends
+                """
+                client._process_queued_actions()
+            client._perform_connect(reconnected, self._service, False)
 
             LOG.exit('Client.reconnect.stop_processing', client.get_id(), None)
 
@@ -1837,12 +2327,148 @@ class Client(object):
         """
         LOG.data(self._id, 'state:', state)
         if state in STATES:
+            trace.record(trace.STATE, self._id, STATES.index(state))
             self._state = state
         else:
             raise InvalidArgumentError('invalid state')
 
     state = property(get_state)
 
+    def metrics(self):
+        """Returns a snapshot of the client's metrics, as a dictionary keyed
+        by metric name. Counters and gauges are numbers, except the
+        ``credit`` and ``unconfirmed`` gauges, which are dictionaries keyed by
+        subscription address. Histograms are dictionaries holding the
+        ``count`` and ``sum`` of the values observed and the cumulative
+        ``buckets``. Use a ``MetricsExporter`` to write the metrics out
+        periodically.
+
+        :returns: the metrics.
+        """
+        LOG.entry('Client.metrics', self._id)
+        snapshot = self._metrics.snapshot()
+        LOG.exit('Client.metrics', self._id, snapshot)
+        return snapshot
+
+    def get_latency(self, topic_pattern=None):
+        """Returns the time taken for messages to arrive from the clients
+        that sent them, for a client created with ``track_latency``. Only
+        messages sent by clients that are also tracking latency are timed.
+
+        :param topic_pattern: (optional) the topic pattern of the
+            subscription to return the latency of.
+        :returns: a dictionary holding the ``count``, ``sum``, ``min`` and
+            ``max`` of the latencies, in seconds, and their ``p50``, ``p90``,
+            ``p99`` and ``p999`` percentiles, or an empty dictionary if no
+            latencies have been recorded for topic_pattern. If topic_pattern
+            is not given, a dictionary of these, keyed by topic pattern.
+        """
+        LOG.entry('Client.get_latency', self._id)
+        LOG.parms(self._id, 'topic_pattern:', topic_pattern)
+        latency = self._latencies.value()
+        if topic_pattern is not None:
+            latency = latency.get(topic_pattern, {})
+        LOG.exit('Client.get_latency', self._id, latency)
+        return latency
+
+    def get_send_latency(self, topic=None):
+        """Returns the time taken by each stage of sending at least once
+        messages, for a client created with ``track_latency``. The stages
+        are ``queue``, waiting to be processed after ``send()`` is called,
+        ``put``, being put into the AMQP library, ``write``, waiting for the
+        library to write out the message, and ``disposition``, waiting for
+        the MQ Light service to settle the message.
+
+        :param topic: (optional) the topic to return the latencies of
+            messages sent to. Once 100 topics have been sent to, the
+            messages sent to any other topics are timed together, and these
+            times are returned for any topic not among the first 100.
+        :returns: a dictionary, keyed by stage, of dictionaries holding the
+            ``count``, ``sum``, ``min`` and ``max`` of the times taken, in
+            seconds, and their ``p50``, ``p90``, ``p99`` and ``p999``
+            percentiles. Empty if the client is not tracking latency, or
+            has not sent at least once messages to topic (or, once 100
+            topics have been sent to, to any of the other topics).
+        """
+        LOG.entry('Client.get_send_latency', self._id)
+        LOG.parms(self._id, 'topic:', topic)
+        latency = {}
+        if self._send_stages is not None:
+            for stage in SEND_STAGES:
+                if topic is None:
+                    latency[stage] = self._send_stages.histogram(
+                        stage).value()
+                else:
+                    value = self._send_stage_topics[stage].value()
+                    key = topic
+                    if key not in value and len(value) >= MAX_STAGE_TOPICS:
+                        key = OTHER_KEY
+                    if key in value:
+                        latency[stage] = value[key]
+        LOG.exit('Client.get_send_latency', self._id, latency)
+        return latency
+
+    def add_hook(self, point, func):
+        """Adds an instrumentation hook, which is called each time a message
+        passes point. The points are ``send_enqueued``, ``put``, ``written``,
+        ``disposition``, ``chunk_pushed``, ``message_dispatched`` and
+        ``handler_returned``. The function prototype must be
+        ``func(point, timestamp, client_id, details)`` where ``timestamp`` is
+        read from a high resolution clock, suitable for timing the gaps
+        between points, and ``details`` is a dictionary identifying the
+        message: the ``send_id`` and ``topic`` of a send, the ``bytes``
+        written or pushed, or the ``topic``, ``subscription`` and
+        ``delivery`` id of a received message. Hooks are called on the
+        client's own threads, so must return quickly.
+
+        :param point: the point to call func at.
+        :param func: the function to call.
+        :raises TypeError: if func is not a function.
+        :raises InvalidArgumentError: if point is not a hook point.
+        """
+        LOG.entry('Client.add_hook', self._id)
+        LOG.parms(self._id, 'point:', point)
+        LOG.parms(self._id, 'func:', func)
+        if not hasattr(func, '__call__'):
+            raise TypeError('func must be a function')
+        if point not in hooks.HOOK_POINTS:
+            raise InvalidArgumentError(
+                'point must be one of {0}'.format(
+                    ', '.join(hooks.HOOK_POINTS)))
+        hooks.add_hook(self._hooks, point, func)
+        LOG.exit('Client.add_hook', self._id, None)
+
+    def remove_hook(self, point, func):
+        """Removes an instrumentation hook added with add_hook.
+
+        :param point: the point func was added at.
+        :param func: the function to remove.
+        :returns: ``True`` if the hook was removed, ``False`` if it had not
+            been added.
+        """
+        LOG.entry('Client.remove_hook', self._id)
+        LOG.parms(self._id, 'point:', point)
+        LOG.parms(self._id, 'func:', func)
+        removed = hooks.remove_hook(self._hooks, point, func)
+        LOG.exit('Client.remove_hook', self._id, removed)
+        return removed
+
+    def get_resubscribe_time(self):
+        """
+        Returns how long, in seconds, it took to make the client's
+        subscriptions again after it last reconnected to the MQ Light
+        service, from the connection being made to the last subscription
+        having its link attached. Subscriptions requested while the client
+        was starting are counted in the same way. Returns None if there have
+        been no subscriptions to make.
+        """
+        LOG.entry('Client.get_resubscribe_time', self._id)
+        LOG.exit(
+            'Client.get_resubscribe_time',
+            self._id,
+            self._resubscribe_time)
+        return self._resubscribe_time
+
     def is_stopped(self):
         """
         :returns: ``True`` if the Client is in the stopped or stopping state,
@@ -1881,6 +2507,7 @@ class Client(object):
             invalid.
         """
         LOG.entry('Client.send', self._id)
+        trace.record(trace.SEND, self._id)
         self._next_message = False
         # Validate the passed parameters
         if topic is None:
@@ -1951,14 +2578,27 @@ class Client(object):
             self._on_drain_required = True
             LOG.exit('Client.send', self._id, False)
             return False
+        send_id = None
+        sent_at = None
+        enqueued = None
+        if self._track_latency:
+            sent_at = (time.time(), _MONOTONIC() if _MONOTONIC else None)
+            enqueued = hooks.now()
+        if self._hooks or sent_at:
+            send_id = next(self._send_ids)
+        if self._hooks:
+            hooks.call_hooks(self._hooks, hooks.SEND_ENQUEUED, self._id, {
+                'send_id': send_id, 'topic': topic, 'qos': qos})
         self._action_queue.put((self._send,
-                                topic, data, options, on_sent, qos, ttl))
+                                topic, data, options, on_sent, qos, ttl,
+                                send_id, sent_at, enqueued))
         # FIXME: the drain behaviour seems badly implemented to me
         self._next_message = len(self._outstanding_sends) <= 1
         LOG.exit('Client.send', self._id, self._next_message)
         return self._next_message
 
-    def _send(self, topic, data, options, on_sent, qos, ttl):
+    def _send(self, topic, data, options, on_sent, qos, ttl, send_id=None,
+              sent_at=None, enqueued=None):
         """
         The internals of the send method that takes place without
         blocking the main thread.
@@ -1973,23 +2613,47 @@ class Client(object):
                 msg.ttl = ttl
 
             msg.body = data
+            msg.message_id = '{0}-{1}'.format(
+                self._message_id_prefix, next(self._message_ids))
             if isinstance(data, str):
                 msg.content_type = 'text/plain'
             else:
                 msg.content_type = 'application/octet-stream'
+            if sent_at is not None:
+                properties = {
+                    SENT_ID_PROPERTY: '{0}:{1}'.format(self._id, send_id),
+                    SENT_TIME_PROPERTY: sent_at[0],
+                    SENT_HOST_PROPERTY: _HOSTNAME}
+                if sent_at[1] is not None:
+                    properties[SENT_CLOCK_PROPERTY] = sent_at[1]
+                msg.properties = properties
 
             # Record that a send operation is in progress
-            self._outstanding_sends.append({
+            in_flight = {
                 'msg': msg,
                 'qos': qos,
                 'on_sent': on_sent,
                 'topic': topic,
-                'options': options
-            })
+                'options': options,
+                'send_id': send_id
+            }
+            if enqueued is not None and qos == QOS_AT_LEAST_ONCE:
+                in_flight['stages'] = {
+                    'enqueued': enqueued,
+                    'dequeued': hooks.now()
+                }
+            self._outstanding_sends.append(in_flight)
             in_outstanding_sends = True
 
             self._messenger.put(msg, qos)
+            if 'stages' in in_flight:
+                in_flight['stages']['put'] = hooks.now()
+            if self._hooks:
+                hooks.call_hooks(self._hooks, hooks.PUT, self._id, {
+                    'send_id': send_id, 'topic': topic, 'qos': qos})
             self._messenger.send(self._sock)
+            self._messages_sent.inc()
+            self._bytes_sent.inc(_message_size(data))
 
             if len(self._outstanding_sends) == 1:
                 def send_outbound_msg():
@@ -2012,6 +2676,8 @@ class Client(object):
 
                             if tries == 0:
                                 LOG.debug(self._id, 'output still pending')
+                            elif self._send_stages is not None:
+                                self._stamp_written()
 
                             # See if any of the outstanding send operations
                             # have now been completed
@@ -2071,6 +2737,18 @@ class Client(object):
                                     # Remove send operation from list of
                                     # outstanding send ops
                                     self._outstanding_sends.pop(0)
+                                    if err is not None:
+                                        self._send_errors.inc()
+                                    elif 'stages' in in_flight:
+                                        self._record_send_stages(in_flight)
+                                    if self._hooks:
+                                        hooks.call_hooks(
+                                            self._hooks,
+                                            hooks.DISPOSITION,
+                                            self._id,
+                                            {'send_id': in_flight['send_id'],
+                                             'topic': in_flight['topic'],
+                                             'status': status})
 
                                     # Generate drain event
                                     if self._on_drain_required and len(
@@ -2273,7 +2951,7 @@ class Client(object):
 
         :param topic_pattern: The topic to subscribe to.
         :param share: The share name of the subscription.
-        :param options: Four valid options. "qos" specifies the quality of
+        :param options: Eight valid options. "qos" specifies the quality of
             service. This can be 1 for at-least-once, or 0 for at-most-once,
             where no callback is triggered. "ttl" specifies the time-to-live
             of the subscription in seconds, which is how long the subscription
@@ -2287,7 +2965,28 @@ class Client(object):
             "auto_confirm" is True by default. If set to false, the client must
             manually confirm messages in order to recover link credit and
             receive more messages once it has run out. "auto_confirm" has no
-            effect if qos is 0.
+            effect if qos is 0. "pull", if set to True, holds messages until
+            the application asks for them by calling receive() or
+            iter_messages(), instead of calling on_message. Link credit is
+            then only flowed as messages are asked for, and "credit" limits
+            the number of unconfirmed messages. "pull" is False by default.
+            "max_prefetch_bytes", if specified, limits the total size of the
+            messages that the client holds, or has given the MQ Light service
+            credit to send, for the subscription. Credit is then flowed based
+            on the average size of the messages received so far. "dedup", if
+            set to True or to a DuplicateFilter, drops messages that have
+            already been received by the subscription, such as those that
+            are delivered again after the client reconnects, before they
+            reach on_message. Messages are identified by their topic and
+            message id, which the client sets on every message it sends, and
+            messages without a message id are always delivered. "dedup" can
+            only be used with a "qos" of 1, as messages sent at most once are
+            never delivered again. Pass a DuplicateFilter to
+            control its memory use and read its statistics. "dispatcher", if
+            set to a KeyedDispatcher, calls on_message on the dispatcher's
+            threads, so that messages with different keys are handled at the
+            same time while messages with the same key stay in order. It
+            cannot be used with "pull".
         :param on_subscribed: A function to call when the subscription is done.
             This function prototype must be ``func(err, pattern, share)`` where
             ``err`` is ``None`` if the client subscribed successfully otherwise
@@ -2306,7 +3005,70 @@ class Client(object):
         :raises InvalidArgumentError: if any of the arguments are
             invalid.
         """
+        return self._subscribe(
+            topic_pattern,
+            share,
+            options,
+            on_subscribed,
+            on_message)
+
+    def subscribe_many(self, subscriptions, on_subscribed=None):
+        """Makes a number of subscriptions at once. The requests for every
+        subscription are written to the network together, and credit is
+        flowed to each as soon as the MQ Light service has attached its link,
+        so this is much quicker than calling subscribe() for each in turn.
+
+        :param subscriptions: a list of dicts, each holding the arguments to
+            subscribe() for one subscription: 'topic_pattern' and, optionally,
+            'share', 'options', 'on_subscribed' and 'on_message'.
+        :param on_subscribed: (optional) function to call once every
+            subscription is done. This function prototype must be
+            ``func(err, subscriptions)`` where ``err`` is ``None`` if every
+            subscription was made successfully otherwise the first error and
+            ``subscriptions`` is the list that was passed in. Errors for an
+            individual subscription, including invalid arguments, are passed
+            to its own on_subscribed function.
+        :return: The client instance.
+        :raises TypeError: if subscriptions is not a list of dicts, or
+            on_subscribed is not a function.
+        :raise StoppedError: if the client is stopped
+        """
+        LOG.entry('Client.subscribe_many', self._id)
+        if not isinstance(subscriptions, (list, tuple)) or \
+                not all(isinstance(sub, dict) for sub in subscriptions):
+            raise TypeError('subscriptions must be a list of dicts')
+        LOG.parms(self._id, 'subscriptions:', subscriptions)
+        if on_subscribed and not hasattr(on_subscribed, '__call__'):
+            raise TypeError('on_subscribed must be a function')
+        LOG.parms(self._id, 'on_subscribed:', on_subscribed)
+        if self.is_stopped():
+            raise StoppedError('not started')
+
+        def subscribed(err):
+            if on_subscribed:
+                on_subscribed(err, subscriptions)
+        self._subscribe_batch(subscriptions, subscribed)
+        LOG.exit('Client.subscribe_many', self._id, self)
+        return self
+
+    def _subscribe(
+            self,
+            topic_pattern,
+            share,
+            options,
+            on_subscribed,
+            on_message,
+            write=True,
+            previous=None):
+        """
+        Performs a subscribe. If write is False the attach is left for the
+        caller to write to the network. previous is the record of a
+        subscription that is being made again after a reconnect, which is
+        reused so that its message buffer and duplicate filter are kept.
+        """
         LOG.entry('Client.subscribe', self._id)
+        LOG.parms(self._id, 'write:', write)
+        trace.record(trace.SUBSCRIBE, self._id, int(previous is not None))
         if topic_pattern is None or topic_pattern == '':
             raise TypeError(
                 'Cannot subscribe to an empty pattern')
@@ -2336,6 +3098,10 @@ class Client(object):
         auto_confirm = True
         ttl = 0
         credit = 1024
+        pull = False
+        max_prefetch_bytes = None
+        dedup = None
+        dispatcher = None
         if options:
             if 'qos' in options:
                 if options['qos'] in QOS:
@@ -2370,6 +3136,53 @@ class Client(object):
                     raise RangeError(
                         'options[\'credit\'] value {0} is invalid must be an '
                         'unsigned integer number'.format(options['credit']))
+            if 'max_prefetch_bytes' in options and \
+                    options['max_prefetch_bytes'] is not None:
+                try:
+                    max_prefetch_bytes = int(options['max_prefetch_bytes'])
+                    if max_prefetch_bytes <= 0:
+                        raise TypeError()
+                except Exception:
+                    raise RangeError(
+                        'options[\'max_prefetch_bytes\'] value {0} is '
+                        'invalid must be a positive integer number'.format(
+                            options['max_prefetch_bytes']))
+            if 'pull' in options:
+                if options['pull'] in (True, False):
+                    pull = options['pull']
+                else:
+                    raise TypeError(
+                        'options[\'pull\'] value {0} is invalid must '
+                        'evaluate to True or False'.format(options['pull']))
+            if 'dedup' in options:
+                if isinstance(options['dedup'], DuplicateFilter):
+                    dedup = options['dedup']
+                elif options['dedup'] is True:
+                    dedup = DuplicateFilter()
+                elif options['dedup'] not in (False, None):
+                    raise TypeError(
+                        'options[\'dedup\'] value {0} is invalid must be '
+                        'True, False or a DuplicateFilter'.format(
+                            options['dedup']))
+            if 'dispatcher' in options and \
+                    options['dispatcher'] is not None:
+                if not isinstance(options['dispatcher'], KeyedDispatcher):
+                    raise TypeError(
+                        'options[\'dispatcher\'] value {0} is invalid must '
+                        'be a KeyedDispatcher'.format(options['dispatcher']))
+                if pull:
+                    raise InvalidArgumentError(
+                        'options[\'dispatcher\'] cannot be used with '
+                        'options[\'pull\']')
+                dispatcher = options['dispatcher']
+        if dedup is not None and qos != QOS_AT_LEAST_ONCE:
+            raise InvalidArgumentError(
+                'options[\'dedup\'] can only be used with options[\'qos\'] '
+                'value of 1 (at least once)')
+        if previous is not None:
+            # Keep filtering out the messages already seen before the
+            # reconnect, as the service may deliver them again
+            dedup = previous['dedup']
 
         if on_subscribed and not hasattr(on_subscribed, '__call__'):
             raise TypeError('on_subscribed must be a function')
@@ -2379,6 +3192,16 @@ class Client(object):
             raise TypeError('on_message must be a function')
         LOG.parms(self._id, 'on_message:', on_message)
 
+        # Pull subscriptions only flow credit as the application calls
+        # receive(). A subscription with a byte budget starts with a single
+        # credit, until the size of its messages is known.
+        if pull:
+            initial_credit = 0
+        elif max_prefetch_bytes:
+            initial_credit = min(credit, 1)
+        else:
+            initial_credit = credit
+
         # Ensure we have attempted a connect
         if self.is_stopped():
             raise StoppedError('not started')
@@ -2397,6 +3220,7 @@ class Client(object):
                 if sub['address'] == subscription_address and sub[
                         'share'] == original_share_value:
                     self._queued_subscriptions.remove(sub)
+                    previous = previous or sub.get('previous')
 
             self._queued_subscriptions.append({
                 'noop': False,  # FIXME: implement noop behaviour for subscribe
@@ -2407,7 +3231,8 @@ class Client(object):
                 'share': original_share_value,
                 'options': options,
                 'on_subscribed': on_subscribed,
-                'on_message': on_message
+                'on_message': on_message,
+                'previous': previous
             })
             LOG.exit('Client.subscribe', self._id, self)
             return self
@@ -2417,7 +3242,7 @@ class Client(object):
         # request to subscribe by throwing a SubscribedError
         for sub in self._subscriptions:
             if sub['address'] == subscription_address and sub[
-                    'share'] == original_share_value:
+                    'share'] == original_share_value and sub is not previous:
                 err = SubscribedError(
                     'client is already subscribed to this address')
                 LOG.error('Client.subscribe', self._id, err)
@@ -2427,6 +3252,8 @@ class Client(object):
             LOG.entry('Client.subscribe.finished_subscribing', self._id)
             LOG.parms(self._id, 'err:', err)
             LOG.parms(self._id, 'callback:', callback)
+            resubscribed = any(
+                sub is previous for sub in self._subscriptions)
 
             if err:
                 LOG.error('Client.subscribe', self._id, err)
@@ -2446,9 +3273,22 @@ class Client(object):
                         'share': original_share_value,
                         'options': options,
                         'on_subscribed': on_subscribed,
-                        'on_message': on_message
+                        'on_message': on_message,
+                        'previous': previous
                     })
                     self._reconnect()
+                elif resubscribed:
+                    self._subscriptions.remove(previous)
+                    if previous['pull']:
+                        previous['received'].put(err)
+            elif resubscribed:
+                # the subscription is attached again, on a new link, so
+                # start its credit accounting afresh
+                with previous['lock']:
+                    previous['unconfirmed'] = 0
+                    previous['confirmed'] = 0
+                    previous['link_credit'] = initial_credit
+                    previous['held_bytes'] = 0
             else:
                 # if no errors, add this to the stored list of subscriptions
                 self._subscriptions.append({
@@ -2462,7 +3302,17 @@ class Client(object):
                     'on_message': on_message,
                     'credit': credit,
                     'unconfirmed': 0,
-                    'confirmed': 0
+                    'confirmed': 0,
+                    'link': share + topic_pattern,
+                    'pull': pull,
+                    'link_credit': initial_credit,
+                    'received': Queue.Queue() if pull else None,
+                    'dedup': dedup,
+                    'dispatcher': dispatcher,
+                    'max_prefetch_bytes': max_prefetch_bytes,
+                    'held_bytes': 0,
+                    'average_size': 0,
+                    'lock': threading.Lock()
                 })
 
             if callback:
@@ -2479,39 +3329,30 @@ class Client(object):
                     qos,
                     ttl,
                     credit,
-                    self._sock)
-
-                def still_subscribing(on_subscribed):
-                    LOG.entry('Client.subscribe.still_subscribing', self._id)
-                    err = None
-                    try:
-                        while not self._messenger.subscribed(address):
-                            if self.state == STOPPED:
-                                err = StoppedError('not started')
-                                break
-                            time.sleep(0.5)
-                        else:
-                            if credit > 0:
-                                self._messenger.flow(
-                                    address,
-                                    credit,
-                                    self._sock)
-                            finished_subscribing(err, on_subscribed)
-                    except Exception as exc:
-                        LOG.error(
-                            'Client.subscribe.still_subscribing',
-                            self._id,
-                            exc)
-                        finished_subscribing(exc, on_subscribed)
-                    LOG.exit(
-                        'Client.subscribe.still_subscribing',
-                        self._id,
-                        None)
+                    self._sock,
+                    write)
+
+                def attached(err):
+                    LOG.entry('Client.subscribe.attached', self._id)
+                    if err is None and initial_credit > 0:
+                        try:
+                            # written by _check_pending_links, together with
+                            # the credit for any other links just attached
+                            self._messenger.flow(
+                                address,
+                                initial_credit,
+                                self._sock,
+                                False)
+                        except Exception as exc:
+                            LOG.error(
+                                'Client.subscribe.attached',
+                                self._id,
+                                exc)
+                            err = exc
+                    finished_subscribing(err, on_subscribed)
+                    LOG.exit('Client.subscribe.attached', self._id, None)
 
-                wait_for_subscribe_thread = threading.Thread(
-                    target=still_subscribing,
-                    args=(on_subscribed,))
-                wait_for_subscribe_thread.start()
+                self._add_pending_link(address, True, attached)
             except Exception as exc:
                 LOG.error('Client.subscribe', self._id, exc)
                 if isinstance(exc, (MQLightError, TypeError)):
@@ -2558,6 +3399,7 @@ class Client(object):
             invalid.
         """
         LOG.entry('Client.unsubscribe', self._id)
+        trace.record(trace.UNSUBSCRIBE, self._id)
         LOG.parms(self._id, 'topic_pattern:', topic_pattern)
 
         if topic_pattern is None or topic_pattern == '':
@@ -2702,6 +3544,10 @@ class Client(object):
                     if sub['address'] == subscription_address and sub[
                             'share'] == original_share_value:
                         self._subscriptions.remove(sub)
+                        if sub['pull']:
+                            sub['received'].put(UnsubscribedError(
+                                'client is not subscribed to this address: '
+                                '{0}'.format(address)))
                         break
 
             if callback:
@@ -2718,35 +3564,262 @@ class Client(object):
         try:
             self._messenger.unsubscribe(address, ttl, self._sock)
 
-            def still_unsubscribing(on_unsubscribed):
-                LOG.entry('Client.unsubscribe.still_unsubscribing', self._id)
-                err = None
-                try:
-                    while not self._messenger.unsubscribed(address):
-                        if self.state == STOPPED:
-                            err = StoppedError('not started')
-                            break
-                        time.sleep(0.5)
-                    else:
-                        finished_unsubscribing(err, on_unsubscribed)
-                except Exception as exc:
-                    LOG.error(
-                        'Client.unsubscribe.still_unsubscribing',
-                        self._id,
-                        exc)
-                    finished_unsubscribing(exc, on_unsubscribed)
-                LOG.exit(
-                    'Client.unsubscribe.still_unsubscribing',
-                    self._id,
-                    None)
-
-            wait_for_unsubscribe_thread = threading.Thread(
-                target=still_unsubscribing,
-                args=(on_unsubscribed,))
-            wait_for_unsubscribe_thread.start()
+            self._add_pending_link(
+                address,
+                False,
+                lambda err: finished_unsubscribing(err, on_unsubscribed))
         except Exception as exc:
             LOG.error('Client.unsubscribe', self._id, exc)
             finished_unsubscribing(exc, on_unsubscribed)
 
         LOG.exit('Client.unsubscribe', self._id, self)
         return self
+
+    def confirm_all(self, deliveries):
+        """Confirms a batch of messages received by subscriptions that were
+        created with a ``qos`` of 1 and ``auto_confirm`` set to ``False``. This
+        has the same effect as calling ``delivery.confirm()`` for each
+        delivery, except that the settlement of every message, and the link
+        credit this frees up, are written to the network together.
+
+        :param deliveries: a list of the ``delivery`` arguments passed to
+            on_message. Deliveries that do not need to be confirmed, or that
+            have already been confirmed, are ignored.
+        :returns: The instance of the client.
+        :raises TypeError: if deliveries is not a list.
+        :raises NetworkError: if the client is not started, or has reconnected
+            since one of the messages was received.
+        """
+        LOG.entry('Client.confirm_all', self._id)
+        if not isinstance(deliveries, (list, tuple)):
+            err = TypeError('deliveries must be a list')
+            LOG.error('Client.confirm_all', self._id, err)
+            raise err
+        LOG.parms(self._id, 'deliveries:', len(deliveries))
+
+        for delivery in deliveries:
+            if not isinstance(delivery, Delivery):
+                err = TypeError(
+                    'deliveries must only contain delivery objects')
+                LOG.error('Client.confirm_all', self._id, err)
+                raise err
+
+        self._confirm_deliveries(deliveries)
+        LOG.exit('Client.confirm_all', self._id, self)
+        return self
+
+    def _get_pull_subscription(self, method, topic_pattern, share):
+        """
+        Validates the arguments identifying a pull subscription, returning the
+        subscription
+        """
+        if topic_pattern is None or topic_pattern == '':
+            err = TypeError('You must specify a topic_pattern argument')
+            LOG.error(method, self._id, err)
+            raise err
+        topic_pattern = str(topic_pattern)
+        if share is not None and ':' in str(share):
+            err = InvalidArgumentError(
+                'share argument value {0} is invalid because it contains '
+                'a colon (:) character'.format(share))
+            LOG.error(method, self._id, err)
+            raise err
+
+        # Ensure we have attempted a connect
+        if self.is_stopped():
+            err = StoppedError('not started')
+            LOG.error(method, self._id, err)
+            raise err
+
+        subscription_address = self._service + '/' + topic_pattern
+        for sub in self._subscriptions:
+            if sub['address'] == subscription_address and sub[
+                    'share'] == share:
+                break
+        else:
+            err = UnsubscribedError(
+                'client is not subscribed to this address: {0}'.format(
+                    subscription_address))
+            LOG.error(method, self._id, err)
+            raise err
+        if not sub['pull']:
+            err = InvalidArgumentError(
+                'the subscription to {0} was not created with options['
+                '\'pull\'] set to True'.format(subscription_address))
+            LOG.error(method, self._id, err)
+            raise err
+        return sub
+
+    def receive(
+            self,
+            topic_pattern,
+            share=None,
+            timeout=None,
+            max_messages=1):
+        """Receives messages from a subscription that was created with
+        options['pull'] set to ``True``. This method blocks until at least one
+        message is available, or the timeout expires. Link credit is only
+        flowed to the MQ Light service as messages are asked for, so the
+        client never holds more than ``max_messages`` messages for the
+        subscription. This method must not be called from a callback invoked
+        by the client.
+
+        :param topic_pattern: the topic_pattern that was supplied in the call
+            to subscribe.
+        :param share: (optional) the share that was supplied in the call to
+            subscribe.
+        :param timeout: (optional) the number of seconds to wait for a message
+            to arrive. If not specified this method waits until a message
+            arrives.
+        :param max_messages: (optional) the maximum number of messages to
+            return. Defaults to 1.
+        :returns: A list of ``(message_type, data, delivery)`` tuples, holding
+            the arguments that would have been passed to an on_message
+            function. The list is empty if the timeout expired before a
+            message arrived.
+        :raises TypeError: if the type of any of the arguments is incorrect.
+        :raises RangeError: if the value of any argument is not within
+            certain values.
+        :raises StoppedError: if the client is, or becomes, stopped.
+        :raises UnsubscribedError: if the client is not subscribed to the
+            topic_pattern and share, or unsubscribes while waiting.
+        :raises InvalidArgumentError: if the subscription was not created with
+            options['pull'] set to ``True``.
+        """
+        LOG.entry('Client.receive', self._id)
+        LOG.parms(self._id, 'topic_pattern:', topic_pattern)
+        LOG.parms(self._id, 'share:', share)
+        LOG.parms(self._id, 'timeout:', timeout)
+        LOG.parms(self._id, 'max_messages:', max_messages)
+
+        if timeout is not None:
+            try:
+                timeout = float(timeout)
+                if not timeout >= 0:
+                    raise TypeError()
+            except Exception:
+                err = RangeError(
+                    'timeout value {0} is invalid must be a positive '
+                    'number'.format(timeout))
+                LOG.error('Client.receive', self._id, err)
+                raise err
+        try:
+            max_messages = int(max_messages)
+            if max_messages < 1:
+                raise TypeError()
+        except Exception:
+            err = RangeError(
+                'max_messages value {0} is invalid must be a positive '
+                'integer number'.format(max_messages))
+            LOG.error('Client.receive', self._id, err)
+            raise err
+        sub = self._get_pull_subscription(
+            'Client.receive', topic_pattern, share)
+
+        # Top up the link credit so that the messages already buffered, plus
+        # those the service may still send, cover the request
+        with sub['lock']:
+            limit = sub['credit'] - sub['unconfirmed']
+            if sub['max_prefetch_bytes']:
+                limit = min(limit, _prefetch_window(sub))
+            wanted = min(
+                max_messages - sub['received'].qsize() - sub['link_credit'],
+                limit - sub['link_credit'])
+            if wanted > 0 and self.state == STARTED:
+                sub['link_credit'] += wanted
+            else:
+                wanted = 0
+        if wanted > 0:
+            LOG.data(self._id, 'flowing credit:', wanted)
+            self._messenger.flow(
+                self._service + '/' + sub['link'],
+                wanted,
+                self._sock)
+
+        items = []
+        try:
+            items.append(sub['received'].get(True, timeout))
+            while len(items) < max_messages:
+                items.append(sub['received'].get_nowait())
+        except Queue.Empty:
+            pass
+
+        result = []
+        settled = 0
+        for item in items:
+            if isinstance(item, MQLightError):
+                # Leave the error in place for any other thread that is
+                # waiting on the subscription
+                sub['received'].put(item)
+                if not result:
+                    LOG.error('Client.receive', self._id, item)
+                    raise item
+                break
+            state, data, delivery, msg, size = item
+            if msg is not None:
+                if msg.connection_id != self._connection_id:
+                    # The message arrived on a previous connection, so it can
+                    # no longer be settled and will be redelivered
+                    with sub['lock']:
+                        if sub['max_prefetch_bytes']:
+                            sub['held_bytes'] -= size
+                    if sub['dedup'] is not None and \
+                            msg.message_id is not None:
+                        # The redelivered copy must not be dropped
+                        sub['dedup'].forget(sub['dedup'].message_key(
+                            msg.message_id, msg.address))
+                    continue
+                self._messenger.settle(msg, self._sock, False)
+                self._confirmed(sub, msg.link_address, 1, False, size)
+                settled += 1
+            elif not delivery.requires_confirmation:
+                # The message has already been settled, so it stops counting
+                # against the byte budget once the application has it
+                with sub['lock']:
+                    if sub['max_prefetch_bytes']:
+                        sub['held_bytes'] -= size
+            result.append((state, data, delivery))
+        if settled:
+            self._messenger.pop(self._sock, False)
+
+        LOG.exit('Client.receive', self._id, len(result))
+        return result
+
+    def iter_messages(self, topic_pattern, share=None, timeout=None):
+        """Returns an iterator over the messages received by a subscription
+        that was created with options['pull'] set to ``True``. Each step of
+        the iteration calls receive() for a single message, so link credit is
+        only flowed to the MQ Light service as the application consumes
+        messages. The iteration ends when no message arrives within the
+        timeout, or when the client is stopped or unsubscribes.
+
+        :param topic_pattern: the topic_pattern that was supplied in the call
+            to subscribe.
+        :param share: (optional) the share that was supplied in the call to
+            subscribe.
+        :param timeout: (optional) the number of seconds to wait for each
+            message to arrive. If not specified, each step waits until a
+            message arrives.
+        :returns: An iterator of ``(message_type, data, delivery)`` tuples.
+        :raises TypeError: if the type of any of the arguments is incorrect.
+        :raises StoppedError: if the client is stopped.
+        :raises UnsubscribedError: if the client is not subscribed to the
+            topic_pattern and share.
+        :raises InvalidArgumentError: if the subscription was not created with
+            options['pull'] set to ``True``.
+        """
+        LOG.entry('Client.iter_messages', self._id)
+        self._get_pull_subscription(
+            'Client.iter_messages', topic_pattern, share)
+
+        def messages():
+            while True:
+                try:
+                    received = self.receive(topic_pattern, share, timeout)
+                except (StoppedError, UnsubscribedError):
+                    return
+                if not received:
+                    return
+                yield received[0]
+        LOG.exit('Client.iter_messages', self._id, None)
+        return messages()
@@ -0,0 +1,131 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Detection of messages that are delivered more than once
+"""
+from __future__ import division, absolute_import
+import hashlib
+import threading
+from collections import OrderedDict
+from .exceptions import RangeError
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+
+def _to_bytes(value):
+    """
+    Returns the bytes to hash for a message id or topic
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+
+class DuplicateFilter(object):
+
+    """
+    Remembers the keys of recently received messages, so that a message that
+    is delivered again, for example after the client reconnects before
+    confirming it, can be dropped before it reaches the on_message function.
+    Messages are identified by their message id, which the client sets on
+    every message it sends. Messages without a message id are never treated
+    as duplicates, as two different messages can have the same body.
+
+    The keys of the last ``capacity`` messages are held in least recently
+    used order. Each key is a 16 byte digest, however long the message id
+    and topic, so the memory used is bounded by the capacity.
+
+    A single DuplicateFilter can be shared by several subscriptions.
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        Creates a DuplicateFilter.
+
+        :param capacity: the number of message keys to remember.
+        :raises RangeError: if capacity is not a positive integer number.
+        """
+        LOG.entry('DuplicateFilter.constructor', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'capacity:', capacity)
+        try:
+            capacity = int(capacity)
+            if capacity <= 0:
+                raise TypeError()
+        except Exception:
+            raise RangeError(
+                'capacity value {0} is invalid must be a positive integer '
+                'number'.format(capacity))
+        self._capacity = capacity
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._duplicates = 0
+        LOG.exit('DuplicateFilter.constructor', NO_CLIENT_ID, None)
+
+    @staticmethod
+    def message_key(message_id, topic):
+        """
+        Returns the key for a message, which is a digest of its message id
+        and its topic
+        """
+        digest = hashlib.md5(_to_bytes(topic))
+        digest.update(b'\0')
+        digest.update(_to_bytes(message_id))
+        return digest.digest()
+
+    def check(self, key):
+        """
+        Returns True if a message with the key has been seen recently, and
+        remembers the key as the most recently seen
+        """
+        with self._lock:
+            self._checked += 1
+            duplicate = self._recent.pop(key, False)
+            if duplicate:
+                self._duplicates += 1
+            # Added again, or for the first time, as the most recently used
+            self._recent[key] = True
+            if len(self._recent) > self._capacity:
+                self._recent.popitem(last=False)
+            return duplicate
+
+    def forget(self, key):
+        """
+        Forgets a key, so that a message with the key is no longer treated as
+        a duplicate. Used when a message is discarded without being passed to
+        the application.
+        """
+        with self._lock:
+            self._recent.pop(key, None)
+
+    def stats(self):
+        """
+        Returns a dictionary of statistics about the messages checked:
+        ``checked`` is the number of messages checked, ``duplicates`` the
+        number found to be duplicates, ``hit_rate`` the proportion of
+        messages that were duplicates, and ``size`` the number of keys
+        currently remembered.
+        """
+        with self._lock:
+            checked = self._checked
+            duplicates = self._duplicates
+            return {
+                'checked': checked,
+                'duplicates': duplicates,
+                'hit_rate': duplicates / checked if checked else 0.0,
+                'size': len(self._recent)
+            }
@@ -0,0 +1,212 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Delivery information passed to the application with each received message
+"""
+from __future__ import absolute_import
+
+# The confirmation states of a delivery
+_NOT_REQUIRED = 0
+_UNCONFIRMED = 1
+_CONFIRMED = 2
+
+# Sentinel for values that have not been read from the message yet
+_UNSET = object()
+
+
+class Delivery(object):
+
+    """
+    Describes a message received by a subscription. A Delivery is passed to
+    the on_message function, and returned by Client.receive(), along with the
+    message data. The topic, share and topic pattern are only parsed from the
+    addresses of the message when they are first used.
+
+    For compatibility, a Delivery can also be used as a dictionary, for
+    example ``delivery['message']['topic']`` or
+    ``delivery['destination']['share']``.
+    """
+    __slots__ = ('_client', '_subscription', '_msg', '_size', '_state',
+                 '_address', '_link_address', '_topic', '_share',
+                 '_topic_pattern', 'ttl', 'malformed')
+
+    def __init__(self, client, subscription, msg, size, requires_confirmation,
+                 malformed=None):
+        self._client = client
+        self._subscription = subscription
+        self._size = size
+        if requires_confirmation:
+            # The message is only kept until the application confirms it
+            self._msg = msg
+            self._state = _UNCONFIRMED
+        else:
+            self._msg = None
+            self._state = _NOT_REQUIRED
+        self._address = msg.address
+        self._link_address = msg.link_address
+        self._topic = _UNSET
+        self._share = _UNSET
+        self._topic_pattern = _UNSET
+        ttl = msg.ttl
+        self.ttl = ttl if ttl > 0 else None
+        self.malformed = malformed
+
+    def _get_topic(self):
+        """
+        Returns the topic that the message was sent to
+        """
+        if self._topic is _UNSET:
+            topic = self._address
+            if topic and topic.startswith('amqp://'):
+                topic = topic[topic.index('/', 7) + 1:]
+            self._topic = topic
+        return self._topic
+
+    topic = property(_get_topic)
+
+    def _parse_link_address(self):
+        """
+        Splits the address of the link the message arrived on, which is of
+        the form private:<topic_pattern> or share:<share>:<topic_pattern>
+        """
+        link = self._link_address
+        share = None
+        topic_pattern = None
+        if link:
+            if link.startswith('share:'):
+                # Remove 'share:' prefix from link name
+                link = link[6:]
+                share = link[0:link.index(':')]
+            topic_pattern = link[link.index(':') + 1:]
+        self._share = share
+        self._topic_pattern = topic_pattern
+
+    def _get_share(self):
+        """
+        Returns the share name of the subscription, or None if the
+        subscription is private
+        """
+        if self._share is _UNSET:
+            self._parse_link_address()
+        return self._share
+
+    share = property(_get_share)
+
+    def _get_topic_pattern(self):
+        """
+        Returns the topic pattern of the subscription
+        """
+        if self._topic_pattern is _UNSET:
+            self._parse_link_address()
+        return self._topic_pattern
+
+    topic_pattern = property(_get_topic_pattern)
+
+    def _get_requires_confirmation(self):
+        """
+        Returns True if the application must confirm the delivery
+        """
+        return self._state != _NOT_REQUIRED
+
+    requires_confirmation = property(_get_requires_confirmation)
+
+    def _get_confirmed(self):
+        """
+        Returns True if the delivery has been confirmed by the application
+        """
+        return self._state == _CONFIRMED
+
+    confirmed = property(_get_confirmed)
+
+    def confirm(self):
+        """Confirms the delivery of the message, for subscriptions with a
+        ``qos`` of 1 and ``auto_confirm`` set to ``False``. Confirming a
+        message that does not need to be confirmed, or has already been
+        confirmed, has no effect.
+
+        :raises NetworkError: if the client is not started, or has reconnected
+            since the message was received.
+        """
+        self._client._confirm_deliveries([self])
+
+    def _pending(self):
+        """
+        Returns the message waiting to be confirmed, or None if the delivery
+        does not need confirming or has already been confirmed
+        """
+        if self._state == _UNCONFIRMED:
+            return self._msg
+        return None
+
+    def _settled(self):
+        """
+        Records that the message has been settled, returning the
+        subscription, the address of the link and the size of the message,
+        for flowing credit
+        """
+        self._state = _CONFIRMED
+        # The message is no longer needed once it has been settled
+        self._msg = None
+        return self._subscription, self._link_address, self._size
+
+    def __getitem__(self, key):
+        if key == 'message':
+            message = {'topic': self.topic}
+            if self.ttl:
+                message['ttl'] = self.ttl
+            if self.requires_confirmation:
+                message['confirm_delivery'] = self.confirm
+            return message
+        elif key == 'destination' and self._link_address:
+            destination = {'topic_pattern': self.topic_pattern}
+            if self.share is not None:
+                destination['share'] = self.share
+            return destination
+        elif key == 'malformed' and self.malformed is not None:
+            return self.malformed
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """
+        Returns the dictionary view for the key, or default if it is not
+        present
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """
+        Returns the keys available when the delivery is used as a dictionary
+        """
+        keys = ['message']
+        if self._link_address:
+            keys.append('destination')
+        if self.malformed is not None:
+            keys.append('malformed')
+        return keys
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __repr__(self):
+        return 'Delivery(topic: {0}, share: {1}, topic_pattern: {2}, ' \
+            'confirmed: {3})'.format(
+                self.topic, self.share, self.topic_pattern, self.confirmed)
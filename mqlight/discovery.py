@@ -0,0 +1,511 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Discovery of the MQ Light services to connect to, from HTTP(S) URLs and
+files, with the results cached between connection attempts
+"""
+from __future__ import absolute_import
+import codecs
+import os
+import re
+import socket
+import threading
+import time
+from json import loads
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+from .exceptions import InvalidArgumentError, MQLightError, NetworkError
+from .logging import get_logger, NO_CLIENT_ID
+from .timer import call_later
+
+LOG = get_logger(__name__)
+
+# How long, in seconds, a service list fetched over HTTP is used for before
+# it is checked with the server again, unless the server sets a max-age
+DISCOVERY_TTL = 30
+
+# How long, in seconds, to wait for a discovery server to respond
+DISCOVERY_TIMEOUT = 10
+
+# How long, in seconds, to wait for all of the discovery sources together
+DISCOVERY_DEADLINE = 10
+
+
+def _parse_services(text):
+    """
+    Returns the service list held in a discovery JSON document
+    """
+    json_obj = loads(text)
+    if 'service' in json_obj:
+        return json_obj['service']
+    return None
+
+
+class _HTTPServiceSource(object):
+
+    """
+    Fetches the service list from an HTTP(S) URL. The list is cached for the
+    TTL, after which it is revalidated with a conditional GET over a
+    connection that is kept open between requests. If the server cannot be
+    reached, the last list fetched is used.
+    """
+
+    def __init__(self, http, http_url, ttl=DISCOVERY_TTL,
+                 timeout=DISCOVERY_TIMEOUT):
+        self._http = http
+        self._scheme = http_url.scheme
+        self._host = http_url.hostname
+        self._port = http_url.port
+        self._path = http[http.index(http_url.netloc) +
+                          len(http_url.netloc):] or '/'
+        self._ttl = ttl
+        self._timeout = timeout
+        self._conn = None
+        self._service = None
+        self._fetched = False
+        self._expires = 0
+        self._etag = None
+        self._last_modified = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """
+        Returns the connection to the server, opening it if needed
+        """
+        if self._conn is None:
+            func = httplib.HTTPConnection
+            if self._scheme == 'https':
+                func = httplib.HTTPSConnection
+            LOG.data(NO_CLIENT_ID, 'using :', func.__name__)
+            self._conn = func(self._host, self._port, timeout=self._timeout)
+        return self._conn
+
+    def _close(self):
+        """
+        Closes the connection to the server
+        """
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception as exc:
+                LOG.data(NO_CLIENT_ID, 'error closing connection:', exc)
+            self._conn = None
+
+    def _request(self):
+        """
+        Sends a GET for the service list, returning the status and body of
+        the response. A kept open connection that the server has closed is
+        opened again once.
+        """
+        headers = {}
+        if self._fetched:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        for attempt in (1, 2):
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', self._path, headers=headers)
+                res = conn.getresponse()
+                # The body must be read in full before the connection can
+                # be used again
+                body = res.read()
+                break
+            except (httplib.HTTPException, socket.error) as exc:
+                self._close()
+                if not reused or attempt == 2:
+                    raise
+                LOG.data(NO_CLIENT_ID, 'reopening connection after:', exc)
+        if res.getheader('connection', '').lower() == 'close':
+            self._close()
+        return res, body
+
+    def _max_age(self, res):
+        """
+        Returns the max-age set by the server, or the TTL if there is none
+        """
+        match = re.search(
+            r'max-age=(\d+)', res.getheader('cache-control', '') or '')
+        if match:
+            return int(match.group(1))
+        return self._ttl
+
+    def fetch(self):
+        """
+        Returns the service list, fetching it from the server if the cached
+        list has expired
+        """
+        LOG.entry('_HTTPServiceSource.fetch', NO_CLIENT_ID)
+        with self._lock:
+            now = time.time()
+            if self._fetched and now < self._expires:
+                LOG.exit(
+                    '_HTTPServiceSource.fetch',
+                    NO_CLIENT_ID,
+                    self._service)
+                return self._service
+            try:
+                res, body = self._request()
+            except (httplib.HTTPException, socket.error) as exc:
+                err = NetworkError(
+                    '{0} request to {1} failed: {2}'.format(
+                        self._scheme, self._http, exc))
+                return self._stale('_HTTPServiceSource.fetch', err)
+
+            if res.status == httplib.NOT_MODIFIED and self._fetched:
+                LOG.data(NO_CLIENT_ID, 'service list not modified')
+            elif res.status == httplib.OK:
+                try:
+                    service = _parse_services(body)
+                except Exception as exc:
+                    err = TypeError(
+                        '{0} request to {1} returned '
+                        'unparseable JSON: {2}'.format(
+                            self._scheme, self._http, exc))
+                    return self._stale('_HTTPServiceSource.fetch', err)
+                self._service = service
+                self._fetched = True
+                self._etag = res.getheader('etag')
+                self._last_modified = res.getheader('last-modified')
+            else:
+                err = NetworkError(
+                    '{0} request to {1} failed with a status code '
+                    'of {2}'.format(self._scheme, self._http, res.status))
+                return self._stale('_HTTPServiceSource.fetch', err)
+            self._expires = now + self._max_age(res)
+        LOG.exit('_HTTPServiceSource.fetch', NO_CLIENT_ID, self._service)
+        return self._service
+
+    def _stale(self, name, err):
+        """
+        Returns the last service list fetched, in place of one that could not
+        be fetched because of err, or raises err if there is none
+        """
+        LOG.error(name, NO_CLIENT_ID, err)
+        if not self._fetched:
+            raise err
+        LOG.data(NO_CLIENT_ID, 'using the last service list fetched')
+        LOG.exit(name, NO_CLIENT_ID, self._service)
+        return self._service
+
+
+class _FileServiceSource(object):
+
+    """
+    Reads the service list from a file, only reading and parsing it again
+    when the file has changed
+    """
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._stamp = None
+        self._service = None
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        """
+        Returns the service list held in the file
+        """
+        LOG.entry('_FileServiceSource.fetch', NO_CLIENT_ID)
+        with self._lock:
+            try:
+                stat = os.stat(self._file_path)
+                stamp = (stat.st_mtime, stat.st_size)
+                if stamp != self._stamp:
+                    with codecs.open(
+                            self._file_path,
+                            encoding='utf-8',
+                            mode='r') as file_obj:
+                        text = file_obj.read()
+                    try:
+                        self._service = _parse_services(text)
+                    except Exception as exc:
+                        err = MQLightError(
+                            'The content read from {0} contained '
+                            'unparseable JSON: {1}'.format(
+                                self._file_path, exc))
+                        LOG.error(
+                            '_FileServiceSource.fetch',
+                            NO_CLIENT_ID,
+                            err)
+                        raise err
+                    self._stamp = stamp
+            except (IOError, OSError) as exc:
+                err = MQLightError(
+                    'attempt to read {0} failed: {1}'.format(
+                        self._file_path, exc))
+                LOG.error('_FileServiceSource.fetch', NO_CLIENT_ID, err)
+                raise err
+        LOG.exit('_FileServiceSource.fetch', NO_CLIENT_ID, self._service)
+        return self._service
+
+
+class _Fetch(object):
+
+    """
+    A fetch of the service list from one source, run on its own thread so
+    that a source that does not respond cannot hold up the others
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.service = None
+        self.error = None
+        self.done = threading.Event()
+        thread = threading.Thread(target=self._run, name='mqlight-discovery')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        """
+        The body of the fetch thread
+        """
+        try:
+            self.service = self.source.fetch()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done.set()
+
+
+class _ServiceDiscovery(object):
+
+    """
+    A service function that fetches the service list from a number of
+    sources at once, waiting no longer than the deadline for them to
+    respond. The lists returned are merged, with the services listed by the
+    most sources first and ties broken by the order of the sources. Once a
+    list has been fetched it is refreshed in the background, so that
+    connecting, and reconnecting, use the list already held instead of
+    waiting for the sources.
+    """
+
+    def __init__(self, sources, deadline=DISCOVERY_DEADLINE,
+                 refresh_interval=DISCOVERY_TTL):
+        self._sources = sources
+        self._deadline = deadline
+        self._refresh_interval = refresh_interval
+        self._fetches = [None] * len(sources)
+        self._service = None
+        self._refresh_timer = None
+        self._refreshing = False
+        self._stopped = True
+        self._lock = threading.Lock()
+
+    def __call__(self, callback):
+        LOG.entry('_ServiceDiscovery.__call__', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'callback:', callback)
+        with self._lock:
+            self._stopped = False
+            service = self._service
+            if service is not None and self._refresh_timer is None and \
+                    not self._refreshing:
+                # Refreshing was stopped, when the client was stopped, so
+                # start it again now the list is being used
+                self._schedule_refresh()
+        if service is None:
+            try:
+                service = self._update()
+            except Exception as err:
+                LOG.error('_ServiceDiscovery.__call__', NO_CLIENT_ID, err)
+                callback(err, None)
+                LOG.exit('_ServiceDiscovery.__call__', NO_CLIENT_ID, None)
+                return
+        LOG.data(NO_CLIENT_ID, 'service:', service)
+        callback(None, service)
+        LOG.exit('_ServiceDiscovery.__call__', NO_CLIENT_ID, None)
+
+    def fetch(self):
+        """
+        Fetches the service list from every source, returning the merged
+        list, or raising the error from the first source if none of them
+        returned a list before the deadline
+        """
+        LOG.entry('_ServiceDiscovery.fetch', NO_CLIENT_ID)
+        with self._lock:
+            # A source that is still working on an earlier fetch is waited
+            # for, rather than asked again
+            for i, source in enumerate(self._sources):
+                fetch = self._fetches[i]
+                if fetch is None or fetch.done.is_set():
+                    self._fetches[i] = _Fetch(source)
+            fetches = list(self._fetches)
+        deadline = time.time() + self._deadline
+        for fetch in fetches:
+            fetch.done.wait(max(deadline - time.time(), 0))
+
+        lists = []
+        errors = []
+        for i, fetch in enumerate(fetches):
+            if not fetch.done.is_set():
+                errors.append(NetworkError(
+                    'service discovery from source {0} did not complete '
+                    'within {1} seconds'.format(i, self._deadline)))
+            elif fetch.error is not None:
+                errors.append(fetch.error)
+            elif fetch.service:
+                lists.append(fetch.service)
+        for err in errors:
+            LOG.data(NO_CLIENT_ID, 'service discovery error:', err)
+        if not lists:
+            err = errors[0] if errors else NetworkError(
+                'service discovery did not return any services')
+            LOG.error('_ServiceDiscovery.fetch', NO_CLIENT_ID, err)
+            raise err
+        service = _merge_services(lists)
+        LOG.exit('_ServiceDiscovery.fetch', NO_CLIENT_ID, service)
+        return service
+
+    def _update(self):
+        """
+        Fetches the service list, keeping it for the next connection attempt
+        and scheduling the next refresh
+        """
+        try:
+            service = self.fetch()
+        except Exception:
+            with self._lock:
+                self._schedule_refresh()
+            raise
+        with self._lock:
+            self._service = service
+            self._schedule_refresh()
+        return service
+
+    def _schedule_refresh(self):
+        """
+        Schedules the next background refresh. Must be called with the lock
+        held.
+        """
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if not self._stopped:
+            self._refresh_timer = call_later(
+                self._refresh_interval,
+                self._refresh)
+
+    def _refresh(self):
+        """
+        Starts a background refresh of the service list. Runs on the timer
+        thread, which must not wait for the sources.
+        """
+        with self._lock:
+            if self._stopped or self._refreshing:
+                return
+            self._refreshing = True
+        refresher = threading.Thread(
+            target=self._run_refresh,
+            name='mqlight-discovery')
+        refresher.daemon = True
+        refresher.start()
+
+    def _run_refresh(self):
+        """
+        The body of the background refresh thread. The list already held is
+        kept if the refresh fails.
+        """
+        LOG.entry('_ServiceDiscovery._run_refresh', NO_CLIENT_ID)
+        try:
+            self._update()
+        except Exception as exc:
+            LOG.data(NO_CLIENT_ID, 'keeping the service list after:', exc)
+        finally:
+            with self._lock:
+                self._refreshing = False
+        LOG.exit('_ServiceDiscovery._run_refresh', NO_CLIENT_ID, None)
+
+    def stop(self):
+        """
+        Stops refreshing the service list in the background, until the
+        service function is next called
+        """
+        LOG.entry('_ServiceDiscovery.stop', NO_CLIENT_ID)
+        with self._lock:
+            self._stopped = True
+            if self._refresh_timer:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        LOG.exit('_ServiceDiscovery.stop', NO_CLIENT_ID, None)
+
+
+def _merge_services(lists):
+    """
+    Merges the service lists returned by a number of sources into one,
+    ranking the services listed by the most sources first. Services listed
+    by the same number of sources keep the order they were first listed in.
+    A source may return a single service rather than a list.
+    """
+    counts = {}
+    order = []
+    for service_list in lists:
+        if isinstance(service_list, (str, unicode)):
+            service_list = [service_list]
+        for service in service_list:
+            if service not in counts:
+                counts[service] = 0
+                order.append(service)
+            counts[service] += 1
+    return sorted(order, key=lambda service: -counts[service])
+
+
+def _is_discovery_url(service):
+    """
+    Returns True if service is an http(s) or file URL to fetch the service
+    list from
+    """
+    return isinstance(service, (str, unicode)) and \
+        urlparse(service).scheme in ('http', 'https', 'file')
+
+
+def _get_service_function(services):
+    """
+    Function to take a list of HTTP(S) and FILE URLs and return a service
+    function that fetches the service list from all of them at once.
+    """
+    LOG.entry('_get_service_function', NO_CLIENT_ID)
+    LOG.parms(NO_CLIENT_ID, 'services:', services)
+    sources = []
+    for service in services:
+        service_url = urlparse(service)
+        if service_url.scheme == 'file':
+            if (service_url.hostname and
+                    service_url.hostname != 'localhost'):
+                error = InvalidArgumentError(
+                    'service contains unsupported file URI of {0}'
+                    ', only file:///path or file://localhost/path are '
+                    ' supported.'.format(service))
+                LOG.error('_get_service_function', NO_CLIENT_ID, error)
+                raise error
+            file_path = service_url.path
+            # Special case for windows drive letters in file URIS, trim the
+            # leading /
+            if os.name == 'nt' and re.match(r'^\/[a-zA-Z]:\/', file_path):
+                file_path = file_path[1:]
+            sources.append(_FileServiceSource(file_path))
+        else:
+            sources.append(_HTTPServiceSource(service, service_url))
+    service_function = _ServiceDiscovery(sources)
+    LOG.exit('_get_service_function', NO_CLIENT_ID, service_function)
+    return service_function
@@ -0,0 +1,154 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Parallel dispatch of received messages that keeps messages with the same key
+in order
+"""
+from __future__ import absolute_import
+import threading
+import time
+import Queue
+from .exceptions import RangeError, StoppedError
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+# Placed on a partition queue to stop its thread
+_STOP = object()
+
+
+class KeyedDispatcher(object):
+
+    """
+    Runs the on_message function of a subscription on a pool of threads.
+    Each message is given a key by calling ``key_func(topic, data)``, and
+    messages with the same key are always handled by the same thread, in the
+    order they were received, while messages with different keys can be
+    handled at the same time. For example, to keep the messages for each
+    account in order::
+
+        dispatcher = KeyedDispatcher(lambda topic, data: topic, workers=8)
+        client.subscribe('accounts/+', options={'dispatcher': dispatcher},
+                         on_message=handle_account)
+
+    A message that is automatically confirmed is only settled once
+    on_message returns for it, so the link credit of the subscription is
+    only replenished as the threads work through their messages.
+
+    A KeyedDispatcher can be shared by several subscriptions. Its threads are
+    started when it is created, and keep running until stop() is called.
+    """
+
+    def __init__(self, key_func, workers=4):
+        """
+        Creates a KeyedDispatcher.
+
+        :param key_func: function returning the key of a message. This
+            function prototype must be ``func(topic, data)`` where ``topic``
+            is the topic the message was sent to and ``data`` is its body.
+            The key must be hashable.
+        :param workers: the number of threads to dispatch messages on.
+        :raises TypeError: if key_func is not a function.
+        :raises RangeError: if workers is not a positive integer number.
+        """
+        LOG.entry('KeyedDispatcher.constructor', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'key_func:', key_func)
+        LOG.parms(NO_CLIENT_ID, 'workers:', workers)
+        if not hasattr(key_func, '__call__'):
+            raise TypeError('key_func must be a function')
+        try:
+            workers = int(workers)
+            if workers <= 0:
+                raise TypeError()
+        except Exception:
+            raise RangeError(
+                'workers value {0} is invalid must be a positive integer '
+                'number'.format(workers))
+        self._key_func = key_func
+        self._queues = [Queue.Queue() for _ in range(workers)]
+        self._stopped = False
+        self._threads = []
+        for index, queue in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(queue,),
+                name='mqlight-dispatch-{0}'.format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        LOG.exit('KeyedDispatcher.constructor', NO_CLIENT_ID, None)
+
+    @staticmethod
+    def _run(queue):
+        """
+        The body of a dispatch thread, which calls the functions placed on
+        its partition queue in turn
+        """
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception as err:
+                # The client reports errors from on_message itself, so this
+                # should only happen if the client has gone away
+                LOG.error('KeyedDispatcher._run', NO_CLIENT_ID, err)
+
+    def dispatch(self, topic, data, func, args):
+        """
+        Calls func(*args) on the thread for the key of the message
+        """
+        LOG.entry_often('KeyedDispatcher.dispatch', NO_CLIENT_ID)
+        if self._stopped:
+            raise StoppedError('dispatcher is stopped')
+        key = self._key_func(topic, data)
+        queue = self._queues[hash(key) % len(self._queues)]
+        queue.put((func, args))
+        LOG.exit_often('KeyedDispatcher.dispatch', NO_CLIENT_ID, None)
+
+    def pending(self):
+        """
+        Returns a list holding the number of messages waiting to be handled
+        by each thread
+        """
+        return [queue.qsize() for queue in self._queues]
+
+    def stop(self, timeout=None):
+        """Stops the dispatcher once its threads have handled the messages
+        already dispatched to them. Messages received by a subscription using
+        the dispatcher after it has been stopped cause an error to be
+        reported by the client.
+
+        :param timeout: (optional) the time, in seconds, to wait for the
+            threads to finish.
+        :returns: True if all of the threads have finished.
+        """
+        LOG.entry('KeyedDispatcher.stop', NO_CLIENT_ID)
+        self._stopped = True
+        for queue in self._queues:
+            queue.put(_STOP)
+        current = threading.current_thread()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            if thread is not current:
+                thread.join(None if deadline is None else
+                            max(deadline - time.time(), 0))
+        finished = not any(thread.is_alive() for thread in self._threads
+                           if thread is not current)
+        LOG.exit('KeyedDispatcher.stop', NO_CLIENT_ID, finished)
+        return finished
@@ -0,0 +1,95 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Instrumentation hooks that an application can attach to points on the paths
+that messages take through a client
+"""
+from __future__ import absolute_import
+import time
+import timeit
+from .logging import get_logger
+
+LOG = get_logger(__name__)
+
+# A send has been queued to be processed
+SEND_ENQUEUED = 'send_enqueued'
+# A message has been put into proton
+PUT = 'put'
+# Bytes have been written to the network
+WRITTEN = 'written'
+# The outcome of a send has been received from the MQ Light service
+DISPOSITION = 'disposition'
+# Bytes received from the network have been pushed into proton
+CHUNK_PUSHED = 'chunk_pushed'
+# A received message is about to be passed to its on_message function
+MESSAGE_DISPATCHED = 'message_dispatched'
+# The on_message function has returned
+HANDLER_RETURNED = 'handler_returned'
+
+HOOK_POINTS = (
+    SEND_ENQUEUED,
+    PUT,
+    WRITTEN,
+    DISPOSITION,
+    CHUNK_PUSHED,
+    MESSAGE_DISPATCHED,
+    HANDLER_RETURNED
+)
+
+# The highest resolution clock available, for timing the gaps between hook
+# points rather than telling the time of day
+now = getattr(time, 'perf_counter', None) or timeit.default_timer
+
+
+def add_hook(hooks, point, func):
+    """
+    Adds func to the hooks for point. The lists of hooks are replaced rather
+    than changed, so that they can be called without a lock.
+    """
+    hooks[point] = hooks.get(point, []) + [func]
+
+
+def remove_hook(hooks, point, func):
+    """
+    Removes func from the hooks for point, returning False if it was not
+    there. point is removed from hooks once it has no hooks left.
+    """
+    funcs = hooks.get(point, [])
+    if func not in funcs:
+        return False
+    funcs = list(funcs)
+    funcs.remove(func)
+    if funcs:
+        hooks[point] = funcs
+    else:
+        hooks.pop(point, None)
+    return True
+
+
+def call_hooks(hooks, point, client_id, details):
+    """
+    Calls the hooks for point, passing the time, client id and details.
+    Errors raised by the hooks are logged and otherwise ignored, so that a
+    faulty hook cannot disrupt the client.
+    """
+    funcs = hooks.get(point)
+    if funcs:
+        timestamp = now()
+        for func in funcs:
+            try:
+                func(point, timestamp, client_id, details)
+            except Exception as err:
+                LOG.error('call_hooks', client_id, err)
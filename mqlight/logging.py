@@ -14,6 +14,7 @@
 # IBM Corp.
 # </copyright>
 from __future__ import absolute_import
+import atexit
 import logging
 import logging.handlers
 import os
@@ -23,6 +24,11 @@ import socket
 import platform
 import threading
 import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from . import trace
 
 ENTRY_IND = '>-----------------------------------------------------------'
 EXIT_IND = '<-----------------------------------------------------------'
@@ -85,16 +91,193 @@ DEFAULT_STREAM = 'stderr'
 # MQLIGHT_PYTHON_LOG_SIZE to a different number.
 DEFAULT_LOG_SIZE = 10 * 1000 * 1000
 
+# Set whether log entries are written by a background thread. By default they
+# are written by the thread that logs them, but setting the environment
+# variable MQLIGHT_PYTHON_LOG_ASYNC to any value hands them to a background
+# writer instead, so that tracing does not hold up message processing.
+# Entries are dropped, and counted, if more than MQLIGHT_PYTHON_LOG_QUEUE_SIZE
+# (by default 10000) are waiting to be written.
+DEFAULT_QUEUE_SIZE = 10000
+
+# The most log entries the background writer writes before flushing
+ASYNC_BATCH_SIZE = 500
+
 DEFAULT_STACK = ['<stack unwind error>']
 NO_CLIENT_ID = '*'
 IS_WIN = os.name == 'nt'
-LOCK = threading.Lock()
+
+# The call stack traced by each thread, shared by every logger so that the
+# log is indented by how deep the thread is in calls across modules
+_STACKS = threading.local()
+
+
+def _get_stack():
+    """
+    Returns the call stack traced by the current thread
+    """
+    try:
+        return _STACKS.stack
+    except AttributeError:
+        stack = _STACKS.stack = list(DEFAULT_STACK)
+        return stack
 
 
 def get_logger(name):
     return MQLightLog(name)
 
 
+class _AsyncWriter(object):
+
+    """
+    Writes log entries to their handlers on a background thread. Entries
+    are queued up to a bounded size, and any more are dropped and counted.
+    The writer takes every entry that is waiting at once, writing them with
+    a single flush of each handler.
+    """
+
+    def __init__(self, size):
+        self._queue = queue.Queue(size)
+        self.dropped = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='mqlight-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, handlers, record):
+        """
+        Queues a log entry to be written to handlers, dropping it if the
+        queue is full
+        """
+        try:
+            self._queue.put_nowait((handlers, record))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self, timeout=None):
+        """
+        Waits until every log entry queued so far has been written, or for
+        no more than timeout seconds
+        """
+        done = threading.Event()
+        try:
+            self._queue.put((None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def _run(self):
+        """
+        The body of the writer thread
+        """
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < ASYNC_BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, batch):
+        """
+        Writes a batch of log entries, then flushes the handlers written to
+        """
+        written = []
+        flushes = []
+        with self._lock:
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+        for handlers, record in batch:
+            if handlers is None:
+                # A flush() is waiting for the entries before this one
+                flushes.append(record)
+                continue
+            if dropped:
+                # Report entries dropped since the last batch, in the log
+                # they were bound for
+                notice = logging.makeLogRecord(record.__dict__)
+                notice.msg = '{0} log entries dropped'.format(dropped)
+                notice.args = None
+                self._emit(handlers, notice, written)
+                dropped = 0
+            self._emit(handlers, record, written)
+        for handler in written:
+            try:
+                handler.flush()
+            except Exception:
+                pass
+        for done in flushes:
+            done.set()
+
+    @staticmethod
+    def _emit(handlers, record, written):
+        """
+        Writes a log entry to handlers, without flushing them
+        """
+        for handler in handlers:
+            handler.acquire()
+            try:
+                if isinstance(
+                        handler,
+                        logging.handlers.RotatingFileHandler) and \
+                        handler.shouldRollover(record):
+                    handler.doRollover()
+                handler.stream.write(handler.format(record) + '\n')
+            except Exception:
+                handler.handleError(record)
+            finally:
+                handler.release()
+            if handler not in written:
+                written.append(handler)
+
+
+class _AsyncHandler(logging.Handler):
+
+    """
+    Hands log entries to the background writer, to be written to a set of
+    target handlers
+    """
+
+    def __init__(self, writer, targets):
+        logging.Handler.__init__(self)
+        self._writer = writer
+        self.targets = targets
+
+    def emit(self, record):
+        self._writer.put(self.targets, record)
+
+    def createLock(self):
+        # Entries are only queued here, so do not need to be serialised
+        self.lock = None
+
+
+# The background writer for the process, created when first needed
+_ASYNC_WRITER = [None]
+_ASYNC_WRITER_LOCK = threading.Lock()
+
+
+def _get_async_writer():
+    """
+    Returns the background log writer, creating it when first needed
+    """
+    with _ASYNC_WRITER_LOCK:
+        if _ASYNC_WRITER[0] is None:
+            try:
+                size = int(os.getenv(
+                    'MQLIGHT_PYTHON_LOG_QUEUE_SIZE',
+                    DEFAULT_QUEUE_SIZE))
+            except ValueError:
+                size = DEFAULT_QUEUE_SIZE
+            _ASYNC_WRITER[0] = _AsyncWriter(size)
+            # Write out whatever is queued when the process exits
+            atexit.register(_ASYNC_WRITER[0].flush, 5)
+        return _ASYNC_WRITER[0]
+
+
 class MQLightLog(object):
 
     """
@@ -108,7 +291,6 @@ class MQLightLog(object):
         if self._level is None:
             self._level = FFDC
         self._ffdc_sequence = 0
-        self._stack = DEFAULT_STACK
 
         # File Handler
         self._fd = None
@@ -116,6 +298,10 @@ class MQLightLog(object):
         self._fe = None
         # stdout Handler
         self._fo = None
+        # Background writer Handler, which writes to the handlers above
+        self._fa = None
+        if os.getenv('MQLIGHT_PYTHON_LOG_ASYNC'):
+            self._fa = _AsyncHandler(_get_async_writer(), [])
 
         if os.getenv('MQLIGHT_PYTHON_NO_HANDLER') is None:
             # Set up a signal handler that will cause an ffdc to be generated
@@ -132,8 +318,8 @@ class MQLightLog(object):
         self._log_size = os.getenv('MQLIGHT_PYTHON_LOG_SIZE', DEFAULT_LOG_SIZE)
         self._stream = os.getenv('MQLIGHT_PYTHON_LOG_STREAM', DEFAULT_STREAM)
         formatter = logging.Formatter(
-            '%(asctime)s [%(process)s] - %(name)s - %(client_id)s - ' +
-            '%(lvl)s %(message)s')
+            '%(asctime)s [%(process)s:%(threadName)s] - %(name)s - ' +
+            '%(client_id)s - %(lvl)s %(message)s')
 
         self._set_handler(self._stream, self._log_size, formatter)
 
@@ -205,11 +391,28 @@ class MQLightLog(object):
             self._log.addHandler(self._fd)
             self._log.addHandler(self._fe)
 
+        if self._fa:
+            # Move the handlers behind the background writer
+            self._fa.targets = [
+                handler for handler in (self._fd, self._fe, self._fo)
+                if handler]
+            for handler in self._fa.targets:
+                self._log.removeHandler(handler)
+            if self._fa not in self._log.handlers:
+                self._log.addHandler(self._fa)
+
     def _write(self, level, message, extra):
         if self._level <= level:
             extra['lvl'] = LEVELS.get(level)
             self._log.log(level, message, extra=extra)
 
+    def is_enabled(self, level):
+        """
+        Returns True if entries at level are being logged. Callers can use
+        this to skip working out values that are only needed for the log.
+        """
+        return self._level <= level
+
     def set_level(self, level):
         self._log.setLevel(level)
 
@@ -223,11 +426,15 @@ class MQLightLog(object):
         self._entry_level(ENTRY_OFTEN, name, client_id)
 
     def _entry_level(self, level, name, client_id):
-        with LOCK:
-            msg = '{0} {1}'.format(ENTRY_IND[0:len(self._stack)], name)
-            keys = {'client_id': client_id}
-            self._write(level, msg, keys)
-            self._stack.append(name)
+        # The call stack is only tracked while entries are being logged, as
+        # it is only used to indent the log
+        if self._level > level:
+            return
+        stack = _get_stack()
+        msg = '{0} {1}'.format(ENTRY_IND[0:len(stack)], name)
+        keys = {'client_id': client_id}
+        self._write(level, msg, keys)
+        stack.append(name)
 
     def exit(self, name, client_id, return_code):
         self._exit_level(EXIT, name, client_id, return_code)
@@ -236,25 +443,24 @@ class MQLightLog(object):
         self._exit_level(EXIT_OFTEN, name, client_id, return_code)
 
     def _exit_level(self, level, name, client_id, return_code):
-        with LOCK:
-            msg = '{0} {1} rc={2}'.format(
-                EXIT_IND[0:len(self._stack) - 1], name, return_code)
-            keys = {'client_id': client_id}
-            self._write(level, msg, keys)
-            last = self._stack[len(self._stack) - 1]
-            if last == name:
-                self._stack.pop()
-            else:
-                # Due to asynchronous calls, the call stack might not be in the
-                # exact order so we try to pop the last matching call
-                if name in self._stack:
-                    self._stack.reverse()
-                    self._stack.remove(name)
-                    self._stack.reverse()
-                else:
-                    # Unable to find the entry call in the stack,
-                    # Generate an FFDC
-                    self.ffdc('MQLightLog._exit_level', 10, None, name)
+        if self._level > level:
+            return
+        stack = _get_stack()
+        msg = '{0} {1} rc={2}'.format(
+            EXIT_IND[0:len(stack) - 1], name, return_code)
+        keys = {'client_id': client_id}
+        self._write(level, msg, keys)
+        if stack[-1] == name:
+            stack.pop()
+        else:
+            # Calls above this one on the stack were left by an exception
+            # without logging their exit, so are popped with it
+            for index in range(len(stack) - 1, 0, -1):
+                if stack[index] == name:
+                    del stack[index:]
+                    break
+            # Otherwise the entry call was made before the level was
+            # raised, so was never added to the stack
 
     def ffdc(self, name, probe_id, client_id, data):
         opts = {
@@ -299,34 +505,58 @@ class MQLightLog(object):
         self._write(FFDC, HEADER_BANNER, keys)
         self._write(FFDC,
                     'Data:             {0}'.format(data), keys)
+        # Write out what the client has recently done
+        try:
+            trace_path = trace.dump()
+        except Exception as exc:
+            trace_path = 'not written: {0}'.format(exc)
+        if trace_path:
+            self._write(FFDC,
+                        'Trace:            {0}'.format(trace_path), keys)
         self._write(FFDC, HEADER_BANNER, keys)
         self._write(FFDC, 'Call Stack:', keys)
         for call in traceback.format_stack():
             self._write(FFDC, call.strip(), keys)
         self._write(FFDC, HEADER_BANNER, keys)
-
-    def debug(self, client_id, message):
-        keys = {'client_id': client_id}
-        self._write(DEBUG, message, keys)
+        if self._fa:
+            # Make sure the FFDC is written out, in case the process is about
+            # to end
+            _get_async_writer().flush(5)
+
+    # The arguments passed to the methods below are only formatted once the
+    # level has been checked, so callers should pass values to be logged as
+    # separate arguments rather than formatting them first
+
+    def debug(self, client_id, message, *args):
+        if self._level <= DEBUG:
+            if args:
+                message = message.format(*args)
+            keys = {'client_id': client_id}
+            self._write(DEBUG, message, keys)
 
     def parms(self, client_id, *args):
-        msg = ' '.join(['{0}'.format(arg) for arg in args])
-        keys = {'client_id': client_id}
-        self._write(PARMS, msg, keys)
+        if self._level <= PARMS:
+            msg = ' '.join(['{0}'.format(arg) for arg in args])
+            keys = {'client_id': client_id}
+            self._write(PARMS, msg, keys)
 
     def data(self, client_id, *args):
-        msg = ' '.join(['{0}'.format(arg) for arg in args])
-        keys = {'client_id': client_id}
-        self._write(DATA, msg, keys)
+        if self._level <= DATA:
+            msg = ' '.join(['{0}'.format(arg) for arg in args])
+            keys = {'client_id': client_id}
+            self._write(DATA, msg, keys)
 
     def state(self, name, client_id, event, *args):
-        msg = 'Client state changed to "{0}" by {1} '.format(event, name)
-        msg += ' '.join(['{0}'.format(arg) for arg in args])
-        keys = {'client_id': client_id}
-        self._write(STATE, msg, keys)
+        if self._level <= STATE:
+            msg = 'Client state changed to "{0}" by {1} '.format(event, name)
+            msg += ' '.join(['{0}'.format(arg) for arg in args])
+            keys = {'client_id': client_id}
+            self._write(STATE, msg, keys)
 
     def error(self, name, client_id, err):
-        msg = 'Error {0} raised by {1}: {2} '.format(
-            type(err).__name__, name, err)
-        keys = {'client_id': client_id}
-        self._write(ERROR, msg, keys)
+        trace.record(trace.ERROR, client_id)
+        if self._level <= ERROR:
+            msg = 'Error {0} raised by {1}: {2} '.format(
+                type(err).__name__, name, err)
+            keys = {'client_id': client_id}
+            self._write(ERROR, msg, keys)
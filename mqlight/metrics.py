@@ -0,0 +1,617 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Counters, gauges and histograms describing what a client is doing, and
+exporters that write them out periodically
+"""
+from __future__ import absolute_import
+import bisect
+import json
+import os
+import threading
+import time
+import BaseHTTPServer
+from .exceptions import RangeError
+from .logging import get_logger, NO_CLIENT_ID
+from .timer import call_later
+
+LOG = get_logger(__name__)
+
+# The default upper bounds of the buckets of a Histogram
+DEFAULT_BUCKETS = (
+    64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# The label value that a HistogramSet records values under once it holds
+# its maximum number of histograms
+OTHER_KEY = '_other'
+
+
+class Counter(object):
+
+    """
+    A value that only goes up, such as the number of messages sent
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """
+        Adds amount to the counter
+        """
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        """
+        Returns the value of the counter
+        """
+        return self._value
+
+
+class Gauge(object):
+
+    """
+    A value that can go up and down. The value is either set, or read from a
+    function when the gauge is read, which costs nothing until then. The
+    function can return a number, or a dictionary of numbers keyed by the
+    value of the gauge's label, such as the credit of each subscription.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, description, func=None, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._func = func
+        self._value = 0
+
+    def set(self, value):
+        """
+        Sets the value of the gauge
+        """
+        self._value = value
+
+    def value(self):
+        """
+        Returns the value of the gauge
+        """
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+
+class Histogram(object):
+
+    """
+    Counts values, such as message sizes, into buckets with fixed upper
+    bounds, along with their number and sum
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        if not buckets or list(buckets) != sorted(buckets):
+            raise RangeError('buckets must be a list of increasing bounds')
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # the last count is for values above every bucket
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        Counts a value into its bucket
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+
+    def value(self):
+        """
+        Returns a dictionary holding the ``count`` and ``sum`` of the values
+        observed, and the cumulative count of values in each of the
+        ``buckets``, as a list of (upper bound, count) pairs ending with
+        ('+Inf', count)
+        """
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+        cumulative = []
+        running = 0
+        for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+            running += bucket
+            cumulative.append((bound, running))
+        return {'count': count, 'sum': total, 'buckets': cumulative}
+
+
+class LogLinearHistogram(object):
+
+    """
+    Records values, such as latencies in seconds, so that their percentiles
+    can be reported. Values are scaled to integers (microseconds, by
+    default) and counted into buckets that are linear within each power of
+    two, in the style of an HDR histogram. With the default 16 buckets per
+    power of two, a percentile is reported to within about 6%, and however
+    many values are recorded no more than a few hundred buckets are kept.
+    """
+    kind = 'summary'
+
+    # The percentiles reported by value()
+    PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+    def __init__(self, name, description, sub_bucket_bits=4, scale=1e6):
+        self.name = name
+        self.description = description
+        self._bits = sub_bucket_bits
+        self._sub = 1 << sub_bucket_bits
+        self._scale = scale
+        self._counts = {}
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+        self._lock = threading.Lock()
+
+    def _index(self, scaled):
+        """
+        Returns the index of the bucket for a scaled value
+        """
+        if scaled < 2 * self._sub:
+            return scaled
+        shift = scaled.bit_length() - self._bits - 1
+        return (shift + 1) * self._sub + (scaled >> shift) - self._sub
+
+    def _bounds(self, index):
+        """
+        Returns the lowest scaled value in a bucket, and the bucket's width
+        """
+        if index < 2 * self._sub:
+            return index, 1
+        shift = index // self._sub - 1
+        return (index % self._sub + self._sub) << shift, 1 << shift
+
+    def observe(self, value):
+        """
+        Records a value. Negative values are recorded as 0.
+        """
+        value = max(value, 0)
+        index = self._index(int(value * self._scale))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self._count += 1
+            self._sum += value
+            if self._min is None or value < self._min:
+                self._min = value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def percentile(self, fraction):
+        """
+        Returns the value that fraction of the recorded values are no more
+        than, or None if no values have been recorded
+        """
+        with self._lock:
+            counts = sorted(self._counts.items())
+            count = self._count
+            maximum = self._max
+        return self._percentile(counts, count, maximum, fraction)
+
+    def _percentile(self, counts, count, maximum, fraction):
+        """
+        Returns a percentile from a sorted list of bucket counts
+        """
+        if not count:
+            return None
+        rank = max(int(round(fraction * count)), 1)
+        running = 0
+        for index, bucket in counts:
+            running += bucket
+            if running >= rank:
+                lowest, width = self._bounds(index)
+                # Report the middle of the bucket, but never more than the
+                # largest value recorded
+                return min((lowest + width / 2.0) / self._scale, maximum)
+        return maximum
+
+    def value(self):
+        """
+        Returns a dictionary holding the ``count``, ``sum``, ``min`` and
+        ``max`` of the values recorded, and the ``p50``, ``p90``, ``p99`` and
+        ``p999`` percentiles
+        """
+        with self._lock:
+            counts = sorted(self._counts.items())
+            result = {'count': self._count, 'sum': self._sum,
+                      'min': self._min, 'max': self._max}
+        for key, fraction in self.PERCENTILES:
+            result[key] = self._percentile(
+                counts, result['count'], result['max'], fraction)
+        return result
+
+
+class HistogramSet(object):
+
+    """
+    A LogLinearHistogram for each value of a label, such as the topic
+    pattern of a subscription, created when the label value is first seen.
+    If max_keys is set, values for label values seen once that many
+    histograms are held are recorded together under OTHER_KEY.
+    """
+    kind = 'summary'
+
+    def __init__(self, name, description, label, max_keys=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._max_keys = max_keys
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, key):
+        """
+        Returns the histogram for a label value
+        """
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                if self._max_keys is not None and \
+                        key not in self._histograms and \
+                        len(self._histograms) >= self._max_keys:
+                    key = OTHER_KEY
+                histogram = self._histograms.setdefault(
+                    key, LogLinearHistogram(self.name, self.description))
+        return histogram
+
+    def observe(self, key, value):
+        """
+        Records a value in the histogram for a label value
+        """
+        self.histogram(key).observe(value)
+
+    def value(self):
+        """
+        Returns the value of each histogram, keyed by label value
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return dict((key, histogram.value()) for key, histogram in histograms)
+
+
+class MetricsRegistry(object):
+
+    """
+    The metrics of a client, keyed by name
+    """
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self._metrics = []
+
+    def _add(self, metric):
+        """
+        Adds a metric to the registry, returning it
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        """
+        Adds and returns a Counter
+        """
+        return self._add(Counter(name, description))
+
+    def gauge(self, name, description, func=None, label=None):
+        """
+        Adds and returns a Gauge
+        """
+        return self._add(Gauge(name, description, func, label))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        """
+        Adds and returns a Histogram
+        """
+        return self._add(Histogram(name, description, buckets))
+
+    def log_linear_histogram(self, name, description):
+        """
+        Adds and returns a LogLinearHistogram
+        """
+        return self._add(LogLinearHistogram(name, description))
+
+    def histogram_set(self, name, description, label, max_keys=None):
+        """
+        Adds and returns a HistogramSet
+        """
+        return self._add(HistogramSet(name, description, label, max_keys))
+
+    def metrics(self):
+        """
+        Returns the metrics in the registry
+        """
+        return list(self._metrics)
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the current value of each metric, keyed by
+        name
+        """
+        values = {}
+        for metric in self._metrics:
+            try:
+                values[metric.name] = metric.value()
+            except Exception as exc:
+                LOG.data(self.client_id, 'cannot read', metric.name, exc)
+        return values
+
+
+def to_json(registries):
+    """
+    Returns a line of JSON holding the metrics of each registry, keyed by
+    client id, along with a timestamp
+    """
+    return json.dumps({
+        'timestamp': time.time(),
+        'clients': dict(
+            (registry.client_id, registry.snapshot())
+            for registry in registries)
+    }, sort_keys=True)
+
+
+def _escape(value):
+    """
+    Escapes a label value for the Prometheus text format
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _summary_lines(lines, name, labels, value):
+    """
+    Adds the lines for a LogLinearHistogram to lines, in the Prometheus text
+    format
+    """
+    for key, fraction in LogLinearHistogram.PERCENTILES:
+        if value[key] is not None:
+            lines.append('{0}{{{1},quantile="{2}"}} {3}'.format(
+                name, labels, fraction, value[key]))
+    lines.append('{0}_sum{{{1}}} {2}'.format(name, labels, value['sum']))
+    lines.append('{0}_count{{{1}}} {2}'.format(name, labels, value['count']))
+
+
+def to_prometheus(registries, prefix='mqlight_'):
+    """
+    Returns the metrics of each registry in the Prometheus text exposition
+    format, labelled with the client id
+    """
+    # Each metric is written once for every client, with all of the lines
+    # for the metric together
+    families = []
+    samples = {}
+    for registry in registries:
+        client = 'client_id="{0}"'.format(_escape(registry.client_id))
+        snapshot = registry.snapshot()
+        for metric in registry.metrics():
+            if metric.name not in snapshot:
+                continue
+            if metric.name not in samples:
+                families.append(metric)
+                samples[metric.name] = []
+            samples[metric.name].append((client, snapshot[metric.name]))
+
+    lines = []
+    for metric in families:
+        name = prefix + metric.name
+        lines.append('# HELP {0} {1}'.format(name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+        for client, value in samples[metric.name]:
+            if metric.kind == 'summary':
+                if getattr(metric, 'label', None):
+                    for key, item in sorted(value.items()):
+                        _summary_lines(
+                            lines, name, '{0},{1}="{2}"'.format(
+                                client, metric.label, _escape(key)), item)
+                else:
+                    _summary_lines(lines, name, client, value)
+            elif metric.kind == 'histogram':
+                for bound, count in value['buckets']:
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        name, client, bound, count))
+                lines.append('{0}_sum{{{1}}} {2}'.format(
+                    name, client, value['sum']))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    name, client, value['count']))
+            elif isinstance(value, dict):
+                for key, item in sorted(value.items()):
+                    lines.append('{0}{{{1},{2}="{3}"}} {4}'.format(
+                        name, client, metric.label, _escape(key), item))
+            else:
+                lines.append('{0}{{{1}}} {2}'.format(name, client, value))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter(object):
+
+    """
+    Exports the metrics of a number of clients. Every interval seconds the
+    metrics are appended to a file as a line of JSON or, in the Prometheus
+    text format, written over the file. The Prometheus text can also be
+    served from a local HTTP endpoint, which is read on demand. For
+    example::
+
+        exporter = MetricsExporter([client], path='/var/run/app.prom',
+                                   fmt='prometheus', port=9464)
+        exporter.start()
+    """
+
+    def __init__(self, clients, path=None, fmt='json', interval=10,
+                 port=None, host='127.0.0.1'):
+        """Creates a MetricsExporter.
+
+        :param clients: the clients whose metrics are exported.
+        :param path: (optional) the file to write the metrics to.
+        :param fmt: (optional) ``json`` or ``prometheus``. Defaults to
+            ``json``.
+        :param interval: (optional) how often, in seconds, the metrics are
+            written to the file. Defaults to 10.
+        :param port: (optional) the port to serve the metrics on, in the
+            Prometheus text format, at any path.
+        :param host: (optional) the address to serve the metrics on. Defaults
+            to 127.0.0.1.
+        :raises TypeError: if fmt is not json or prometheus.
+        :raises RangeError: if interval is not a positive number.
+        """
+        LOG.entry('MetricsExporter.constructor', NO_CLIENT_ID)
+        if fmt not in ('json', 'prometheus'):
+            raise TypeError('fmt must be json or prometheus')
+        if not isinstance(interval, (int, long, float)) or interval <= 0:
+            raise RangeError(
+                'interval value {0} is invalid must be a positive '
+                'number'.format(interval))
+        self._clients = list(clients)
+        self._path = path
+        self._format = fmt
+        self._interval = interval
+        self._port = port
+        self._host = host
+        self._timer = None
+        self._server = None
+        self._lock = threading.Lock()
+        LOG.exit('MetricsExporter.constructor', NO_CLIENT_ID, None)
+
+    def _registries(self):
+        """
+        Returns the registries of the clients
+        """
+        return [client._metrics for client in self._clients]
+
+    def render(self, fmt=None):
+        """
+        Returns the metrics of the clients in fmt, by default the format
+        of the exporter
+        """
+        if (fmt or self._format) == 'prometheus':
+            return to_prometheus(self._registries())
+        return to_json(self._registries())
+
+    def start(self):
+        """
+        Starts writing the metrics to the file, and serving them over HTTP
+        """
+        LOG.entry('MetricsExporter.start', NO_CLIENT_ID)
+        with self._lock:
+            if self._port is not None and self._server is None:
+                self._server = _MetricsServer((self._host, self._port), self)
+                server = threading.Thread(
+                    target=self._server.serve_forever,
+                    name='mqlight-metrics')
+                server.daemon = True
+                server.start()
+            if self._path is not None and self._timer is None:
+                self._timer = call_later(self._interval, self._export)
+        LOG.exit('MetricsExporter.start', NO_CLIENT_ID, None)
+
+    def stop(self):
+        """
+        Stops writing and serving the metrics
+        """
+        LOG.entry('MetricsExporter.stop', NO_CLIENT_ID)
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            server = self._server
+            self._server = None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        LOG.exit('MetricsExporter.stop', NO_CLIENT_ID, None)
+
+    def server_port(self):
+        """
+        Returns the port the metrics are served on, or None if they are not
+        being served
+        """
+        server = self._server
+        return server.server_port if server is not None else None
+
+    def export(self):
+        """
+        Writes the metrics to the file now
+        """
+        text = self.render()
+        if self._format == 'json':
+            with open(self._path, 'a') as file_obj:
+                file_obj.write(text + '\n')
+        else:
+            # Replace the file in one step, so that it is never read part
+            # written
+            temp = self._path + '.tmp'
+            with open(temp, 'w') as file_obj:
+                file_obj.write(text)
+            os.rename(temp, self._path)
+
+    def _export(self):
+        """
+        Writes the metrics to the file, and schedules the next write. Runs on
+        the timer thread.
+        """
+        try:
+            self.export()
+        except Exception as exc:
+            LOG.error('MetricsExporter._export', NO_CLIENT_ID, exc)
+        with self._lock:
+            if self._timer is not None:
+                self._timer = call_later(self._interval, self._export)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Serves the metrics in the Prometheus text format
+    """
+
+    def do_GET(self):
+        """handles a GET"""
+        body = self.server.exporter.render('prometheus')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _MetricsServer(BaseHTTPServer.HTTPServer):
+
+    """
+    The HTTP server for a MetricsExporter
+    """
+
+    def __init__(self, address, exporter):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _MetricsHandler)
+        self.exporter = exporter
@@ -14,15 +14,17 @@
 # IBM Corp.
 # </copyright>
 from __future__ import division, absolute_import
+import collections
 import socket
 import ssl
 import select
 import threading
-import Queue
 from . import cproton
 from .exceptions import MQLightError, SecurityError, ReplacedError, \
     NetworkError, InvalidArgumentError, NotPermittedError
 from .logging import get_logger, NO_CLIENT_ID
+from . import hooks
+from . import trace
 try:
     from urlparse import urlunparse
 except ImportError:
@@ -33,20 +35,47 @@ LOG = get_logger(__name__)
 STATUSES = ['UNKNOWN', 'PENDING', 'ACCEPTED', 'REJECTED', 'RELEASED',
             'MODIFIED', 'ABORTED', 'SETTLED']
 
+# The most bytes read from a socket at once
+READ_SIZE = 65536
+
 QOS_AT_MOST_ONCE = 0
 QOS_AT_LEAST_ONCE = 1
 
+# The most Proton messages kept for receiving messages into
+MESSAGE_POOL_SIZE = 256
+
+# Proton messages for receiving messages into, each with the handle to its
+# delivery annotations. A received message's Proton message is returned here
+# once nothing refers to it, so the handle is looked up once for each Proton
+# message rather than once for each message received.
+_MESSAGE_POOL = collections.deque()
+
+
+def _take_message():
+    """
+    Returns a Proton message to receive a message into, and the handle to
+    its delivery annotations
+    """
+    try:
+        return _MESSAGE_POOL.pop()
+    except IndexError:
+        message = cproton.pn_message()
+        return message, cproton.pn_message_instructions(message)
+
 
 class _MQLightMessage(object):
     """
     Wrapper for the Proton Message class
     """
 
-    def __init__(self, message=None):
+    def __init__(self, message=None, instructions=None):
         """
-        MQLight Message constructor
+        MQLight Message constructor. instructions is the handle to the
+        delivery annotations of a message taken from the pool, which the
+        message is returned to once it is no longer used.
         """
         LOG.entry('_MQLightMessage.constructor', NO_CLIENT_ID)
+        self._instructions = instructions
         if message:
             LOG.parms(NO_CLIENT_ID, 'message:', message)
             self._msg = message
@@ -57,9 +86,22 @@ class _MQLightMessage(object):
             self._body = None
         self._tracker = None
         self._link_address = None
+        self._annotations = None
         self.connection_id = None
         LOG.exit('_MQLightMessage.constructor', NO_CLIENT_ID, None)
 
+    def __del__(self):
+        # Nothing else holds the Proton message of a received message, so it
+        # can be cleared and used to receive another
+        try:
+            if self._instructions is not None and \
+                    len(_MESSAGE_POOL) < MESSAGE_POOL_SIZE:
+                cproton.pn_message_clear(self._msg)
+                _MESSAGE_POOL.append((self._msg, self._instructions))
+        except Exception:
+            # The module may already have been torn down at exit
+            pass
+
     def _set_body(self, value):
         """
         Handles body data type and encoding
@@ -106,100 +148,50 @@ class _MQLightMessage(object):
 
     def _get_delivery_annotations(self):
         """
-        Gets the message delivery annotations
+        Gets the message delivery annotations, as a dictionary of key to
+        value. The annotations are decoded the first time they are asked for,
+        and cached on the message.
         """
-        LOG.entry('_MQLightMessage._get_delivery_annotations', NO_CLIENT_ID)
+        if self._annotations is not None:
+            return self._annotations
         # instructions === delivery annotations
-        anno = cproton.pn_message_instructions(self.message)
-
-        # Count the number of delivery annotations that we are interested in
-        # returning
-        lval = cproton.pn_data_next(anno)     # Move to Map
-        elements = 0
-        result = []
-        # Check it actually is a Map
-        if lval and cproton.pn_data_type(anno) == cproton.PN_MAP:
-            if lval:
-                lval = cproton.pn_data_enter(anno)    # Enter the Map
-            if lval:
-                lval = cproton.pn_data_next(anno)     # Position on 1st map key
-            if lval:
-                while True:
-                    if cproton.pn_data_type(anno) == cproton.PN_SYMBOL:
-                        if cproton.pn_data_next(anno):
-                            if cproton.pn_data_type(anno) in (
-                                    cproton.PN_SYMBOL,
-                                    cproton.PN_STRING,
-                                    cproton.PN_INT):
-                                elements += 1
-                            else:
-                                break
-                            if not cproton.pn_data_next(anno):
-                                break
-                        else:
-                            break
-            cproton.pn_data_rewind(anno)
+        anno = self._instructions
+        if anno is None:
+            anno = cproton.pn_message_instructions(self.message)
+
+        # Most messages have no delivery annotations, which a single check of
+        # the size of the data finds without moving through it. A received
+        # message already has the handle to its annotations, so this is its
+        # only call.
+        if not cproton.pn_data_size(anno):
+            self._annotations = {}
+            return self._annotations
 
-            # Return early if there are no (interesting) delivery annotations
-            if elements == 0:
-                LOG.exit(
-                    '_MQLightMessage._get_delivery_annotations',
-                    NO_CLIENT_ID,
-                    result)
-                return result
-
-            cproton.pn_data_next(anno)    # Move to Map
-            cproton.pn_data_enter(anno)   # Enter the Map
-            cproton.pn_data_next(anno)    # Position on first map key
-
-            # Build an array of objects, where each object has the following
-            # four properties:
-            #   key        : the key of the delivery annotation entry
-            #   key_type   : the type of the delivery annotation key (always
-            #   'symbol')
-            #   value      : the value of the delivery annotation entry
-            #   value_type : the type of the delivery annotation value
-            #   ('symbol' ,'string', or 'int32')
-            while True:
+        LOG.entry('_MQLightMessage._get_delivery_annotations', NO_CLIENT_ID)
+        result = {}
+        # Check the annotations actually are a Map, and collect the entries
+        # that have a symbol key and a symbol, string or int32 value
+        if cproton.pn_data_next(anno) and \
+                cproton.pn_data_type(anno) == cproton.PN_MAP and \
+                cproton.pn_data_enter(anno):
+            while cproton.pn_data_next(anno):   # Position on the next key
+                key = None
                 if cproton.pn_data_type(anno) == cproton.PN_SYMBOL:
-                    key = cproton.pn_data_get_symbol(anno).start
-
-                    if cproton.pn_data_next(anno):
-                        value = None
-                        value_type = None
-                        data_type = cproton.pn_data_type(anno)
-                        add_entry = False
-
-                        if data_type == cproton.PN_SYMBOL:
-                            add_entry = True
-                            value_type = 'symbol'
-                            value = cproton.pn_data_get_symbol(anno).start
-                        elif data_type == cproton.PN_STRING:
-                            add_entry = True
-                            value_type = 'string'
-                            value = cproton.pn_data_get_string(anno).start
-                        elif data_type == cproton.PN_INT:
-                            add_entry = True
-                            value_type = 'int32'
-                            value = cproton.pn_data_get_atom(anno).u.as_int
-
-                        if add_entry:
-                            # e.g. { 'key': 'xopt-blah', 'key_type': 'symbol',
-                            # 'value': 'blahblah', 'value_type': 'string' }
-                            item = {
-                                'key': key,
-                                'key_type': 'symbol',
-                                'value': value,
-                                'value_type': value_type
-                            }
-                            result.append(item)
-
-                        if not cproton.pn_data_next(anno):
-                            break
-                    else:
-                        break
-
-                cproton.pn_data_rewind(anno)
+                    key = cproton.pn_data_get_symbol(anno)
+                if not cproton.pn_data_next(anno):  # Position on the value
+                    break
+                if key is None:
+                    continue
+                data_type = cproton.pn_data_type(anno)
+                if data_type == cproton.PN_SYMBOL:
+                    result[key] = cproton.pn_data_get_symbol(anno)
+                elif data_type == cproton.PN_STRING:
+                    result[key] = cproton.pn_data_get_string(
+                        anno).decode('utf8')
+                elif data_type == cproton.PN_INT:
+                    result[key] = cproton.pn_data_get_int(anno)
+            cproton.pn_data_rewind(anno)
+        self._annotations = result
         LOG.exit(
             '_MQLightMessage._get_delivery_annotations',
             NO_CLIENT_ID,
@@ -208,6 +200,99 @@ class _MQLightMessage(object):
 
     annotations = property(_get_delivery_annotations)
 
+    def _get_properties(self):
+        """
+        Gets the message application properties, as a dictionary of key to
+        value. Entries with a string key and a string, integer, floating point
+        or boolean value are returned.
+        """
+        LOG.entry('_MQLightMessage._get_properties', NO_CLIENT_ID)
+        result = {}
+        props = cproton.pn_message_properties(self.message)
+        if cproton.pn_data_next(props) and \
+                cproton.pn_data_type(props) == cproton.PN_MAP and \
+                cproton.pn_data_enter(props):
+            while cproton.pn_data_next(props):   # Position on the next key
+                key = None
+                if cproton.pn_data_type(props) == cproton.PN_STRING:
+                    key = cproton.pn_data_get_string(props).decode('utf8')
+                if not cproton.pn_data_next(props):  # Position on the value
+                    break
+                if key is None:
+                    continue
+                data_type = cproton.pn_data_type(props)
+                if data_type == cproton.PN_STRING:
+                    result[key] = cproton.pn_data_get_string(
+                        props).decode('utf8')
+                elif data_type == cproton.PN_LONG:
+                    result[key] = cproton.pn_data_get_long(props)
+                elif data_type == cproton.PN_INT:
+                    result[key] = cproton.pn_data_get_int(props)
+                elif data_type == cproton.PN_DOUBLE:
+                    result[key] = cproton.pn_data_get_double(props)
+                elif data_type == cproton.PN_BOOL:
+                    result[key] = cproton.pn_data_get_bool(props)
+            cproton.pn_data_rewind(props)
+        LOG.exit('_MQLightMessage._get_properties', NO_CLIENT_ID, result)
+        return result
+
+    def _set_properties(self, properties):
+        """
+        Sets the message application properties from a dictionary of string
+        keys to string, integer, floating point or boolean values
+        """
+        LOG.entry('_MQLightMessage._set_properties', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'properties:', properties)
+        props = cproton.pn_message_properties(self.message)
+        cproton.pn_data_clear(props)
+        cproton.pn_data_put_map(props)
+        cproton.pn_data_enter(props)
+        for key, value in properties.items():
+            cproton.pn_data_put_string(props, str(key))
+            if isinstance(value, bool):
+                cproton.pn_data_put_bool(props, value)
+            elif isinstance(value, (int, long)):
+                cproton.pn_data_put_long(props, value)
+            elif isinstance(value, float):
+                cproton.pn_data_put_double(props, value)
+            else:
+                cproton.pn_data_put_string(props, str(value))
+        cproton.pn_data_exit(props)
+        cproton.pn_data_rewind(props)
+        LOG.exit('_MQLightMessage._set_properties', NO_CLIENT_ID, None)
+
+    properties = property(_get_properties, _set_properties)
+
+    def _get_message_id(self):
+        """
+        Gets the message id, or None if the message does not have one
+        """
+        data = cproton.pn_message_id(self.message)
+        result = None
+        if cproton.pn_data_next(data):
+            data_type = cproton.pn_data_type(data)
+            if data_type == cproton.PN_STRING:
+                result = cproton.pn_data_get_string(data).decode('utf8')
+            elif data_type == cproton.PN_ULONG:
+                result = cproton.pn_data_get_ulong(data)
+            elif data_type == cproton.PN_UUID:
+                result = cproton.pn_data_get_uuid(data)
+            elif data_type == cproton.PN_BINARY:
+                result = cproton.pn_data_get_binary(data)
+            cproton.pn_data_rewind(data)
+        return result
+
+    def _set_message_id(self, message_id):
+        """
+        Sets the message id to a string
+        """
+        data = cproton.pn_message_id(self.message)
+        cproton.pn_data_clear(data)
+        cproton.pn_data_put_string(data, str(message_id))
+        cproton.pn_data_rewind(data)
+
+    message_id = property(_get_message_id, _set_message_id)
+
     def set_content_type(self, content_type):
         """
         Sets the message content type
@@ -321,6 +406,8 @@ class _MQLightMessenger(object):
         self.sasl_outcome = cproton.PN_SASL_NONE
         self._name = name
         self._lock = threading.RLock()
+        # Instrumentation hooks, shared with the client
+        self.hooks = {}
         LOG.exit('_MQLightMessenger.constructor', NO_CLIENT_ID, None)
 
     @staticmethod
@@ -540,14 +627,16 @@ class _MQLightMessenger(object):
             remote_idle_timeout)
         return remote_idle_timeout
 
-    def flow(self, address, credit, sock):
+    def flow(self, address, credit, sock, write=True):
         """
-        Process messages based on the number of credit available
+        Process messages based on the number of credit available. If write is
+        False the flow is left buffered in the transport for a later pop()
         """
         LOG.entry('_MQLightMessenger.flow', NO_CLIENT_ID)
         LOG.parms(NO_CLIENT_ID, 'address:', address)
         LOG.parms(NO_CLIENT_ID, 'credit:', credit)
         LOG.parms(NO_CLIENT_ID, 'sock:', sock)
+        LOG.parms(NO_CLIENT_ID, 'write:', write)
         # throw exception if not connected
         if self.messenger is None:
             raise NetworkError('Not connected')
@@ -556,7 +645,8 @@ class _MQLightMessenger(object):
         link = cproton.pn_messenger_get_link(self.messenger, address, False)
         if link:
             cproton.pn_link_flow(link, credit)
-            self._write(sock, False)
+            if write:
+                self._write(sock, False)
         LOG.exit('_MQLightMessenger.flow', NO_CLIENT_ID, None)
 
     def put(self, msg, qos):
@@ -642,12 +732,13 @@ class _MQLightMessenger(object):
 
         messages = []
         count = cproton.pn_messenger_incoming(self.messenger)
-        LOG.data(NO_CLIENT_ID, 'messages count: {0}'.format(count))
+        LOG.data(NO_CLIENT_ID, 'messages count:', count)
         while cproton.pn_messenger_incoming(self.messenger) > 0:
-            message = cproton.pn_message()
+            message, instructions = _take_message()
             rc = cproton.pn_messenger_get(self.messenger, message)
             # try again if message not yet available on incoming queue
             if rc == cproton.PN_EOS:
+                _MESSAGE_POOL.append((message, instructions))
                 continue
             error = cproton.pn_messenger_errno(self.messenger)
             if error:
@@ -655,7 +746,7 @@ class _MQLightMessenger(object):
                     cproton.pn_messenger_error(
                         self.messenger))
                 _MQLightMessenger._raise_error(text)
-            msg = _MQLightMessage(message)
+            msg = _MQLightMessage(message, instructions)
             tracker = cproton.pn_messenger_incoming_tracker(self.messenger)
             msg.tracker = tracker
             link = cproton.pn_messenger_tracker_link(
@@ -683,13 +774,15 @@ class _MQLightMessenger(object):
         LOG.exit('_MQLightMessenger.receive', NO_CLIENT_ID, messages)
         return messages
 
-    def settle(self, message, sock):
+    def settle(self, message, sock, write=True):
         """
-        Settles a message
+        Settles a message. If write is False the settlement is left buffered
+        in the transport for a later pop()
         """
         LOG.entry('_MQLightMessenger.settle', NO_CLIENT_ID)
         LOG.parms(NO_CLIENT_ID, 'message:', message)
         LOG.parms(NO_CLIENT_ID, 'sock:', sock)
+        LOG.parms(NO_CLIENT_ID, 'write:', write)
         # throw exception if not connected
         if self.messenger is None:
             raise NetworkError('Not connected')
@@ -708,7 +801,8 @@ class _MQLightMessenger(object):
         elif status != 0:
             raise NetworkError('Failed to settle')
 
-        self._write(sock, False)
+        if write:
+            self._write(sock, False)
         LOG.exit('_MQLightMessenger.settle', NO_CLIENT_ID, True)
         return True
 
@@ -790,9 +884,10 @@ class _MQLightMessenger(object):
         LOG.exit('_MQLightMessenger.status', NO_CLIENT_ID, status)
         return status
 
-    def subscribe(self, address, qos, ttl, credit, sock):
+    def subscribe(self, address, qos, ttl, credit, sock, write=True):
         """
-        Subscribes to a topic
+        Subscribes to a topic. If write is False the attach is left buffered
+        in the transport for a later pop()
         """
         LOG.entry('_MQLightMessenger.subscribe', NO_CLIENT_ID)
         if credit > 4294967295:
@@ -802,6 +897,7 @@ class _MQLightMessenger(object):
         LOG.parms(NO_CLIENT_ID, 'ttl:', ttl)
         LOG.parms(NO_CLIENT_ID, 'credit:', credit)
         LOG.parms(NO_CLIENT_ID, 'sock:', sock)
+        LOG.parms(NO_CLIENT_ID, 'write:', write)
 
         # throw exception if not connected
         if self.messenger is None:
@@ -829,7 +925,8 @@ class _MQLightMessenger(object):
                 cproton.pn_messenger_error(self.messenger))
             _MQLightMessenger._raise_error(text)
 
-        self._write(sock, False)
+        if write:
+            self._write(sock, False)
 
         LOG.exit('_MQLightMessenger.subscribe', NO_CLIENT_ID, True)
         return True
@@ -1052,6 +1149,10 @@ class _MQLightMessenger(object):
                         # write n bytes to stream
                         buf = cproton.pn_transport_head(transport, n)
                         sock.send(buf)
+                        trace.record(trace.WRITE, NO_CLIENT_ID, n)
+                        if self.hooks:
+                            hooks.call_hooks(self.hooks, hooks.WRITTEN,
+                                             self._name, {'bytes': n})
 
                         closed = cproton.pn_connection_pop(self.connection, n)
                         if closed:
@@ -1088,6 +1189,14 @@ class _MQLightMessenger(object):
 
 class _MQLightSocket(object):
 
+    """
+    A connection to the MQ Light service. A thread waits for data on the
+    connection and passes it straight to on_read, which must not block, so
+    that each chunk read is handed off once, to the client's action thread,
+    rather than through another thread of the socket's own. Data is written
+    to the connection on whichever thread calls send().
+    """
+
     def __init__(self, address, tls, security_options, on_read, on_close):
         LOG.entry('_MQLightSocket.__init__', NO_CLIENT_ID)
         LOG.parms(NO_CLIENT_ID, 'address:', address)
@@ -1098,9 +1207,6 @@ class _MQLightSocket(object):
         self.running = False
         self.on_read = on_read
         self.on_close = on_close
-        self._data_queue = Queue.Queue()
-        self._data_handler_thread = threading.Thread(target=self.queue_data)
-        self._data_handler_thread.setDaemon(True)
         try:
             self.sock = socket.socket(
                 socket.AF_INET,
@@ -1124,31 +1230,18 @@ class _MQLightSocket(object):
             raise exc
         LOG.exit('_MQLightSocket.__init__', NO_CLIENT_ID, None)
 
-    def queue_data(self):
-        LOG.entry('_MQLightSocket.queue_data', NO_CLIENT_ID)
-        while self.running:
-            args = self._data_queue.get()
-            callback = args[0]
-            if len(args) > 1:
-                callback(*args[1:])
-            # if we do not get arguments that means on_close was passed in
-            else:
-                callback()
-                self.running = False
-        LOG.exit('_MQLightSocket.queue_data', NO_CLIENT_ID, None)
-
     def loop(self):
         LOG.entry('_MQLightSocket.loop', NO_CLIENT_ID)
-        self._data_handler_thread.start()
         exc = None
         while self.running and not exc:
             read, write, exc = select.select([self.sock], [], [self.sock])
             if read:
-                data = self.sock.recv(4096)
+                data = self.sock.recv(READ_SIZE)
                 if data:
-                    self._data_queue.put((self.on_read, data))
+                    self.on_read(data)
                 else:
-                    self._data_queue.put((self.on_close,))
+                    self.on_close()
+                    self.running = False
         LOG.exit('_MQLightSocket.loop', NO_CLIENT_ID, None)
 
     def send(self, msg):
@@ -1163,6 +1256,8 @@ class _MQLightSocket(object):
         LOG.entry('_MQLightSocket.close', NO_CLIENT_ID)
         self.running = False
         self.sock.shutdown(socket.SHUT_RD)
-        self.io_loop.join()
+        # on_close may close the socket from the loop's own thread
+        if threading.current_thread() is not self.io_loop:
+            self.io_loop.join()
         self.sock.close()
         LOG.exit('_MQLightSocket.close', NO_CLIENT_ID, None)
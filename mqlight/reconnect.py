@@ -0,0 +1,318 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Coordination of the connection attempts made by all of the clients in a
+process, so that they do not all reconnect to a service at once
+"""
+from __future__ import absolute_import
+import threading
+import time
+from random import random
+from .exceptions import RangeError
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ReconnectPolicy(object):
+
+    """
+    Controls how the clients in a process retry connecting to the MQ Light
+    service. For example, to let no more than two clients at a time perform
+    the TLS and SASL handshakes with an endpoint::
+
+        mqlight.set_reconnect_policy(ReconnectPolicy(max_concurrent=2))
+    """
+
+    def __init__(
+            self,
+            initial_delay=1,
+            max_delay=60,
+            multiplier=2,
+            jitter=0.25,
+            max_concurrent=4,
+            handshake_rate=10.0,
+            handshake_burst=10,
+            failure_threshold=5,
+            open_time=30):
+        """Creates a ReconnectPolicy.
+
+        :param initial_delay: the delay, in seconds, before the first retry.
+        :param max_delay: the longest delay, in seconds, between retries.
+        :param multiplier: the factor the delay grows by after each failed
+            retry.
+        :param jitter: the fraction of each delay that is random, so that
+            clients spread out their retries.
+        :param max_concurrent: the most connection attempts that may be in
+            progress to one endpoint at a time.
+        :param handshake_rate: the number of connection attempts, per second,
+            that may be started to one endpoint.
+        :param handshake_burst: the number of connection attempts that may be
+            started to one endpoint at once, after a quiet period.
+        :param failure_threshold: the number of connection attempts to an
+            endpoint that must fail in a row before the endpoint is treated
+            as down.
+        :param open_time: the time, in seconds, that an endpoint that is down
+            is left alone before one connection attempt is allowed to test
+            it.
+        :raises RangeError: if any of the values is out of range.
+        """
+        LOG.entry('ReconnectPolicy.constructor', NO_CLIENT_ID)
+        for name, value, minimum in (
+                ('initial_delay', initial_delay, 0),
+                ('max_delay', max_delay, 0),
+                ('multiplier', multiplier, 1),
+                ('handshake_rate', handshake_rate, 0),
+                ('open_time', open_time, 0)):
+            if not isinstance(value, (int, long, float)) or value < minimum:
+                raise RangeError(
+                    '{0} value {1} is invalid must be a number no less than '
+                    '{2}'.format(name, value, minimum))
+        if not isinstance(jitter, (int, long, float)) or \
+                not 0 <= jitter <= 1:
+            raise RangeError(
+                'jitter value {0} is invalid must be a number between 0 '
+                'and 1'.format(jitter))
+        for name, value in (
+                ('max_concurrent', max_concurrent),
+                ('handshake_burst', handshake_burst),
+                ('failure_threshold', failure_threshold)):
+            if not isinstance(value, (int, long)) or value <= 0:
+                raise RangeError(
+                    '{0} value {1} is invalid must be a positive integer '
+                    'number'.format(name, value))
+        if handshake_rate == 0:
+            raise RangeError(
+                'handshake_rate value 0 is invalid must be a positive number')
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.handshake_rate = handshake_rate
+        self.handshake_burst = handshake_burst
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        LOG.exit('ReconnectPolicy.constructor', NO_CLIENT_ID, None)
+
+    def delay(self, attempt):
+        """
+        Returns the time, in seconds, to wait before retry number attempt
+        """
+        if self.initial_delay == 0:
+            return 0
+        # limit the exponent, as anything above this puts the delay over any
+        # sensible cap straight away
+        upper_bound = self.initial_delay * pow(
+            self.multiplier, min(attempt, 32))
+        jitter = random() * self.jitter * upper_bound
+        return min(self.max_delay, (1 - self.jitter) * upper_bound + jitter)
+
+
+class _Endpoint(object):
+
+    """
+    The state kept for connection attempts to one endpoint
+    """
+    __slots__ = ('in_flight', 'tokens', 'refilled', 'state', 'failures',
+                 'opened', 'attempts', 'deferred', 'trips')
+
+    def __init__(self, burst):
+        self.in_flight = 0
+        self.tokens = float(burst)
+        self.refilled = time.time()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.attempts = 0
+        self.deferred = 0
+        self.trips = 0
+
+
+class ReconnectCoordinator(object):
+
+    """
+    Decides when the clients in a process may attempt to connect to each
+    endpoint. For each endpoint it limits the number of attempts in progress
+    at once, rations the start of new attempts with a token bucket, and runs
+    a circuit breaker that holds off every attempt while the endpoint is
+    known to be down.
+    """
+
+    def __init__(self, policy=None):
+        self._policy = policy or ReconnectPolicy()
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    @property
+    def policy(self):
+        """The ReconnectPolicy in use"""
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        """Replaces the ReconnectPolicy in use"""
+        if not isinstance(policy, ReconnectPolicy):
+            raise TypeError('policy must be a ReconnectPolicy')
+        with self._lock:
+            self._policy = policy
+
+    def _endpoint(self, endpoint):
+        """
+        Returns the state for an endpoint, creating it if needed. Must be
+        called with the lock held.
+        """
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = _Endpoint(
+                self._policy.handshake_burst)
+        return state
+
+    def acquire(self, endpoint):
+        """Asks to start a connection attempt to endpoint. If the attempt may
+        start, 0 is returned and release() must be called once it has
+        finished. Otherwise the time, in seconds, to wait before asking again
+        is returned.
+        """
+        LOG.entry('ReconnectCoordinator.acquire', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'endpoint:', endpoint)
+        policy = self._policy
+        now = time.time()
+        with self._lock:
+            state = self._endpoint(endpoint)
+            wait = 0
+            if state.state == OPEN:
+                wait = state.opened + policy.open_time - now
+                if wait <= 0:
+                    # Let a single attempt test whether the endpoint is back
+                    state.state = HALF_OPEN
+                    wait = 0
+            if not wait:
+                limit = 1 if state.state == HALF_OPEN else \
+                    policy.max_concurrent
+                if state.in_flight >= limit:
+                    # Check again once an attempt in progress could have
+                    # finished
+                    wait = 1.0 / policy.handshake_rate
+            if not wait:
+                state.tokens = min(
+                    float(policy.handshake_burst),
+                    state.tokens + (now - state.refilled) *
+                    policy.handshake_rate)
+                state.refilled = now
+                if state.tokens < 1:
+                    wait = (1 - state.tokens) / policy.handshake_rate
+                else:
+                    state.tokens -= 1
+                    state.in_flight += 1
+                    state.attempts += 1
+            if wait:
+                state.deferred += 1
+        LOG.exit('ReconnectCoordinator.acquire', NO_CLIENT_ID, wait)
+        return wait
+
+    def release(self, endpoint, connected, down=True):
+        """
+        Reports that a connection attempt started with acquire() has
+        finished. down should be False for an attempt that failed for a
+        reason that does not suggest the endpoint is down, such as an invalid
+        argument, so that it is not counted by the circuit breaker.
+        """
+        LOG.entry('ReconnectCoordinator.release', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'endpoint:', endpoint)
+        LOG.parms(NO_CLIENT_ID, 'connected:', connected)
+        LOG.parms(NO_CLIENT_ID, 'down:', down)
+        with self._lock:
+            state = self._endpoint(endpoint)
+            state.in_flight = max(state.in_flight - 1, 0)
+            if connected:
+                state.state = CLOSED
+                state.failures = 0
+            elif not down:
+                if state.state == HALF_OPEN:
+                    # Let another attempt test the endpoint
+                    state.state = OPEN
+            else:
+                state.failures += 1
+                if state.state == HALF_OPEN or (
+                        state.state == CLOSED and
+                        state.failures >= self._policy.failure_threshold):
+                    LOG.data(
+                        NO_CLIENT_ID,
+                        'endpoint {0} is down'.format(endpoint))
+                    state.state = OPEN
+                    state.opened = time.time()
+                    state.trips += 1
+        LOG.exit('ReconnectCoordinator.release', NO_CLIENT_ID, None)
+
+    def retry_delay(self, endpoints, attempt):
+        """
+        Returns the time, in seconds, to wait before retry number attempt to
+        connect to any of endpoints. This is the delay from the policy, but
+        no sooner than the first of the endpoints stops being held off by its
+        circuit breaker.
+        """
+        delay = self._policy.delay(attempt)
+        now = time.time()
+        with self._lock:
+            opens = [
+                state.opened + self._policy.open_time - now
+                for state in (self._endpoints.get(endpoint)
+                              for endpoint in endpoints)
+                if state is not None and state.state == OPEN]
+        if opens and len(opens) == len(endpoints):
+            delay = max(delay, min(opens))
+        return delay
+
+    def stats(self):
+        """
+        Returns a dictionary, keyed by endpoint, holding the ``state`` of the
+        circuit breaker, the number of ``in_flight`` attempts, the number of
+        ``attempts`` started, the number of times an attempt was
+        ``deferred`` and the number of times the breaker has opened, as
+        ``trips``
+        """
+        with self._lock:
+            return dict(
+                (endpoint, {
+                    'state': state.state,
+                    'in_flight': state.in_flight,
+                    'attempts': state.attempts,
+                    'deferred': state.deferred,
+                    'trips': state.trips
+                })
+                for endpoint, state in self._endpoints.items())
+
+
+# The coordinator shared by every client in the process
+COORDINATOR = ReconnectCoordinator()
+
+
+def set_reconnect_policy(policy):
+    """Sets the ReconnectPolicy used by every client in the process.
+
+    :param policy: the ReconnectPolicy.
+    :raises TypeError: if policy is not a ReconnectPolicy.
+    """
+    LOG.entry('set_reconnect_policy', NO_CLIENT_ID)
+    LOG.parms(NO_CLIENT_ID, 'policy:', policy)
+    COORDINATOR.policy = policy
+    LOG.exit('set_reconnect_policy', NO_CLIENT_ID, None)
@@ -0,0 +1,259 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+Client side routing of received messages to local handlers, based on the
+topic of each message
+"""
+from __future__ import absolute_import
+import threading
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+# Wildcards that can be used as a level of a topic pattern. '#' matches any
+# number of levels (including none) and '+' matches exactly one level
+MULTI_LEVEL_WILDCARD = '#'
+SINGLE_LEVEL_WILDCARD = '+'
+
+
+class _TrieNode(object):
+
+    """
+    A level of a topic pattern in a TopicTrie
+    """
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicTrie(object):
+
+    """
+    Stores values against MQ Light topic patterns, and finds the values for
+    every pattern that matches a topic. Topics and patterns are split into
+    levels at each '/'. A level of a pattern can be the wildcard '+', which
+    matches exactly one level of a topic, or '#', which matches any number of
+    levels. Finding the matches for a topic costs time proportional to the
+    number of levels in the topic, rather than the number of patterns stored.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._size = 0
+
+    def add(self, topic_pattern, value):
+        """
+        Stores a value against a topic pattern. The same value can be stored
+        against more than one pattern.
+        """
+        node = self._root
+        for level in topic_pattern.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TrieNode()
+            node = child
+        node.values.append(value)
+        self._size += 1
+
+    def remove(self, topic_pattern, value):
+        """
+        Removes a value stored against a topic pattern, returning True if the
+        value was found
+        """
+        path = [self._root]
+        for level in topic_pattern.split('/'):
+            child = path[-1].children.get(level)
+            if child is None:
+                return False
+            path.append(child)
+        if value not in path[-1].values:
+            return False
+        path[-1].values.remove(value)
+        self._size -= 1
+
+        # Prune the levels that no longer lead to any values
+        levels = topic_pattern.split('/')
+        for index in range(len(levels), 0, -1):
+            node = path[index]
+            if node.values or node.children:
+                break
+            del path[index - 1].children[levels[index - 1]]
+        return True
+
+    def match(self, topic):
+        """
+        Returns a list of the values stored against patterns that match the
+        topic, in no particular order. Each value is only returned once, even
+        if it is stored against more than one matching pattern.
+        """
+        result = []
+        self._collect(self._root, topic.split('/'), 0, result)
+        if len(result) > 1:
+            unique = []
+            for value in result:
+                if value not in unique:
+                    unique.append(value)
+            result = unique
+        return result
+
+    def _collect(self, node, levels, index, result):
+        """
+        Adds the values of the patterns that match levels[index:] below node
+        """
+        if index == len(levels):
+            result.extend(node.values)
+        hash_node = node.children.get(MULTI_LEVEL_WILDCARD)
+        if hash_node is not None:
+            # A '#' matches any number of levels, including none, so the
+            # rest of the pattern, which may start with another '#', can
+            # follow it at any of the remaining levels
+            for skip in range(index, len(levels) + 1):
+                self._collect(hash_node, levels, skip, result)
+        if index < len(levels):
+            child = node.children.get(levels[index])
+            if child is not None:
+                self._collect(child, levels, index + 1, result)
+            child = node.children.get(SINGLE_LEVEL_WILDCARD)
+            if child is not None:
+                self._collect(child, levels, index + 1, result)
+
+    def __len__(self):
+        return self._size
+
+
+class TopicRouter(object):
+
+    """
+    Fans out the messages received by one subscription to local handlers,
+    each registered against its own topic pattern. This means that handlers
+    with overlapping topic patterns can share a single subscription with a
+    broad pattern, rather than each opening a subscription and receiving its
+    own copy of every message. For example::
+
+        router = TopicRouter()
+        router.add_handler('sports/football/#', on_football)
+        router.add_handler('sports/+/results', on_results)
+        client.subscribe('sports/#', on_message=router.on_message)
+
+    A message is passed to every handler whose pattern matches its topic.
+    Handlers have the same ``func(message_type, data, delivery)`` prototype
+    as the on_message function of Client.subscribe(), and are called on the
+    thread that delivers messages for the client.
+    """
+
+    def __init__(self, on_unmatched=None):
+        """
+        Creates a TopicRouter.
+
+        :param on_unmatched: (optional) function to call for messages that do
+            not match the pattern of any handler. This function has the same
+            prototype as a handler.
+        :raises TypeError: if on_unmatched is not a function
+        """
+        LOG.entry('TopicRouter.constructor', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'on_unmatched:', on_unmatched)
+        if on_unmatched and not hasattr(on_unmatched, '__call__'):
+            raise TypeError('on_unmatched must be a function')
+        self._trie = TopicTrie()
+        self._on_unmatched = on_unmatched
+        self._lock = threading.Lock()
+        LOG.exit('TopicRouter.constructor', NO_CLIENT_ID, None)
+
+    @staticmethod
+    def _validate(topic_pattern, on_message):
+        """
+        Validates the arguments identifying a handler, returning the topic
+        pattern as a string
+        """
+        if topic_pattern is None or topic_pattern == '':
+            raise TypeError(
+                'Cannot route messages to an empty or None topic_pattern')
+        if not hasattr(on_message, '__call__'):
+            raise TypeError('on_message must be a function')
+        return str(topic_pattern)
+
+    def add_handler(self, topic_pattern, on_message):
+        """Registers a function to be called for every message whose topic
+        matches topic_pattern. The same function can be registered against
+        more than one pattern.
+
+        :param topic_pattern: the topic pattern to match, using the same
+            wildcards as Client.subscribe().
+        :param on_message: function to call for matching messages.
+        :returns: The instance of the router.
+        :raises TypeError: if topic_pattern is empty or on_message is not a
+            function
+        """
+        LOG.entry('TopicRouter.add_handler', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'topic_pattern:', topic_pattern)
+        LOG.parms(NO_CLIENT_ID, 'on_message:', on_message)
+        topic_pattern = self._validate(topic_pattern, on_message)
+        with self._lock:
+            self._trie.add(topic_pattern, on_message)
+        LOG.exit('TopicRouter.add_handler', NO_CLIENT_ID, self)
+        return self
+
+    def remove_handler(self, topic_pattern, on_message):
+        """Stops calling a function that was registered against
+        topic_pattern.
+
+        :param topic_pattern: the topic pattern the function was registered
+            against.
+        :param on_message: the function to remove.
+        :returns: True if the function was registered against the pattern.
+        :raises TypeError: if topic_pattern is empty or on_message is not a
+            function
+        """
+        LOG.entry('TopicRouter.remove_handler', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'topic_pattern:', topic_pattern)
+        LOG.parms(NO_CLIENT_ID, 'on_message:', on_message)
+        topic_pattern = self._validate(topic_pattern, on_message)
+        with self._lock:
+            removed = self._trie.remove(topic_pattern, on_message)
+        LOG.exit('TopicRouter.remove_handler', NO_CLIENT_ID, removed)
+        return removed
+
+    def handlers(self, topic):
+        """
+        Returns a list of the functions registered against patterns that
+        match the topic
+        """
+        return self._trie.match(topic)
+
+    def on_message(self, message_type, data, delivery):
+        """
+        Passes a message to every handler whose pattern matches its topic.
+        Supply this as the on_message function when subscribing. If a handler
+        raises an error, the remaining handlers are still called and the first
+        error is raised once they have all returned.
+        """
+        LOG.entry_often('TopicRouter.on_message', NO_CLIENT_ID)
+        handlers = self._trie.match(delivery['message']['topic'])
+        if not handlers and self._on_unmatched:
+            handlers = [self._on_unmatched]
+        error = None
+        for handler in handlers:
+            try:
+                handler(message_type, data, delivery)
+            except StandardError as err:
+                LOG.error('TopicRouter.on_message', NO_CLIENT_ID, err)
+                if error is None:
+                    error = err
+        if error is not None:
+            raise error
+        LOG.exit_often('TopicRouter.on_message', NO_CLIENT_ID, len(handlers))
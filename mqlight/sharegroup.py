@@ -0,0 +1,349 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+A group of worker processes consuming from one shared subscription
+"""
+from __future__ import absolute_import
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from .client import Client
+from .exceptions import InvalidArgumentError, RangeError
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+# How often, in seconds, the supervisor checks on the workers
+SUPERVISE_INTERVAL = 0.5
+
+# The number of counters held for each worker: messages and errors
+_COUNTERS = 2
+
+
+def _run_worker(index, config, drain, counters):
+    """
+    The body of a worker process. Creates a client that subscribes to the
+    share, then runs until the group asks it to drain, its parent exits, or
+    its client stops for good, in which case the worker exits so that the
+    group restarts it.
+    """
+    LOG.entry('ShareGroup._run_worker', NO_CLIENT_ID)
+    LOG.parms(NO_CLIENT_ID, 'index:', index)
+    slot = index * _COUNTERS
+    on_message = config['on_message']
+    stopped = threading.Event()
+
+    def counting_on_message(message_type, data, delivery):
+        """counts the messages handled, and the handlers that fail"""
+        counters[slot] += 1
+        try:
+            on_message(message_type, data, delivery)
+        except Exception:
+            counters[slot + 1] += 1
+            raise
+
+    def started(client):
+        """subscribes once the client has started"""
+        client.subscribe(
+            config['topic_pattern'],
+            config['share'],
+            config['options'],
+            on_message=counting_on_message)
+
+    client = Client(
+        config['service'],
+        '{0}_{1}'.format(config['client_id_prefix'], index),
+        config['security_options'],
+        on_started=started)
+
+    parent = os.getppid()
+    while not drain.wait(SUPERVISE_INTERVAL):
+        if os.getppid() != parent:
+            # The group has gone away without stopping the worker
+            break
+        if client.is_stopped():
+            # The client has stopped, for example because it was replaced
+            # or a security error ended its connection, and will not
+            # restart by itself
+            LOG.data(NO_CLIENT_ID, 'worker client has stopped')
+            LOG.exit('ShareGroup._run_worker', NO_CLIENT_ID, None)
+            return
+
+    # Stop taking new messages and let the handler finish the one it is
+    # processing. Unconfirmed messages are redelivered to the rest of the
+    # share by the MQ Light service.
+    client.stop(lambda *args: stopped.set())
+    stopped.wait(config['drain_timeout'])
+    LOG.exit('ShareGroup._run_worker', NO_CLIENT_ID, None)
+
+
+class ShareGroup(object):
+
+    """
+    Runs a number of worker processes, each with its own Client subscribed to
+    the same shared subscription, so that messages are spread across them by
+    the MQ Light service and handlers can use more than one processor core.
+    For example::
+
+        group = ShareGroup('amqp://localhost', 'orders/#', 'order_workers',
+                           handle_order, workers=4).start()
+        ...
+        group.stop()
+
+    The group restarts workers that exit, waiting longer after each restart
+    of a worker that keeps failing. A worker also exits, and so is
+    restarted, if its client stops for good, for example because another
+    client has replaced it. The workers' clients have no on_state_changed
+    function, so an error raised by the handler is treated as it is by any
+    Client without one: the traceback is printed and the worker process is
+    ended at once with ``os._exit(1)``, without stopping its client. Its
+    unconfirmed messages are then redelivered to the other workers. When
+    the group is stopped, each worker stops its client once the handler has
+    finished the message it is processing.
+
+    The on_message function is called in the worker processes, so anything it
+    changes is not seen by the process that created the group.
+    """
+
+    def __init__(
+            self,
+            service,
+            topic_pattern,
+            share,
+            on_message,
+            workers=None,
+            options=None,
+            client_id_prefix=None,
+            security_options=None,
+            restart_delay=1.0,
+            max_restart_delay=60.0,
+            drain_timeout=30.0):
+        """Creates a ShareGroup. The workers are not started until start() is
+        called.
+
+        :param service: the service to connect to, as for Client.
+        :param topic_pattern: the topic pattern to subscribe to.
+        :param share: the share name that every worker subscribes with.
+        :param on_message: function to call in a worker when it receives a
+            message, as for Client.subscribe().
+        :param workers: (optional) the number of worker processes. Defaults to
+            the number of processor cores.
+        :param options: (optional) the subscribe options for each worker.
+        :param client_id_prefix: (optional) prefix for the client id of each
+            worker, which is followed by the number of the worker.
+        :param security_options: (optional) security options, as for Client.
+        :param restart_delay: the time, in seconds, to wait before restarting
+            a worker that has exited. This doubles each time the worker exits
+            again soon after being restarted.
+        :param max_restart_delay: the longest time, in seconds, to wait
+            before restarting a worker.
+        :param drain_timeout: the time, in seconds, that a worker waits for
+            its client to stop when the group is stopped.
+        :raises TypeError: if on_message is not a function.
+        :raises RangeError: if workers or any of the times are not positive.
+        :raises InvalidArgumentError: if share is not specified.
+        """
+        LOG.entry('ShareGroup.constructor', NO_CLIENT_ID)
+        LOG.parms(NO_CLIENT_ID, 'service:', service)
+        LOG.parms(NO_CLIENT_ID, 'topic_pattern:', topic_pattern)
+        LOG.parms(NO_CLIENT_ID, 'share:', share)
+        LOG.parms(NO_CLIENT_ID, 'workers:', workers)
+        if not share:
+            raise InvalidArgumentError(
+                'A ShareGroup must subscribe with a share name')
+        if not hasattr(on_message, '__call__'):
+            raise TypeError('on_message must be a function')
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        try:
+            workers = int(workers)
+            if workers <= 0:
+                raise TypeError()
+        except Exception:
+            raise RangeError(
+                'workers value {0} is invalid must be a positive integer '
+                'number'.format(workers))
+        for name, value in (('restart_delay', restart_delay),
+                            ('max_restart_delay', max_restart_delay),
+                            ('drain_timeout', drain_timeout)):
+            if not isinstance(value, (int, long, float)) or value <= 0:
+                raise RangeError(
+                    '{0} value {1} is invalid must be a positive '
+                    'number'.format(name, value))
+        if client_id_prefix is None:
+            client_id_prefix = 'SHARE_' + str(uuid.uuid4()).replace(
+                '-', '_')[0:7]
+
+        self._config = {
+            'service': service,
+            'topic_pattern': topic_pattern,
+            'share': share,
+            'options': options,
+            'on_message': on_message,
+            'client_id_prefix': str(client_id_prefix),
+            'security_options': security_options,
+            'drain_timeout': drain_timeout
+        }
+        self._workers = workers
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._drain_timeout = drain_timeout
+        self._drain = multiprocessing.Event()
+        # Each worker only writes to its own counters, so they need no lock
+        self._counters = multiprocessing.RawArray('l', workers * _COUNTERS)
+        self._processes = [None] * workers
+        self._started_at = [0] * workers
+        self._failures = [0] * workers
+        self._restart_at = [None] * workers
+        self._restarts = 0
+        self._supervisor = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        LOG.exit('ShareGroup.constructor', NO_CLIENT_ID, None)
+
+    def _start_worker(self, index):
+        """
+        Starts the process for a worker
+        """
+        LOG.entry('ShareGroup._start_worker', NO_CLIENT_ID)
+        process = multiprocessing.Process(
+            target=_run_worker,
+            args=(index, self._config, self._drain, self._counters),
+            name='{0}_{1}'.format(self._config['client_id_prefix'], index))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.time()
+        self._restart_at[index] = None
+        LOG.exit('ShareGroup._start_worker', NO_CLIENT_ID, process.pid)
+
+    def _supervise(self):
+        """
+        Restarts workers that have exited, until the group is stopped
+        """
+        LOG.entry('ShareGroup._supervise', NO_CLIENT_ID)
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            with self._lock:
+                if self._stopping.is_set():
+                    break
+                now = time.time()
+                for index, process in enumerate(self._processes):
+                    if process.is_alive():
+                        continue
+                    if self._restart_at[index] is None:
+                        LOG.data(
+                            NO_CLIENT_ID,
+                            'worker {0} exited with code {1}'.format(
+                                index, process.exitcode))
+                        # A worker that ran for a while before exiting is
+                        # restarted quickly, but one that keeps exiting
+                        # straight away is restarted less and less often
+                        if now - self._started_at[index] > \
+                                self._max_restart_delay:
+                            self._failures[index] = 0
+                        delay = min(
+                            self._restart_delay * 2 ** self._failures[index],
+                            self._max_restart_delay)
+                        self._failures[index] += 1
+                        self._restart_at[index] = now + delay
+                    elif now >= self._restart_at[index]:
+                        self._restarts += 1
+                        self._start_worker(index)
+        LOG.exit('ShareGroup._supervise', NO_CLIENT_ID, None)
+
+    def start(self):
+        """Starts the worker processes, and the thread that supervises them.
+
+        :returns: The instance of the group.
+        :raises InvalidArgumentError: if the group has already been started.
+        """
+        LOG.entry('ShareGroup.start', NO_CLIENT_ID)
+        with self._lock:
+            if self._supervisor is not None:
+                raise InvalidArgumentError('ShareGroup is already started')
+            for index in range(self._workers):
+                self._start_worker(index)
+            self._supervisor = threading.Thread(target=self._supervise)
+            self._supervisor.daemon = True
+            self._supervisor.start()
+        LOG.exit('ShareGroup.start', NO_CLIENT_ID, self)
+        return self
+
+    def stop(self, timeout=None):
+        """Stops the group. Each worker finishes the message it is processing
+        and stops its client, and any worker that has not exited within the
+        timeout is terminated.
+
+        :param timeout: (optional) the time, in seconds, to wait for the
+            workers to exit. Defaults to the drain_timeout of the group.
+        :returns: True if every worker exited by itself.
+        """
+        LOG.entry('ShareGroup.stop', NO_CLIENT_ID)
+        if timeout is None:
+            timeout = self._drain_timeout
+        with self._lock:
+            self._stopping.set()
+            self._drain.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+
+        deadline = time.time() + timeout
+        drained = True
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                LOG.data(
+                    NO_CLIENT_ID,
+                    'terminating worker {0} that did not drain'.format(
+                        process.name))
+                process.terminate()
+                process.join()
+                drained = False
+        LOG.exit('ShareGroup.stop', NO_CLIENT_ID, drained)
+        return drained
+
+    def metrics(self):
+        """Returns a dictionary of metrics for the group: ``workers`` is the
+        number of workers, ``alive`` the number of worker processes that are
+        running, ``restarts`` the number of times a worker has been
+        restarted, ``messages`` the number of messages passed to on_message
+        and ``errors`` the number of those for which on_message raised an
+        error. ``per_worker`` is a list holding the ``pid``, ``alive``,
+        ``messages`` and ``errors`` for each worker.
+        """
+        per_worker = []
+        with self._lock:
+            for index, process in enumerate(self._processes):
+                slot = index * _COUNTERS
+                per_worker.append({
+                    'pid': process.pid if process else None,
+                    'alive': bool(process and process.is_alive()),
+                    'messages': self._counters[slot],
+                    'errors': self._counters[slot + 1]
+                })
+            restarts = self._restarts
+        return {
+            'workers': self._workers,
+            'alive': sum(1 for worker in per_worker if worker['alive']),
+            'restarts': restarts,
+            'messages': sum(worker['messages'] for worker in per_worker),
+            'errors': sum(worker['errors'] for worker in per_worker),
+            'per_worker': per_worker
+        }
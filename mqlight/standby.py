@@ -0,0 +1,232 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+A spare network connection that a client can fail over to
+"""
+from __future__ import absolute_import
+import socket
+import threading
+from .logging import get_logger
+from .reconnect import COORDINATOR
+from .timer import call_later
+
+LOG = get_logger(__name__)
+
+
+class _Standby(object):
+
+    """
+    Keeps a connected, and for amqps handshaken, socket open to the service
+    the client would fail over to, so that a reconnect does not have to wait
+    for a TCP connection and TLS handshake. The AMQP connection is only
+    opened once the client takes the socket, as the MQ Light service allows
+    one connection at a time for each client id, so the socket is kept alive
+    with TCP keepalives until then. Opening the standby connection counts
+    as a connection attempt to the service, so is held off by the reconnect
+    coordinator in the same way as a client connecting.
+    """
+
+    def __init__(self, client_id, security_options, socket_class):
+        self._id = client_id
+        self._security_options = security_options
+        self._socket_class = socket_class
+        self._lock = threading.Lock()
+        self._address = None
+        self._tls = False
+        self._sock = None
+        self._opening = False
+        self._retry_timer = None
+        self._retries = 0
+        self._closed = False
+
+    def prepare(self, address, tls):
+        """
+        Opens the standby connection to address, in the background, replacing
+        any standby connection to a different address
+        """
+        LOG.entry('_Standby.prepare', self._id)
+        LOG.parms(self._id, 'address:', address)
+        LOG.parms(self._id, 'tls:', tls)
+        stale = None
+        with self._lock:
+            self._closed = False
+            if self._address != address or self._tls != tls:
+                stale = self._discard()
+                self._address = address
+                self._tls = tls
+                self._retries = 0
+            start = self._sock is None and not self._opening
+            if start:
+                self._opening = True
+        if stale is not None:
+            self._close_socket(stale)
+        if start:
+            opener = threading.Thread(target=self._open)
+            opener.daemon = True
+            opener.start()
+        LOG.exit('_Standby.prepare', self._id, start)
+
+    def _open(self):
+        """
+        Connects the standby socket
+        """
+        LOG.entry('_Standby._open', self._id)
+        with self._lock:
+            address = self._address
+            tls = self._tls
+        wait = COORDINATOR.acquire(address)
+        if wait:
+            LOG.data(
+                self._id,
+                'deferring standby connection for {0} seconds'.format(wait))
+            with self._lock:
+                self._opening = False
+                if not self._closed and address == self._address:
+                    self._schedule_retry(wait)
+            LOG.exit('_Standby._open', self._id, False)
+            return
+        sock = None
+        try:
+            sock = self._socket_class(
+                address,
+                tls,
+                self._security_options,
+                self._on_read,
+                self._on_close)
+            raw = getattr(sock, 'sock', None)
+            if raw is not None:
+                raw.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except Exception as exc:
+            LOG.error('_Standby._open', self._id, exc)
+        COORDINATOR.release(address, sock is not None)
+        with self._lock:
+            self._opening = False
+            if self._closed or address != self._address:
+                # Stopped, or pointed elsewhere, while connecting
+                stale = sock
+                sock = None
+            else:
+                stale = None
+                self._sock = sock
+                if sock is None:
+                    self._schedule_retry()
+                else:
+                    self._retries = 0
+        if stale is not None:
+            self._close_socket(stale)
+        LOG.exit('_Standby._open', self._id, sock is not None)
+
+    def _on_read(self, chunk):
+        """
+        The service does not send anything before the AMQP connection is
+        opened, so data on the standby socket means it is not usable
+        """
+        LOG.data(self._id, 'unexpected data on standby connection')
+        self._on_close()
+
+    def _on_close(self):
+        """
+        Called when the standby socket is closed by the service
+        """
+        LOG.entry('_Standby._on_close', self._id)
+        with self._lock:
+            sock = self._sock
+            self._sock = None
+            if not self._closed:
+                self._schedule_retry()
+        if sock is not None:
+            self._close_socket(sock)
+        LOG.exit('_Standby._on_close', self._id, None)
+
+    def _schedule_retry(self, delay=None):
+        """
+        Opens the standby connection again after delay seconds or, if delay
+        is not given, after the reconnect policy's delay for the number of
+        retries made. Must be called with the lock held.
+        """
+        if self._retry_timer:
+            self._retry_timer.cancel()
+        if delay is None:
+            self._retries += 1
+            delay = COORDINATOR.retry_delay([self._address], self._retries)
+        self._retry_timer = call_later(
+            delay,
+            self.prepare,
+            [self._address, self._tls])
+
+    def ready(self):
+        """
+        Returns the address the standby connection is open to, or None if it
+        is not open
+        """
+        with self._lock:
+            return self._address if self._sock is not None else None
+
+    def take(self, address, on_read, on_close):
+        """
+        Hands the standby socket over to the client, if it is open to
+        address, returning None otherwise. The socket then passes the data it
+        receives to on_read and on_close.
+        """
+        LOG.entry('_Standby.take', self._id)
+        LOG.parms(self._id, 'address:', address)
+        with self._lock:
+            sock = None
+            if self._sock is not None and self._address == address:
+                sock = self._sock
+                self._sock = None
+                sock.on_read = on_read
+                sock.on_close = on_close
+        LOG.exit('_Standby.take', self._id, sock is not None)
+        return sock
+
+    def close(self):
+        """
+        Closes the standby connection, and stops it being opened again
+        """
+        LOG.entry('_Standby.close', self._id)
+        with self._lock:
+            self._closed = True
+            sock = self._discard()
+        if sock is not None:
+            self._close_socket(sock)
+        LOG.exit('_Standby.close', self._id, None)
+
+    def _discard(self):
+        """
+        Stops any retry and takes the standby socket, returning it to be
+        closed once the lock is released, as closing waits for the socket's
+        thread, which may be waiting for the lock. Must be called with the
+        lock held.
+        """
+        if self._retry_timer:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        sock = self._sock
+        self._sock = None
+        return sock
+
+    def _close_socket(self, sock):
+        """
+        Closes a socket, ignoring errors as it is no longer wanted
+        """
+        # Stop the socket reporting its own close
+        sock.on_read = lambda *args: None
+        sock.on_close = lambda *args: None
+        try:
+            sock.close()
+        except Exception as exc:
+            LOG.data(self._id, 'error closing standby connection:', exc)
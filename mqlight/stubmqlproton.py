@@ -51,7 +51,8 @@ class _MQLightMessage(object):
         return None
 
     body = property(_get_body, _set_body)
-    annotations = property((lambda s: None), (lambda s, v: None))
+    annotations = property((lambda s: {}), (lambda s, v: None))
+    message_id = property((lambda s: None), (lambda s, v: None))
     content_type = property((lambda s: None), (lambda s, v: None))
     ttl = property((lambda s: None), (lambda s, v: None))
     address = property((lambda s: None), (lambda s, v: None))
@@ -249,7 +250,7 @@ class _MQLightMessenger(object):
         self.remote_idle_timeout = interval
         self.work_callback = callback
 
-    def flow(self, address, credit, sock):
+    def flow(self, address, credit, sock, write=True):
         """
         Process messages based on the number of credit available
         """
@@ -275,7 +276,7 @@ class _MQLightMessenger(object):
         """
         return []
 
-    def settle(self, message, sock):
+    def settle(self, message, sock, write=True):
         """
         Settles a message
         """
@@ -301,7 +302,7 @@ class _MQLightMessenger(object):
             result = 'UNKNOWN'
         return result
 
-    def subscribe(self, address, qos, ttl, credit, sock):
+    def subscribe(self, address, qos, ttl, credit, sock, write=True):
         """
         Subscribes to a topic
         """
@@ -348,6 +349,8 @@ class _MQLightSocket(object):
 
     def __init__(self, address, tls, security_options, on_read, on_close):
         LOG.entry('_MQLightSocket.__init__', NO_CLIENT_ID)
+        self.on_read = on_read
+        self.on_close = on_close
         err = None
         verify = security_options.ssl_verify_name
         if 'bad' in address[0]:
@@ -0,0 +1,227 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+A single thread that runs the timed work of every client in the process, and
+a worker for each client that runs timed work that can block
+"""
+from __future__ import absolute_import
+import collections
+import heapq
+import itertools
+import os
+import threading
+import time
+from .logging import get_logger, NO_CLIENT_ID
+
+LOG = get_logger(__name__)
+
+
+class TimerHandle(object):
+
+    """
+    A function scheduled to run after a delay, which can be cancelled
+    """
+    __slots__ = ('when', '_func', '_args', '_cancelled', '_done')
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self._func = func
+        self._args = args
+        self._cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        """
+        Stops the function from running, if it has not already started
+        """
+        self._cancelled = True
+        self._done.set()
+
+    def cancelled(self):
+        """
+        Returns True if the timer has been cancelled
+        """
+        return self._cancelled
+
+    def join(self, timeout=None):
+        """
+        Waits until the function has run, or the timer has been cancelled.
+        Returns straight away if called from the function itself.
+        """
+        if threading.current_thread() is not _SCHEDULER_THREAD[0]:
+            self._done.wait(timeout)
+
+    def _run(self):
+        """
+        Runs the function, unless the timer has been cancelled
+        """
+        if self._cancelled:
+            return
+        try:
+            self._func(*self._args)
+        except Exception as err:
+            LOG.error('TimerHandle._run', NO_CLIENT_ID, err)
+        finally:
+            self._done.set()
+
+
+class Scheduler(object):
+
+    """
+    Runs scheduled functions in time order on a single daemon thread, so that
+    the number of threads used for timed work does not grow with the number
+    of timers. Scheduled functions must not block for long, as they hold up
+    every other timer in the process.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # breaks ties between timers due at the same time, keeping them in
+        # the order they were scheduled
+        self._sequence = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(
+            target=self._run,
+            name='mqlight-timer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, delay, func, args=None):
+        """
+        Runs func(*args) after delay seconds.
+
+        :returns: a TimerHandle that can be used to cancel the call.
+        """
+        handle = TimerHandle(time.time() + delay, func, args or ())
+        with self._condition:
+            heapq.heappush(
+                self._heap,
+                (handle.when, next(self._sequence), handle))
+            # Wake the thread if this is now the first timer due
+            if self._heap[0][2] is handle:
+                self._condition.notify()
+        return handle
+
+    def pending(self):
+        """
+        Returns the number of timers waiting to run, including any that have
+        been cancelled but not yet discarded
+        """
+        with self._condition:
+            return len(self._heap)
+
+    def _run(self):
+        """
+        The body of the timer thread
+        """
+        _SCHEDULER_THREAD[0] = threading.current_thread()
+        while True:
+            with self._condition:
+                while True:
+                    # Discard cancelled timers without waiting for them
+                    while self._heap and self._heap[0][2].cancelled():
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        handle = heapq.heappop(self._heap)[2]
+                        break
+                    self._condition.wait(delay)
+            handle._run()
+
+
+class Worker(object):
+
+    """
+    Runs the functions posted to it one at a time, in the order they were
+    posted, on a thread that is started when work is posted and exits once
+    there is none left. Timers post work that can block, such as connecting
+    or calling the application, to a worker rather than running it on the
+    timer thread, so that however many timers fire, each worker uses at most
+    one thread.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._work = collections.deque()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def post(self, func, *args):
+        """
+        Runs func(*args) on the worker's thread, once the functions posted
+        before it have run
+        """
+        with self._lock:
+            self._work.append((func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def is_current(self):
+        """
+        Returns True if called from a function run by the worker
+        """
+        return threading.current_thread() is self._thread
+
+    def _run(self):
+        """
+        The body of the worker's thread
+        """
+        while True:
+            with self._lock:
+                if not self._work:
+                    self._thread = None
+                    return
+                func, args = self._work.popleft()
+            try:
+                func(*args)
+            except Exception as err:
+                LOG.error('Worker._run', NO_CLIENT_ID, err)
+
+
+# The scheduler for the process, and the id of the process that created it.
+# A child process created by fork() does not inherit the thread of its
+# parent's scheduler, so it creates its own.
+_SCHEDULER = [None, None]
+_SCHEDULER_THREAD = [None]
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Returns the Scheduler for the process, creating it when first needed
+    """
+    pid = os.getpid()
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER[0] is None or _SCHEDULER[1] != pid:
+            _SCHEDULER[0] = Scheduler()
+            _SCHEDULER[1] = pid
+        return _SCHEDULER[0]
+
+
+def call_later(delay, func, args=None):
+    """
+    Runs func(*args) on the timer thread after delay seconds.
+
+    :returns: a TimerHandle that can be used to cancel the call.
+    """
+    return get_scheduler().schedule(delay, func, args)
@@ -0,0 +1,290 @@
+# <copyright
+# notice="lm-source-program"
+# pids="5725-P60"
+# years="2013,2015"
+# crc="3568777996" >
+# Licensed Materials - Property of IBM
+#
+# 5725-P60
+#
+# (C) Copyright IBM Corp. 2013, 2015
+#
+# US Government Users Restricted Rights - Use, duplication or
+# disclosure restricted by GSA ADP Schedule Contract with
+# IBM Corp.
+# </copyright>
+"""
+An always on, fixed size, in memory record of what the client has recently
+done, which is written to a file when an FFDC is generated
+"""
+from __future__ import absolute_import
+import collections
+import itertools
+import os
+import struct
+import tempfile
+import threading
+import time
+try:
+    from thread import get_ident
+except ImportError:
+    from threading import get_ident
+
+# Set the number of trace records kept. By default the last 65536 records are
+# kept, but this can be altered by setting the environment variable
+# MQLIGHT_PYTHON_TRACE_SIZE to a different number, which is rounded up to a
+# power of two. Setting it to 0 turns tracing off.
+DEFAULT_TRACE_SIZE = 65536
+
+# Set the number of trace dumps that a process keeps. Once a process has
+# written this many, each new dump replaces its oldest. The default of 10
+# can be altered by setting the environment variable
+# MQLIGHT_PYTHON_TRACE_DUMPS.
+DEFAULT_MAX_DUMPS = 10
+
+# Event codes
+STATE = 1
+CONNECT = 2
+DISCONNECT = 3
+READ = 4
+WRITE = 5
+SEND = 6
+MESSAGE = 7
+SETTLE = 8
+SUBSCRIBE = 9
+UNSUBSCRIBE = 10
+ERROR = 11
+
+EVENTS = {
+    STATE: 'STATE',
+    CONNECT: 'CONNECT',
+    DISCONNECT: 'DISCONNECT',
+    READ: 'READ',
+    WRITE: 'WRITE',
+    SEND: 'SEND',
+    MESSAGE: 'MESSAGE',
+    SETTLE: 'SETTLE',
+    SUBSCRIBE: 'SUBSCRIBE',
+    UNSUBSCRIBE: 'UNSUBSCRIBE',
+    ERROR: 'ERROR'
+}
+
+_MAGIC = b'MQLTRACE'
+_VERSION = 1
+_HEADER = struct.Struct('<8sHII')
+_RECORD = struct.Struct('<QdQHIqq')
+_LENGTH = struct.Struct('<H')
+_pack_record = _RECORD.pack_into
+
+
+class TraceBuffer(object):
+
+    """
+    A ring buffer of compact trace records, held in a preallocated bytearray
+    of fixed size slots laid out as they are written to a dump. Each record
+    holds a sequence number, a timestamp, the thread, an event code, the
+    index of the client id in a table of the client ids seen, and two
+    integers whose meaning depends on the event. Recording takes no lock and
+    builds no record object: the sequence number is claimed atomically and
+    the record is packed straight into its slot, so the oldest records are
+    overwritten without any bookkeeping.
+    """
+
+    def __init__(self, size=DEFAULT_TRACE_SIZE, max_dumps=DEFAULT_MAX_DUMPS):
+        if size > 0:
+            size = 1 << (size - 1).bit_length()
+        self._size = max(size, 0)
+        self._mask = size - 1
+        self._slots = bytearray(_RECORD.size * self._size)
+        # Sequence numbers start at 1 so that an empty slot, which is all
+        # zeros, can be told apart
+        self._sequence = itertools.count(1)
+        self._clients = {}
+        self._client_ids = []
+        self._clients_lock = threading.Lock()
+        self._max_dumps = max_dumps
+        self._dumps = collections.deque()
+
+    def record(self, event, client_id, arg1=0, arg2=0):
+        """
+        Records an event
+        """
+        if self._size:
+            sequence = next(self._sequence)
+            client = self._clients.get(client_id)
+            if client is None:
+                client = self._add_client(client_id)
+            offset = (sequence & self._mask) * _RECORD.size
+            try:
+                _pack_record(
+                    self._slots, offset, sequence, time.time(), get_ident(),
+                    event, client, arg1, arg2)
+            except (struct.error, TypeError):
+                # arguments that are not integers, or are too large
+                _pack_record(
+                    self._slots, offset, sequence, time.time(),
+                    get_ident() & 0xFFFFFFFFFFFFFFFF, event, client,
+                    _int(arg1), _int(arg2))
+
+    def _add_client(self, client_id):
+        """
+        Adds a client id to the table of client ids, returning its index
+        """
+        with self._clients_lock:
+            client = self._clients.get(client_id)
+            if client is None:
+                client = len(self._client_ids)
+                self._client_ids.append(str(client_id))
+                self._clients[client_id] = client
+        return client
+
+    def snapshot(self):
+        """
+        Returns the records held, oldest first, as (sequence, timestamp,
+        thread, event, client_id, arg1, arg2) tuples
+        """
+        slots = bytes(self._slots)
+        # Copied after the slots, as a client id is always added before the
+        # records that refer to it
+        client_ids = list(self._client_ids)
+        records = []
+        for offset in range(0, len(slots), _RECORD.size):
+            record = _RECORD.unpack_from(slots, offset)
+            if record[0]:
+                records.append(
+                    (record[0] - 1,) + record[1:4] +
+                    (client_ids[record[4]],) + record[5:])
+        records.sort()
+        return records
+
+    def dump(self, directory=None):
+        """
+        Writes the records held to a new file in directory, returning the
+        path of the file. By default the file is written to the directory
+        named by the environment variable MQLIGHT_PYTHON_TRACE_DIR, or the
+        temporary directory if it is not set. The file is created with a
+        name that cannot be guessed, and only the owner can read it. Once
+        max_dumps files have been written, the oldest is removed.
+        """
+        records = self.snapshot()
+        if directory is None:
+            directory = os.getenv(
+                'MQLIGHT_PYTHON_TRACE_DIR',
+                tempfile.gettempdir())
+        clients = {}
+        for record in records:
+            clients.setdefault(record[4], len(clients))
+        handle, path = tempfile.mkstemp(
+            suffix='.bin',
+            prefix='mqlight-trace-{0}-'.format(os.getpid()),
+            dir=directory)
+        with os.fdopen(handle, 'wb') as file_obj:
+            file_obj.write(_HEADER.pack(
+                _MAGIC, _VERSION, len(clients), len(records)))
+            for client_id in sorted(clients, key=clients.get):
+                encoded = client_id.encode('utf-8')
+                file_obj.write(_LENGTH.pack(len(encoded)))
+                file_obj.write(encoded)
+            for sequence, when, thread, event, client_id, arg1, arg2 in \
+                    records:
+                file_obj.write(_RECORD.pack(
+                    sequence, when, thread, event, clients[client_id], arg1,
+                    arg2))
+        self._dumps.append(path)
+        while len(self._dumps) > self._max_dumps:
+            try:
+                os.remove(self._dumps.popleft())
+            except OSError:
+                pass
+        return path
+
+
+def _int(value):
+    """
+    Returns value as an integer that fits in a trace record, or 0 if it is
+    not a number
+    """
+    try:
+        return max(min(int(value), 0x7FFFFFFFFFFFFFFF), -0x8000000000000000)
+    except (TypeError, ValueError):
+        return 0
+
+
+def read_dump(path):
+    """
+    Reads a trace dump, returning a list of (sequence, timestamp, thread,
+    event, client_id, arg1, arg2) tuples, oldest first
+    """
+    with open(path, 'rb') as file_obj:
+        magic, version, client_count, record_count = _HEADER.unpack(
+            file_obj.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('{0} is not a trace dump'.format(path))
+        clients = []
+        for _ in range(client_count):
+            length = _LENGTH.unpack(file_obj.read(_LENGTH.size))[0]
+            clients.append(file_obj.read(length).decode('utf-8'))
+        records = []
+        for _ in range(record_count):
+            sequence, when, thread, event, client, arg1, arg2 = \
+                _RECORD.unpack(file_obj.read(_RECORD.size))
+            records.append(
+                (sequence, when, thread, event, clients[client], arg1, arg2))
+    return records
+
+
+def format_dump(path):
+    """
+    Returns the records in a trace dump as lines of text
+    """
+    return [
+        '{0} {1:.6f} {2:x} {3} {4} {5} {6}'.format(
+            sequence, when, thread, EVENTS.get(event, event), client_id,
+            arg1, arg2)
+        for sequence, when, thread, event, client_id, arg1, arg2 in
+        read_dump(path)]
+
+
+def _trace_size():
+    """
+    Returns the number of trace records to keep
+    """
+    try:
+        return max(int(os.getenv(
+            'MQLIGHT_PYTHON_TRACE_SIZE',
+            DEFAULT_TRACE_SIZE)), 0)
+    except ValueError:
+        return DEFAULT_TRACE_SIZE
+
+
+def _max_dumps():
+    """
+    Returns the number of trace dumps to keep
+    """
+    try:
+        return max(int(os.getenv(
+            'MQLIGHT_PYTHON_TRACE_DUMPS',
+            DEFAULT_MAX_DUMPS)), 1)
+    except ValueError:
+        return DEFAULT_MAX_DUMPS
+
+
+# The trace buffer for the process
+TRACE = TraceBuffer(_trace_size(), _max_dumps())
+_DUMP_LOCK = threading.Lock()
+
+
+# Records an event in the trace buffer for the process, called as
+# record(event, client_id, arg1=0, arg2=0)
+record = TRACE.record
+
+
+def dump():
+    """
+    Writes the trace buffer for the process to a file, returning the path of
+    the file, or None if tracing is off
+    """
+    if not TRACE._size:
+        return None
+    with _DUMP_LOCK:
+        return TRACE.dump()
@@ -0,0 +1,43 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=invalid-name
+import os
+import shutil
+import tempfile
+import pytest
+
+
+@pytest.fixture(scope='session', autouse=True)
+def trace_dir(request):
+    """
+    Writes the trace dumps of any FFDCs generated by the tests to a
+    temporary directory, which is removed once the tests have run
+    """
+    directory = tempfile.mkdtemp()
+    previous = os.environ.get('MQLIGHT_PYTHON_TRACE_DIR')
+    os.environ['MQLIGHT_PYTHON_TRACE_DIR'] = directory
+
+    def remove():
+        """restores the environment and removes the dumps"""
+        if previous is None:
+            os.environ.pop('MQLIGHT_PYTHON_TRACE_DIR', None)
+        else:
+            os.environ['MQLIGHT_PYTHON_TRACE_DIR'] = previous
+        shutil.rmtree(directory, ignore_errors=True)
+    request.addfinalizer(remove)
+    return directory
@@ -0,0 +1,221 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import pytest
+from mock import Mock
+import mqlight
+from mqlight.exceptions import NetworkError
+
+
+class TestConfirmAll(object):
+
+    """
+    Unit tests for client.confirm_all()
+    """
+    TEST_TIMEOUT = 10.0
+
+    @staticmethod
+    def _subscription(credit, max_prefetch_bytes=None):
+        """builds the client's record of a subscription"""
+        return {
+            'credit': credit,
+            'unconfirmed': 0,
+            'confirmed': 0,
+            'pull': False,
+            'link_credit': 0,
+            'max_prefetch_bytes': max_prefetch_bytes,
+            'held_bytes': 0,
+            'average_size': 0,
+            'lock': threading.Lock()
+        }
+
+    @staticmethod
+    def _message(client):
+        """builds a message received by the client"""
+        msg = Mock()
+        msg.connection_id = client._connection_id
+        msg.address = 'amqp://host:5672/foo'
+        msg.link_address = 'private:/foo'
+        msg.ttl = 0
+        return msg
+
+    def _deliveries(self, client, subscription, count, size=0):
+        """builds deliveries that require confirmation"""
+        deliveries = []
+        for _ in range(count):
+            subscription['unconfirmed'] += 1
+            subscription['held_bytes'] += size
+            if size:
+                subscription['average_size'] = size
+            deliveries.append(mqlight.Delivery(
+                client, subscription, self._message(client), size, True))
+        return deliveries
+
+    def test_confirm_all_argument_must_be_a_list(self):
+        """
+        Test that client.confirm_all(...) only accepts a list of deliveries
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            with pytest.raises(TypeError):
+                client.confirm_all('delivery')
+            with pytest.raises(TypeError):
+                client.confirm_all([1, 2])
+            assert client.confirm_all([]) == client
+            with pytest.raises(TypeError):
+                client.confirm_all([{'message': {'topic': '/a'}}])
+            delivery = mqlight.Delivery(
+                client, self._subscription(10), self._message(client), 0,
+                False)
+            assert client.confirm_all([delivery]) == client
+            client.stop()
+            test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_confirm_all_argument_must_be_a_list',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_confirm_all_single_write(self):
+        """
+        Test that confirming a batch of deliveries settles every message, but
+        only flows credit and writes to the network once
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            subscription = self._subscription(10)
+            deliveries = self._deliveries(client, subscription, 10)
+            messenger = client._messenger
+            client._messenger = Mock()
+            try:
+                client.confirm_all(deliveries)
+                assert client._messenger.settle.call_count == 10
+                for call in client._messenger.settle.call_args_list:
+                    assert call[0][2] is False
+                assert client._messenger.flow.call_count == 1
+                assert client._messenger.flow.call_args[0][1] == 10
+                assert client._messenger.pop.call_count == 1
+                assert subscription['unconfirmed'] == 0
+
+                # confirming again is a no-op
+                client._messenger.reset_mock()
+                client.confirm_all(deliveries)
+                deliveries[0].confirm()
+                assert client._messenger.settle.call_count == 0
+            finally:
+                client._messenger = messenger
+            client.stop()
+            test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_confirm_all_single_write',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_confirm_all_prefetch_bytes(self):
+        """
+        Test that confirming deliveries for a subscription with a byte budget
+        flows the credit that the budget allows
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            subscription = self._subscription(1024, 1000)
+            deliveries = self._deliveries(client, subscription, 10, 100)
+            messenger = client._messenger
+            client._messenger = Mock()
+            try:
+                # 600 bytes are still held, so only 4 more 100 byte
+                # messages fit into the budget
+                client.confirm_all(deliveries[:4])
+                assert subscription['held_bytes'] == 600
+                assert client._messenger.flow.call_args[0][1] == 4
+                assert subscription['link_credit'] == 4
+
+                # with the budget used up, no more credit is flowed until
+                # messages are confirmed
+                client._messenger.reset_mock()
+                subscription['held_bytes'] += 400
+                client.confirm_all(deliveries[4:5])
+                assert client._messenger.flow.call_count == 0
+            finally:
+                client._messenger = messenger
+            client.stop()
+            test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_confirm_all_prefetch_bytes',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_confirm_all_after_reconnect(self):
+        """
+        Test that a batch containing a message received before a reconnect is
+        rejected without settling any of the messages
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            subscription = self._subscription(10)
+            deliveries = self._deliveries(client, subscription, 3)
+            deliveries[2]._msg.connection_id -= 1
+            messenger = client._messenger
+            client._messenger = Mock()
+            try:
+                with pytest.raises(NetworkError):
+                    client.confirm_all(deliveries)
+                assert client._messenger.settle.call_count == 0
+            finally:
+                client._messenger = messenger
+            client.stop()
+            test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_confirm_all_after_reconnect',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_confirm_all_when_stopped(self):
+        """
+        Test that confirming deliveries while the client is stopped raises
+        NetworkError
+        """
+        test_is_done = threading.Event()
+
+        def stopped(client):
+            """stopped listener"""
+            with pytest.raises(NetworkError):
+                client.confirm_all([])
+            test_is_done.set()
+
+        def started(client):
+            """started listener"""
+            client.stop(stopped)
+        client = mqlight.Client('amqp://host',
+                                'test_confirm_all_when_stopped',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
@@ -20,6 +20,7 @@ IBM Corp.
 import unittest
 import pytest
 import threading
+import time
 from mock import Mock, patch
 import re
 import inspect
@@ -462,5 +463,58 @@ class TestCreateClient(object):
         test_is_done.wait(self.TEST_TIMEOUT)
         assert test_is_done.is_set()
 
+    def test_standby(self):
+        """
+        Test that a client with standby set keeps a spare connection to the
+        next service, and fails over to it when reconnecting
+        """
+        started_event = threading.Event()
+        restarted_event = threading.Event()
+        services = ['amqp://host1:5672', 'amqp://host2:5672']
+        result = {}
+
+        def wait_for_standby(client, address):
+            """waits for the standby connection to be open to address"""
+            deadline = time.time() + self.TEST_TIMEOUT
+            while client._standby.ready() != address and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            return client._standby.ready()
+
+        def started(client):
+            """started listener"""
+            started_event.set()
+
+        def state_changed(client, state, err):
+            """state listener"""
+            if state == mqlight.RESTARTED and not restarted_event.is_set():
+                result['sock'] = client._sock
+                result['service'] = client.get_service()
+                restarted_event.set()
+
+        with pytest.raises(TypeError):
+            mqlight.Client(services, standby='yes')
+        client = mqlight.Client(services,
+                                'test_standby',
+                                on_started=started,
+                                on_state_changed=state_changed,
+                                standby=True)
+        try:
+            assert started_event.wait(self.TEST_TIMEOUT)
+            assert wait_for_standby(client, ('host2', 5672)) == \
+                ('host2', 5672)
+            spare = client._standby._sock
+            client._reconnect()
+            assert restarted_event.wait(self.TEST_TIMEOUT)
+            assert result['sock'] is spare
+            assert result['service'] == services[1]
+            assert wait_for_standby(client, ('host1', 5672)) == \
+                ('host1', 5672)
+        finally:
+            stopped = threading.Event()
+            client.stop(lambda *args: stopped.set())
+            stopped.wait(self.TEST_TIMEOUT)
+        assert client._standby.ready() is None
+
 if __name__ == 'main':
     unittest.main()
@@ -0,0 +1,126 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import pytest
+from mock import Mock
+import mqlight
+from mqlight import DuplicateFilter
+from mqlight.exceptions import InvalidArgumentError, RangeError
+
+
+def _message(body, message_id=None, topic='/foo'):
+    """builds a received message for the private subscription to topic"""
+    msg = Mock()
+    msg.body = body
+    msg.message_id = message_id
+    msg.address = 'amqp://host:5672/' + topic
+    msg.link_address = 'private:' + topic
+    msg.ttl = 0
+    msg.annotations = {}
+    return msg
+
+
+class TestDedup(object):
+
+    """
+    Unit tests for DuplicateFilter and the dedup subscribe option
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_dedup_arguments(self):
+        """
+        Test that invalid capacity values raise RangeError
+        """
+        for capacity in (0, -1, 'abc', None):
+            with pytest.raises(RangeError):
+                DuplicateFilter(capacity)
+
+    def test_dedup_keys(self):
+        """
+        Test that messages are keyed by their message id and their topic
+        """
+        key = DuplicateFilter.message_key
+        assert key('id1', '/a') == key('id1', '/a')
+        assert key('id1', '/a') != key('id2', '/a')
+        assert key('id1', '/a') != key('id1', '/b')
+        assert key(u'id1', '/a') == key('id1', '/a')
+        assert key(1, '/a') == key('1', '/a')
+
+    def test_dedup_window(self):
+        """
+        Test that duplicates are detected within the capacity of the filter,
+        and that the statistics are updated
+        """
+        dedup = DuplicateFilter(100)
+        keys = [DuplicateFilter.message_key(str(i), '/a')
+                for i in range(300)]
+        for key in keys:
+            assert not dedup.check(key)
+        # only the last 100 keys are remembered
+        for key in keys[-100:]:
+            assert dedup.check(key)
+        stats = dedup.stats()
+        assert stats['checked'] == 400
+        assert stats['duplicates'] == 100
+        assert stats['hit_rate'] == 0.25
+        assert stats['size'] == 100
+        dedup.forget(keys[-1])
+        assert not dedup.check(keys[-1])
+
+    def test_dedup_drops_duplicates(self):
+        """
+        Test that a subscription with the dedup option settles duplicate
+        messages without passing them to on_message, and that different
+        messages with the same body are all delivered
+        """
+        test_is_done = threading.Event()
+        dedup = DuplicateFilter(10)
+        on_message = Mock()
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                try:
+                    messenger = client._messenger
+                    client._messenger = Mock()
+                    client._process_message(_message('one', 'id1'))
+                    client._process_message(_message('one', 'id1'))
+                    client._process_message(_message('one', 'id2'))
+                    client._process_message(_message('two'))
+                    client._process_message(_message('two'))
+                    assert [c[0][1] for c in on_message.call_args_list] == \
+                        ['one', 'one', 'two', 'two']
+                    # every message is settled, including the duplicate
+                    assert client._messenger.settle.call_count == 5
+                    assert dedup.stats()['duplicates'] == 1
+                finally:
+                    client._messenger = messenger
+                    client.stop()
+                    test_is_done.set()
+            with pytest.raises(InvalidArgumentError):
+                client.subscribe('/foo', options={'dedup': dedup})
+            client.subscribe('/foo', options={'dedup': dedup, 'qos': 1},
+                             on_subscribed=subscribed, on_message=on_message)
+        client = mqlight.Client('amqp://host',
+                                'test_dedup_drops_duplicates',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
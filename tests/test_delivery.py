@@ -0,0 +1,106 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import pytest
+from mock import Mock
+from mqlight import Delivery
+
+
+def _message(link_address, ttl=0):
+    """builds a received message"""
+    msg = Mock()
+    msg.address = 'amqp://host:5672/kittens/fluffy'
+    msg.link_address = link_address
+    msg.ttl = ttl
+    return msg
+
+
+class TestDelivery(object):
+
+    """
+    Unit tests for the Delivery passed to on_message
+    """
+
+    def test_delivery_private(self):
+        """
+        Test the values of a delivery for a private subscription
+        """
+        delivery = Delivery(Mock(), {}, _message('private:kittens/+'), 0,
+                            False)
+        assert delivery.topic == 'kittens/fluffy'
+        assert delivery.share is None
+        assert delivery.topic_pattern == 'kittens/+'
+        assert delivery.ttl is None
+        assert not delivery.requires_confirmation
+        # the message is not held on to when there is nothing to confirm
+        assert delivery._msg is None
+        with pytest.raises(AttributeError):
+            delivery.extra = True
+
+    def test_delivery_dictionary_access(self):
+        """
+        Test that a delivery can still be used as the dictionary passed to
+        on_message by earlier versions of the client
+        """
+        delivery = Delivery(Mock(), {}, _message('share:cats:kittens/#', 10),
+                            0, False)
+        assert delivery['message'] == {'topic': 'kittens/fluffy', 'ttl': 10}
+        assert delivery['destination'] == {
+            'share': 'cats',
+            'topic_pattern': 'kittens/#'
+        }
+        assert delivery['destination']['share'] == 'cats'
+        assert 'confirm_delivery' not in delivery['message']
+        assert delivery['message'].get('confirm_delivery') is None
+        assert 'malformed' not in delivery
+        with pytest.raises(KeyError):
+            delivery['malformed']
+        assert sorted(delivery.keys()) == ['destination', 'message']
+
+        malformed = {'condition': 'bad', 'MQMD': {}}
+        delivery = Delivery(Mock(), {}, _message('private:kittens'), 0,
+                            False, malformed)
+        assert delivery['malformed'] == malformed
+
+    def test_delivery_confirm(self):
+        """
+        Test that confirming a delivery, directly or through the
+        confirm_delivery entry, asks the client to settle the message
+        """
+        client = Mock()
+        delivery = Delivery(client, {}, _message('private:kittens'), 0, True)
+        assert delivery.requires_confirmation
+        assert not delivery.confirmed
+        delivery.confirm()
+        client._confirm_deliveries.assert_called_once_with([delivery])
+        delivery['message']['confirm_delivery']()
+        assert client._confirm_deliveries.call_count == 2
+
+    def test_delivery_settled(self):
+        """
+        Test that a delivery holds its message only until it is settled
+        """
+        subscription = {}
+        msg = _message('private:kittens')
+        delivery = Delivery(Mock(), subscription, msg, 42, True)
+        assert delivery._pending() is msg
+        assert delivery._settled() == (subscription, 'private:kittens', 42)
+        assert delivery.confirmed
+        assert delivery._pending() is None
+        assert Delivery(Mock(), {}, msg, 0, False)._pending() is None
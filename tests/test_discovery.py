@@ -0,0 +1,242 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse
+import pytest
+from mock import patch
+from mqlight.discovery import _HTTPServiceSource, _FileServiceSource, \
+    _ServiceDiscovery
+from mqlight.exceptions import MQLightError, NetworkError
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Serves a service list, with an ETag, over keep-alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+    body = json.dumps({'service': ['amqp://host1', 'amqp://host2']})
+    etag = '"v1"'
+    requests = []
+    connections = []
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        _Handler.connections.append(self.client_address)
+
+    def do_GET(self):
+        """handles a GET"""
+        _Handler.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == _Handler.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', _Handler.etag)
+        self.send_header('Content-Length', str(len(_Handler.body)))
+        self.end_headers()
+        self.wfile.write(_Handler.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """
+    Handles each connection on its own thread, so that a kept open
+    connection does not stop the server shutting down
+    """
+    daemon_threads = True
+
+
+class _Source(object):
+
+    """
+    A discovery source that returns a fixed list, or raises an error, after
+    an optional wait
+    """
+
+    def __init__(self, service=None, error=None, wait=None):
+        self.service = service
+        self.error = error
+        self.wait = wait
+        self.calls = 0
+
+    def fetch(self):
+        """returns the service list"""
+        self.calls += 1
+        if self.wait:
+            self.wait.wait()
+        if self.error:
+            raise self.error
+        return self.service
+
+
+class TestDiscovery(object):
+
+    """
+    Unit tests for the cached service discovery sources
+    """
+    TEST_TIMEOUT = 10.0
+
+    def _server(self):
+        """starts an HTTP server for the test"""
+        _Handler.requests = []
+        _Handler.connections = []
+        server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{0}/services'.format(server.server_port)
+        return server, url
+
+    def test_http_cache(self):
+        """
+        Test that the service list is cached for the TTL, then revalidated
+        with a conditional GET over the same connection
+        """
+        server, url = self._server()
+        source = _HTTPServiceSource(url, urlparse(url), ttl=60)
+        try:
+            assert source.fetch() == ['amqp://host1', 'amqp://host2']
+            assert source.fetch() == ['amqp://host1', 'amqp://host2']
+            assert _Handler.requests == [None]
+            source._expires = 0
+            assert source.fetch() == ['amqp://host1', 'amqp://host2']
+            assert _Handler.requests == [None, '"v1"']
+            assert len(_Handler.connections) == 1
+        finally:
+            source._close()
+            server.shutdown()
+            server.server_close()
+
+    def test_http_stale_on_error(self):
+        """
+        Test that the last service list fetched is used when the server can
+        no longer be reached, and that an error is raised if there is none
+        """
+        server, url = self._server()
+        source = _HTTPServiceSource(url, urlparse(url), ttl=0, timeout=1)
+        try:
+            assert source.fetch() == ['amqp://host1', 'amqp://host2']
+        finally:
+            source._close()
+            server.shutdown()
+            server.server_close()
+        assert source.fetch() == ['amqp://host1', 'amqp://host2']
+        with pytest.raises(NetworkError):
+            _HTTPServiceSource(url, urlparse(url), timeout=1).fetch()
+
+    def test_file_cache(self):
+        """
+        Test that a file is only parsed again once it has changed
+        """
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'services.json')
+        try:
+            with open(path, 'w') as file_obj:
+                json.dump({'service': ['amqp://host1']}, file_obj)
+            source = _FileServiceSource(path)
+            with patch('mqlight.discovery.loads', wraps=json.loads) as loads:
+                assert source.fetch() == ['amqp://host1']
+                assert source.fetch() == ['amqp://host1']
+                assert loads.call_count == 1
+                with open(path, 'w') as file_obj:
+                    json.dump({'service': ['amqp://host1', 'amqp://host2']},
+                              file_obj)
+                assert source.fetch() == ['amqp://host1', 'amqp://host2']
+                assert loads.call_count == 2
+            os.remove(path)
+            with pytest.raises(MQLightError):
+                source.fetch()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_parallel_deadline(self):
+        """
+        Test that the lists from every source are merged, ranking the
+        services listed by the most sources first, that a source can return
+        a single service, and that a source that does not respond before the
+        deadline is left out
+        """
+        hung = threading.Event()
+        try:
+            discovery = _ServiceDiscovery([
+                _Source(['amqp://a', 'amqp://b']),
+                _Source(error=NetworkError('down')),
+                _Source(['amqp://c', 'amqp://b']),
+                _Source(['amqp://d'], wait=hung)], deadline=0.5)
+            start = time.time()
+            assert discovery.fetch() == ['amqp://b', 'amqp://a', 'amqp://c']
+            assert time.time() - start < 5
+        finally:
+            hung.set()
+
+        discovery = _ServiceDiscovery([
+            _Source('amqp://b'),
+            _Source(['amqp://a', 'amqp://b'])])
+        assert discovery.fetch() == ['amqp://b', 'amqp://a']
+
+        discovery = _ServiceDiscovery([
+            _Source(error=NetworkError('down')),
+            _Source(error=NetworkError('also down'))])
+        with pytest.raises(NetworkError):
+            discovery.fetch()
+
+    def test_background_refresh(self):
+        """
+        Test that the service function returns the list already fetched,
+        which is refreshed in the background until it is stopped, and again
+        once the service function is next called
+        """
+        source = _Source(['amqp://a'])
+        discovery = _ServiceDiscovery([source], refresh_interval=0.1)
+        results = []
+        discovery(lambda err, service: results.append((err, service)))
+        assert results == [(None, ['amqp://a'])]
+        source.service = ['amqp://b']
+        deadline = time.time() + self.TEST_TIMEOUT
+        while discovery._service != ['amqp://b'] and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        discovery(lambda err, service: results.append((err, service)))
+        assert results[1] == (None, ['amqp://b'])
+        discovery.stop()
+        time.sleep(0.2)
+        calls = source.calls
+        time.sleep(0.3)
+        assert source.calls == calls
+        # refreshing starts again when the list is next used
+        discovery(lambda err, service: results.append((err, service)))
+        assert discovery._refresh_timer is not None
+        deadline = time.time() + self.TEST_TIMEOUT
+        while source.calls == calls and time.time() < deadline:
+            time.sleep(0.05)
+        assert source.calls > calls
+        discovery.stop()
@@ -0,0 +1,139 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import time
+import pytest
+from mock import Mock
+import mqlight
+from mqlight import KeyedDispatcher
+from mqlight.exceptions import InvalidArgumentError, RangeError, \
+    StoppedError
+
+
+def _message(body, topic='/foo'):
+    """builds a received message for the private subscription to /foo"""
+    msg = Mock()
+    msg.body = body
+    msg.address = 'amqp://host:5672/' + topic
+    msg.link_address = 'private:/foo'
+    msg.ttl = 0
+    msg.annotations = {}
+    return msg
+
+
+class TestDispatch(object):
+
+    """
+    Unit tests for KeyedDispatcher and the dispatcher subscribe option
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_dispatch_arguments(self):
+        """
+        Test that invalid key functions and numbers of workers are rejected
+        """
+        with pytest.raises(TypeError):
+            KeyedDispatcher('not a function')
+        for workers in (0, -1, 'abc'):
+            with pytest.raises(RangeError):
+                KeyedDispatcher(Mock(), workers)
+
+    def test_dispatch_order(self):
+        """
+        Test that messages with the same key are handled in order, and that
+        messages with different keys are handled at the same time
+        """
+        dispatcher = KeyedDispatcher(lambda topic, data: topic, 2)
+        handled = {'a': [], 'b': []}
+        # Block the first message for 'a' until a message for 'b' has been
+        # handled, which can only happen if they run on different threads
+        b_done = threading.Event()
+
+        def handle(topic, index):
+            """records the order that messages are handled"""
+            if topic == 'a' and index == 0:
+                b_done.wait(self.TEST_TIMEOUT)
+            handled[topic].append(index)
+            if topic == 'b':
+                b_done.set()
+
+        # find two keys that map to different threads
+        assert hash('a') % 2 != hash('b') % 2
+        for index in range(5):
+            dispatcher.dispatch('a', None, handle, ('a', index))
+        dispatcher.dispatch('b', None, handle, ('b', 0))
+        assert dispatcher.stop(self.TEST_TIMEOUT)
+        assert handled['a'] == [0, 1, 2, 3, 4]
+        assert handled['b'] == [0]
+        with pytest.raises(StoppedError):
+            dispatcher.dispatch('a', None, handle, ('a', 5))
+
+    def test_dispatch_subscribe(self):
+        """
+        Test that a subscription with a dispatcher calls on_message on the
+        dispatcher's threads, and only settles messages once on_message has
+        returned
+        """
+        test_is_done = threading.Event()
+        dispatcher = KeyedDispatcher(lambda topic, data: data, 4)
+        threads = set()
+        release = threading.Event()
+
+        def on_message(message_type, data, delivery):
+            """message listener"""
+            threads.add(threading.current_thread().name)
+            release.wait(self.TEST_TIMEOUT)
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                messenger = client._messenger
+                client._messenger = Mock()
+                try:
+                    client._process_message(_message('one'))
+                    client._process_message(_message('two'))
+                    time.sleep(0.1)
+                    assert client._messenger.settle.call_count == 0
+                    release.set()
+                    deadline = time.time() + self.TEST_TIMEOUT
+                    while client._messenger.settle.call_count < 2 and \
+                            time.time() < deadline:
+                        time.sleep(0.01)
+                    assert client._messenger.settle.call_count == 2
+                    assert all(name.startswith('mqlight-dispatch')
+                               for name in threads)
+                finally:
+                    client._messenger = messenger
+                    client.stop()
+                    dispatcher.stop()
+                    test_is_done.set()
+            with pytest.raises(TypeError):
+                client.subscribe('/bar', options={'dispatcher': 'threads'})
+            with pytest.raises(InvalidArgumentError):
+                client.subscribe('/bar', options={'dispatcher': dispatcher,
+                                                  'pull': True})
+            client.subscribe('/foo', options={'dispatcher': dispatcher},
+                             on_subscribed=subscribed, on_message=on_message)
+        client = mqlight.Client('amqp://host',
+                                'test_dispatch_subscribe',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
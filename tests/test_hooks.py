@@ -0,0 +1,92 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import pytest
+import mqlight
+from mqlight.exceptions import InvalidArgumentError
+
+
+class TestHooks(object):
+
+    """
+    Unit tests for client.add_hook() and client.remove_hook()
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_hook_arguments(self):
+        """
+        Test that hooks must be functions added at a known point, and that
+        removing the last hook leaves no hooks to check
+        """
+        test_is_done = threading.Event()
+
+        def hook(point, timestamp, client_id, details):
+            """does nothing"""
+
+        def started(client):
+            """started listener"""
+            try:
+                with pytest.raises(TypeError):
+                    client.add_hook('put', 'not a function')
+                with pytest.raises(InvalidArgumentError):
+                    client.add_hook('nowhere', hook)
+                client.add_hook('put', hook)
+                assert client._hooks
+                assert client.remove_hook('put', hook)
+                assert not client.remove_hook('put', hook)
+                assert client._hooks == {}
+            finally:
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host', 'test_hook_arguments',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_send_hooks(self):
+        """
+        Test that the send hooks are called in order, with increasing
+        timestamps and the same send id
+        """
+        test_is_done = threading.Event()
+        calls = []
+
+        def hook(point, timestamp, client_id, details):
+            """records the hook call"""
+            calls.append((point, timestamp, client_id, details))
+
+        def started(client):
+            """started listener"""
+            def sent(err, topic, data, options):
+                """send callback"""
+                client.stop()
+                test_is_done.set()
+            client.add_hook('send_enqueued', hook)
+            client.add_hook('put', hook)
+            client.send('test', 'message', on_sent=sent)
+        client = mqlight.Client('amqp://host', 'test_send_hooks',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+        assert [call[0] for call in calls] == ['send_enqueued', 'put']
+        assert calls[0][1] <= calls[1][1]
+        assert calls[0][2] == 'test_send_hooks'
+        assert calls[0][3]['send_id'] == calls[1][3]['send_id']
+        assert calls[1][3]['topic'] == 'test'
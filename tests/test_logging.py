@@ -0,0 +1,125 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import logging
+import threading
+from StringIO import StringIO
+import mqlight.logging
+from mqlight.logging import _AsyncWriter, _get_stack, DEFAULT_STACK
+
+
+class _BlockingStream(StringIO):
+
+    """
+    A stream that holds up the first write until it is released
+    """
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, text):
+        if not self.writing.is_set():
+            self.writing.set()
+            self.release.wait(TestLogging.TEST_TIMEOUT)
+        StringIO.write(self, text)
+
+
+def _record(msg):
+    """builds a log entry"""
+    return logging.makeLogRecord({'msg': msg, 'name': 'test'})
+
+
+class TestLogging(object):
+
+    """
+    Unit tests for the logging module
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_async_writer(self):
+        """
+        Test that the background writer writes log entries in order, and
+        that flush waits for them to be written
+        """
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        writer = _AsyncWriter(100)
+        for index in range(10):
+            writer.put([handler], _record('entry {0}'.format(index)))
+        writer.flush(self.TEST_TIMEOUT)
+        assert stream.getvalue().splitlines() == [
+            'entry {0}'.format(index) for index in range(10)]
+        assert writer.dropped == 0
+
+    def test_async_writer_drops(self):
+        """
+        Test that log entries are dropped, and counted, when the queue is
+        full, and that the number dropped is written to the log
+        """
+        stream = _BlockingStream()
+        handler = logging.StreamHandler(stream)
+        writer = _AsyncWriter(2)
+        writer.put([handler], _record('first'))
+        assert stream.writing.wait(self.TEST_TIMEOUT)
+        # The writer is now held up writing the first entry, so the queue
+        # fills
+        for index in range(4):
+            writer.put([handler], _record('entry {0}'.format(index)))
+        assert writer.dropped == 2
+        stream.release.set()
+        writer.flush(self.TEST_TIMEOUT)
+        assert stream.getvalue().splitlines() == [
+            'first', '2 log entries dropped', 'entry 0', 'entry 1']
+
+    def test_thread_stacks(self):
+        """
+        Test that each thread traces its own call stack, and that calls left
+        by an exception are popped with the call they were made from
+        """
+        log = mqlight.logging.get_logger('test_thread_stacks')
+        log._level = mqlight.logging.ALL
+        log._log.disabled = True
+        entered = threading.Event()
+        release = threading.Event()
+        stacks = {}
+
+        def other():
+            """traces calls on a second thread"""
+            log.entry('other', None)
+            stacks['other'] = list(_get_stack())
+            entered.set()
+            release.wait(self.TEST_TIMEOUT)
+            log.exit('other', None, None)
+            stacks['other_after'] = list(_get_stack())
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        assert entered.wait(self.TEST_TIMEOUT)
+        log.entry('outer', None)
+        log.entry('inner', None)
+        assert _get_stack() == DEFAULT_STACK + ['outer', 'inner']
+        release.set()
+        thread.join(self.TEST_TIMEOUT)
+        # inner raised, so never logged its exit
+        log.exit('outer', None, None)
+        assert _get_stack() == DEFAULT_STACK
+        assert stacks['other'] == DEFAULT_STACK + ['other']
+        assert stacks['other_after'] == DEFAULT_STACK
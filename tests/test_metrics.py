@@ -0,0 +1,236 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+import pytest
+from mock import Mock
+import mqlight
+from mqlight.client import SEND_STAGES, MAX_STAGE_TOPICS
+from mqlight.exceptions import RangeError
+from mqlight.metrics import HistogramSet, LogLinearHistogram, \
+    MetricsExporter, MetricsRegistry, OTHER_KEY, to_prometheus
+
+
+def _registry(client_id):
+    """builds a registry holding one of each kind of metric"""
+    registry = MetricsRegistry(client_id)
+    registry.counter('sent', 'Messages sent').inc(3)
+    registry.gauge('credit', 'Credit', lambda: {'/a': 10, '/b': 0},
+                   'subscription')
+    histogram = registry.histogram('sizes', 'Sizes', (10, 100))
+    for size in (5, 50, 500):
+        histogram.observe(size)
+    return registry
+
+
+class TestMetrics(object):
+
+    """
+    Unit tests for the metrics registry, exporters and client.metrics()
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_snapshot(self):
+        """
+        Test that a snapshot holds the value of each metric
+        """
+        assert _registry('c1').snapshot() == {
+            'sent': 3,
+            'credit': {'/a': 10, '/b': 0},
+            'sizes': {'count': 3, 'sum': 555,
+                      'buckets': [(10, 1), (100, 2), ('+Inf', 3)]}}
+        with pytest.raises(RangeError):
+            MetricsRegistry('c1').histogram('sizes', 'Sizes', (100, 10))
+
+    def test_prometheus(self):
+        """
+        Test the Prometheus text format, with the lines for each metric kept
+        together across clients
+        """
+        lines = to_prometheus([_registry('c1'), _registry('c2')]).split('\n')
+        assert lines[:4] == [
+            '# HELP mqlight_sent Messages sent',
+            '# TYPE mqlight_sent counter',
+            'mqlight_sent{client_id="c1"} 3',
+            'mqlight_sent{client_id="c2"} 3']
+        assert 'mqlight_credit{client_id="c1",subscription="/a"} 10' in lines
+        assert 'mqlight_sizes_bucket{client_id="c2",le="+Inf"} 3' in lines
+        assert 'mqlight_sizes_count{client_id="c2"} 3' in lines
+
+    def test_log_linear_histogram(self):
+        """
+        Test that percentiles are reported to within the width of a bucket,
+        and that a histogram set is reported in the Prometheus text
+        """
+        histogram = LogLinearHistogram('latency', 'Latency')
+        assert histogram.percentile(0.5) is None
+        for millis in range(1, 1001):
+            histogram.observe(millis / 1000.0)
+        value = histogram.value()
+        assert value['count'] == 1000
+        assert value['min'] == 0.001
+        assert value['max'] == 1.0
+        for key, expected in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                              ('p999', 0.999)):
+            assert abs(value[key] - expected) <= expected * 0.07
+        registry = MetricsRegistry('c1')
+        latency = registry.histogram_set('latency', 'Latency', 'topic')
+        latency.observe('/a', 0.002)
+        lines = to_prometheus([registry]).split('\n')
+        assert '# TYPE mqlight_latency summary' in lines
+        assert 'mqlight_latency_count{client_id="c1",topic="/a"} 1' in lines
+
+    def test_histogram_set_bounded(self):
+        """
+        Test that a histogram set records the values for label values seen
+        once it is full together
+        """
+        histograms = HistogramSet('latency', 'Latency', 'topic', max_keys=2)
+        for topic in ('a', 'b', 'c', 'd', 'a'):
+            histograms.observe(topic, 0.001)
+        value = histograms.value()
+        assert sorted(value) == [OTHER_KEY, 'a', 'b']
+        assert value['a']['count'] == 2
+        assert value[OTHER_KEY]['count'] == 2
+
+    def test_exporter(self):
+        """
+        Test that the exporter writes JSON lines to a file and serves the
+        Prometheus text over HTTP
+        """
+        client = Mock()
+        client._metrics = _registry('c1')
+        with pytest.raises(TypeError):
+            MetricsExporter([client], fmt='xml')
+        with pytest.raises(RangeError):
+            MetricsExporter([client], interval=0)
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'metrics.jsonl')
+        exporter = MetricsExporter([client], path=path, port=0)
+        try:
+            exporter.start()
+            exporter.export()
+            exporter.export()
+            with open(path) as file_obj:
+                lines = file_obj.read().splitlines()
+            assert len(lines) == 2
+            assert json.loads(lines[0])['clients']['c1']['sent'] == 3
+            body = urllib2.urlopen(
+                'http://127.0.0.1:{0}/metrics'.format(exporter.server_port()),
+                timeout=self.TEST_TIMEOUT).read()
+            assert 'mqlight_sent{client_id="c1"} 3' in body
+        finally:
+            exporter.stop()
+            shutil.rmtree(tmp)
+
+    def test_client_metrics(self):
+        """
+        Test that a client counts the messages it sends
+        """
+        test_is_done = threading.Event()
+        result = {}
+
+        def started(client):
+            """started listener"""
+            def sent(err, topic, data, options):
+                """send callback"""
+                result['metrics'] = client.metrics()
+                client.stop()
+                test_is_done.set()
+            client.send('test', 'message', on_sent=sent)
+        client = mqlight.Client('amqp://host', 'test_client_metrics',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+        metrics = result['metrics']
+        assert metrics['messages_sent'] == 1
+        assert metrics['bytes_sent'] == len('message')
+        assert metrics['reconnects'] == 0
+        assert metrics['credit'] == {}
+
+    def test_track_latency(self):
+        """
+        Test that track_latency must be True or False, and that a client
+        tracking latency stamps the messages it sends
+        """
+        with pytest.raises(TypeError):
+            mqlight.Client('amqp://host', 'test_track_latency',
+                           track_latency='yes')
+        test_is_done = threading.Event()
+        result = {}
+
+        def started(client):
+            """started listener"""
+            def put(point, timestamp, client_id, details):
+                """records the properties of the message put"""
+                result['properties'] = client._outstanding_sends[-1][
+                    'msg'].properties
+            def sent(err, topic, data, options):
+                """send callback"""
+                result['pattern_latency'] = client.get_latency('test')
+                result['latency'] = client.get_latency()
+                result['send_latency'] = client.get_send_latency()
+                result['topic_latency'] = client.get_send_latency('test')
+                client.stop()
+                test_is_done.set()
+            client.add_hook('put', put)
+            client.send('test', 'message', {'qos': mqlight.QOS_AT_LEAST_ONCE},
+                        on_sent=sent)
+        client = mqlight.Client('amqp://host', 'test_track_latency',
+                                on_started=started, track_latency=True)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+        properties = result['properties']
+        assert properties['mqlight_sent_id'] == 'test_track_latency:1'
+        assert properties['mqlight_sent_time'] > 0
+        assert result['latency'] == {}
+        assert result['pattern_latency'] == {}
+        assert sorted(result['send_latency']) == sorted(SEND_STAGES)
+        assert result['send_latency']['queue']['count'] == 1
+        assert result['topic_latency']['disposition']['count'] == 1
+
+    def test_send_latency_other_topics(self):
+        """
+        Test that once the maximum number of topics have been sent to, the
+        send latency of any other topic is that of the other topics
+        """
+        client = mqlight.Client('amqp://host', 'test_send_latency_other',
+                                track_latency=True)
+        try:
+            for index in range(MAX_STAGE_TOPICS + 1):
+                client._record_send_stages({
+                    'topic': 'topic{0}'.format(index),
+                    'stages': {'enqueued': 0, 'dequeued': 0, 'put': 0,
+                               'written': 0}})
+            client._record_send_stages({
+                'topic': 'unwritten',
+                'stages': {'enqueued': 0, 'dequeued': 0, 'put': 0}})
+            assert client.get_send_latency('topic0')['queue']['count'] == 1
+            other = client.get_send_latency('unknown')
+            assert other['queue']['count'] == 1
+            assert client.get_send_latency('unwritten') == other
+            assert client.get_send_latency()['queue']['count'] == \
+                MAX_STAGE_TOPICS + 1
+        finally:
+            client.stop()
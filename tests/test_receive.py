@@ -0,0 +1,283 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import Queue
+import pytest
+from mock import Mock
+import mqlight
+from mqlight.exceptions import InvalidArgumentError, RangeError, \
+    StoppedError, UnsubscribedError
+
+
+def _message(body, topic='/foo'):
+    """builds a received message for the private subscription to topic"""
+    msg = Mock()
+    msg.body = body
+    msg.address = 'amqp://host:5672/' + topic
+    msg.link_address = 'private:' + topic
+    msg.ttl = 0
+    msg.annotations = {}
+    return msg
+
+
+class TestReceive(object):
+
+    """
+    Unit tests for client.receive() and client.iter_messages()
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_receive_not_subscribed(self):
+        """
+        Test that receiving from a subscription that does not exist raises
+        UnsubscribedError
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            with pytest.raises(TypeError):
+                client.receive(None)
+            with pytest.raises(UnsubscribedError):
+                client.receive('/foo', timeout=0)
+            with pytest.raises(UnsubscribedError):
+                client.iter_messages('/foo')
+            client.stop()
+            test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_receive_not_subscribed',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_receive_requires_pull(self):
+        """
+        Test that receiving from a subscription that was not created with the
+        pull option raises InvalidArgumentError
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                with pytest.raises(InvalidArgumentError):
+                    client.receive('/foo', timeout=0)
+                client.stop()
+                test_is_done.set()
+            client.subscribe('/foo', on_subscribed=subscribed)
+        client = mqlight.Client('amqp://host',
+                                'test_receive_requires_pull',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_receive_arguments(self):
+        """
+        Test a variety of valid and invalid timeout and max_messages values
+        """
+        test_is_done = threading.Event()
+        data = [
+            {'valid': False, 'timeout': -1, 'max_messages': 1},
+            {'valid': False, 'timeout': 'abc', 'max_messages': 1},
+            {'valid': False, 'timeout': float('nan'), 'max_messages': 1},
+            {'valid': False, 'timeout': 0, 'max_messages': 0},
+            {'valid': False, 'timeout': 0, 'max_messages': None},
+            {'valid': True, 'timeout': 0, 'max_messages': 1},
+            {'valid': True, 'timeout': 0.01, 'max_messages': 10}
+        ]
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                try:
+                    for test in data:
+                        if test['valid']:
+                            assert client.receive(
+                                '/foo', 'share', test['timeout'],
+                                test['max_messages']) == []
+                        else:
+                            with pytest.raises(RangeError):
+                                client.receive(
+                                    '/foo', 'share', test['timeout'],
+                                    test['max_messages'])
+                finally:
+                    client.stop()
+                    test_is_done.set()
+            client.subscribe('/foo', 'share', {'pull': True},
+                             on_subscribed=subscribed)
+        client = mqlight.Client('amqp://host',
+                                'test_receive_arguments',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_receive_messages(self):
+        """
+        Test that messages are held for a pull subscription until receive is
+        called, and that credit is only flowed as messages are asked for
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                try:
+                    flow = client._messenger.flow = Mock()
+                    assert client.receive('/foo', timeout=0,
+                                          max_messages=3) == []
+                    assert flow.call_args[0][1] == 3
+                    for body in ('one', 'two', 'three'):
+                        client._process_message(_message(body))
+                    received = client.receive('/foo', timeout=0,
+                                              max_messages=2)
+                    assert [r[1] for r in received] == ['one', 'two']
+                    assert received[0][0] == mqlight.MESSAGE
+                    assert received[0][2]['message']['topic'] == '/foo'
+                    # one message is still held, so one more credit is needed
+                    # for three messages
+                    flow.reset_mock()
+                    received = client.receive('/foo', timeout=0,
+                                              max_messages=3)
+                    assert flow.call_args[0][1] == 2
+                    assert [r[1] for r in received] == ['three']
+                finally:
+                    client.stop()
+                    test_is_done.set()
+            client.subscribe('/foo', options={'pull': True},
+                             on_subscribed=subscribed)
+        client = mqlight.Client('amqp://host',
+                                'test_receive_messages',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_receive_malformed(self):
+        """
+        Test that a message carrying the malformed delivery annotations is
+        received as malformed, with the details taken from the annotations
+        """
+        test_is_done = threading.Event()
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                try:
+                    client._messenger.flow = Mock()
+                    msg = _message('data')
+                    msg.annotations = {
+                        'x-opt-message-malformed-condition': 'FORMATNOMATCH',
+                        'x-opt-message-malformed-description': 'bad format',
+                        'x-opt-message-malformed-MQMD-CodedCharSetId': 1208,
+                        'x-opt-message-malformed-MQMD.Format': 'MQSTR'
+                    }
+                    client._process_message(msg)
+                    client._process_message(_message('good'))
+                    received = client.receive('/foo', timeout=0,
+                                              max_messages=2)
+                    assert received[0][0] == mqlight.MALFORMED
+                    assert received[0][2]['malformed'] == {
+                        'condition': 'FORMATNOMATCH',
+                        'description': 'bad format',
+                        'MQMD': {'CodedCharSetId': 1208, 'Format': 'MQSTR'}
+                    }
+                    assert received[1][0] == mqlight.MESSAGE
+                    assert 'malformed' not in received[1][2]
+                finally:
+                    client.stop()
+                    test_is_done.set()
+            client.subscribe('/foo', options={'pull': True},
+                             on_subscribed=subscribed)
+        client = mqlight.Client('amqp://host',
+                                'test_receive_malformed',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_receive_wakes_on_stop(self):
+        """
+        Test that a thread blocked in receive raises StoppedError when the
+        client is stopped, and that iter_messages ends
+        """
+        test_is_done = threading.Event()
+        errors = []
+
+        def started(client):
+            """started listener"""
+            def subscribed(err, topic_pattern, share):
+                """subscribe callback"""
+                messages = client.iter_messages('/foo')
+
+                def receiver():
+                    """blocks waiting for a message"""
+                    try:
+                        client.receive('/foo')
+                    except StoppedError as exc:
+                        errors.append(exc)
+                    assert list(messages) == []
+                    test_is_done.set()
+                thread = threading.Thread(target=receiver)
+                thread.start()
+                client.stop()
+            client.subscribe('/foo', options={'pull': True},
+                             on_subscribed=subscribed)
+        client = mqlight.Client('amqp://host',
+                                'test_receive_wakes_on_stop',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+        assert len(errors) == 1
+
+    def test_reads_coalesced(self):
+        """
+        Test that chunks read while a push into proton is pending are pushed
+        with it, rather than each queueing an action of its own
+        """
+        test_is_done = threading.Event()
+        result = {}
+
+        def started(client):
+            """started listener"""
+            action_queue = client._action_queue
+            try:
+                client._action_queue = Queue.Queue()
+                client._push_chunks = Mock()
+                for chunk in (b'a', b'bc', b'def'):
+                    client._queue_on_read(chunk)
+                result['actions'] = client._action_queue.qsize()
+                action = client._action_queue.get()
+                action[0](*action[1:])
+                result['chunks'] = list(client._queued_chunks)
+                result['pushes'] = client._push_chunks.call_count
+                client._queue_on_read(b'g')
+                result['requeued'] = client._action_queue.qsize()
+            finally:
+                client._action_queue = action_queue
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host', 'test_reads_coalesced',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+        assert result == {'actions': 1, 'chunks': [b'a', b'bc', b'def'],
+                          'pushes': 1, 'requeued': 1}
@@ -0,0 +1,116 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import time
+import pytest
+import mqlight
+from mqlight import ReconnectPolicy
+from mqlight.exceptions import RangeError
+from mqlight.reconnect import ReconnectCoordinator, CLOSED, OPEN, HALF_OPEN
+
+
+class TestReconnect(object):
+
+    """
+    Unit tests for ReconnectPolicy and ReconnectCoordinator
+    """
+
+    def test_policy_arguments(self):
+        """
+        Test that out of range policy values raise RangeError
+        """
+        for kwargs in ({'initial_delay': -1}, {'multiplier': 0.5},
+                       {'jitter': 2}, {'max_concurrent': 0},
+                       {'handshake_rate': 0}, {'handshake_burst': 1.5},
+                       {'failure_threshold': 'abc'}, {'open_time': None}):
+            with pytest.raises(RangeError):
+                ReconnectPolicy(**kwargs)
+        with pytest.raises(TypeError):
+            mqlight.set_reconnect_policy('policy')
+
+    def test_policy_delay(self):
+        """
+        Test that the delay grows with each attempt, within the jitter, and is
+        capped
+        """
+        policy = ReconnectPolicy(initial_delay=1, max_delay=60)
+        for attempt in range(1, 6):
+            assert 0.75 * 2 ** attempt <= policy.delay(attempt) <= \
+                2 ** attempt
+        assert policy.delay(100) == 60
+        assert ReconnectPolicy(initial_delay=0).delay(5) == 0
+
+    def test_coordinator_concurrency(self):
+        """
+        Test that only max_concurrent attempts to an endpoint may be in
+        progress at once, and that other endpoints are not affected
+        """
+        coordinator = ReconnectCoordinator(ReconnectPolicy(max_concurrent=2))
+        assert coordinator.acquire('a') == 0
+        assert coordinator.acquire('a') == 0
+        assert coordinator.acquire('a') > 0
+        assert coordinator.acquire('b') == 0
+        coordinator.release('a', True)
+        assert coordinator.acquire('a') == 0
+        stats = coordinator.stats()
+        assert stats['a']['in_flight'] == 2
+        assert stats['a']['attempts'] == 3
+        assert stats['a']['deferred'] == 1
+
+    def test_coordinator_token_bucket(self):
+        """
+        Test that the start of attempts is limited by the handshake rate once
+        the burst has been used
+        """
+        coordinator = ReconnectCoordinator(ReconnectPolicy(
+            max_concurrent=100, handshake_rate=10, handshake_burst=3))
+        for _ in range(3):
+            assert coordinator.acquire('a') == 0
+        wait = coordinator.acquire('a')
+        assert 0 < wait <= 0.1
+        time.sleep(wait)
+        assert coordinator.acquire('a') == 0
+
+    def test_coordinator_circuit_breaker(self):
+        """
+        Test that the breaker opens after failure_threshold failures, lets one
+        attempt through once open_time has passed, and closes when it
+        succeeds
+        """
+        coordinator = ReconnectCoordinator(ReconnectPolicy(
+            failure_threshold=2, open_time=0.2))
+        for _ in range(2):
+            assert coordinator.acquire('a') == 0
+            coordinator.release('a', False)
+        assert coordinator.stats()['a']['state'] == OPEN
+        assert coordinator.acquire('a') > 0
+        assert coordinator.retry_delay(['a'], 0) > 0.1
+        # failures that do not mean the endpoint is down are not counted
+        assert coordinator.acquire('b') == 0
+        coordinator.release('b', False, False)
+        coordinator.acquire('b')
+        coordinator.release('b', False, False)
+        assert coordinator.stats()['b']['state'] == CLOSED
+        time.sleep(0.2)
+        assert coordinator.acquire('a') == 0
+        assert coordinator.stats()['a']['state'] == HALF_OPEN
+        assert coordinator.acquire('a') > 0
+        coordinator.release('a', True)
+        assert coordinator.stats()['a']['state'] == CLOSED
+        assert coordinator.stats()['a']['trips'] == 1
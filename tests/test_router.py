@@ -0,0 +1,154 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import pytest
+from mock import Mock
+from mqlight import TopicRouter, TopicTrie, MESSAGE
+
+
+class TestRouter(object):
+
+    """
+    Unit tests for TopicTrie and TopicRouter
+    """
+
+    def test_trie_match(self):
+        """
+        Test that topics are matched against patterns using the MQ Light
+        wildcards
+        """
+        trie = TopicTrie()
+        patterns = ['a/b', 'a/+', 'a/#', '#', '+/b', 'a/#/c', 'x/+/z', 'a']
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        assert len(trie) == len(patterns)
+        data = [
+            {'topic': 'a', 'matches': ['#', 'a', 'a/#']},
+            {'topic': 'a/b', 'matches': ['#', '+/b', 'a/#', 'a/+', 'a/b']},
+            {'topic': 'a/b/c', 'matches': ['#', 'a/#', 'a/#/c']},
+            {'topic': 'a/x/y/c', 'matches': ['#', 'a/#', 'a/#/c']},
+            {'topic': 'x/y/z', 'matches': ['#', 'x/+/z']},
+            {'topic': 'x/y/y/z', 'matches': ['#']},
+            {'topic': 'b', 'matches': ['#']}
+        ]
+        for test in data:
+            assert sorted(trie.match(test['topic'])) == test['matches']
+
+    def test_trie_consecutive_wildcards(self):
+        """
+        Test that consecutive '#' wildcards can each match no levels, by
+        comparing the matches with those of a simple recursive matcher
+        """
+        def matches(pattern, topic):
+            """reference matcher, working on lists of levels"""
+            if not pattern:
+                return not topic
+            if pattern[0] == '#':
+                return any(matches(pattern[1:], topic[skip:])
+                           for skip in range(len(topic) + 1))
+            if not topic:
+                return False
+            return pattern[0] in ('+', topic[0]) and \
+                matches(pattern[1:], topic[1:])
+
+        patterns = ['+/#/#/a', '#/#', 'c/#/#', '#/+/#', '#/a/#/#/a']
+        trie = TopicTrie()
+        for pattern in patterns:
+            trie.add(pattern, pattern)
+        for topic in ('c/a', 'a', 'c', 'c/b/a', 'a/a', 'x/a/y/a', 'c/a/b'):
+            expected = sorted(
+                pattern for pattern in patterns
+                if matches(pattern.split('/'), topic.split('/')))
+            assert sorted(trie.match(topic)) == expected
+        assert '+/#/#/a' in trie.match('c/a')
+
+    def test_trie_remove(self):
+        """
+        Test that values can be removed, and that removing a value that was
+        never added returns False
+        """
+        trie = TopicTrie()
+        trie.add('a/+/c', 1)
+        trie.add('a/+/c', 2)
+        trie.add('a/b', 3)
+        assert not trie.remove('a/+/d', 1)
+        assert not trie.remove('a/b', 1)
+        assert trie.remove('a/+/c', 1)
+        assert trie.match('a/b/c') == [2]
+        assert trie.remove('a/+/c', 2)
+        assert trie.match('a/b/c') == []
+        assert trie.remove('a/b', 3)
+        assert len(trie) == 0
+        assert trie._root.children == {}
+
+    def test_router_arguments(self):
+        """
+        Test that invalid handlers and topic patterns raise TypeError
+        """
+        router = TopicRouter()
+        with pytest.raises(TypeError):
+            router.add_handler(None, Mock())
+        with pytest.raises(TypeError):
+            router.add_handler('', Mock())
+        with pytest.raises(TypeError):
+            router.add_handler('a', 'not a function')
+        with pytest.raises(TypeError):
+            TopicRouter('not a function')
+
+    def test_router_on_message(self):
+        """
+        Test that a message is passed to every handler whose pattern matches
+        its topic, and to on_unmatched if there are none
+        """
+        unmatched = Mock()
+        router = TopicRouter(unmatched)
+        football = Mock()
+        results = Mock()
+        router.add_handler('sports/football/#', football)
+        router.add_handler('sports/+/results', results)
+        router.add_handler('sports/#', results)
+
+        delivery = {'message': {'topic': 'sports/football/results'}}
+        router.on_message(MESSAGE, 'data', delivery)
+        football.assert_called_once_with(MESSAGE, 'data', delivery)
+        # handlers registered against more than one pattern are only called
+        # once
+        results.assert_called_once_with(MESSAGE, 'data', delivery)
+        assert not unmatched.called
+
+        delivery = {'message': {'topic': 'news'}}
+        router.on_message(MESSAGE, 'data', delivery)
+        unmatched.assert_called_once_with(MESSAGE, 'data', delivery)
+
+        assert router.remove_handler('sports/football/#', football)
+        assert router.handlers('sports/football/results') == [results]
+
+    def test_router_handler_error(self):
+        """
+        Test that an error raised by one handler does not stop the others from
+        being called
+        """
+        router = TopicRouter()
+        failing = Mock(side_effect=ValueError('handler failed'))
+        other = Mock()
+        router.add_handler('a/+', failing)
+        router.add_handler('a/b', other)
+        with pytest.raises(ValueError):
+            router.on_message(MESSAGE, 'data', {'message': {'topic': 'a/b'}})
+        assert other.called
@@ -0,0 +1,96 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import os
+import signal
+import time
+import pytest
+from mqlight import ShareGroup
+from mqlight.exceptions import InvalidArgumentError, RangeError
+
+
+def _on_message(message_type, data, delivery):
+    """message handler run in the workers"""
+    pass
+
+
+class TestShareGroup(object):
+
+    """
+    Unit tests for ShareGroup
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_sharegroup_arguments(self):
+        """
+        Test that invalid arguments are rejected
+        """
+        with pytest.raises(InvalidArgumentError):
+            ShareGroup('amqp://host', '/foo', None, _on_message)
+        with pytest.raises(TypeError):
+            ShareGroup('amqp://host', '/foo', 'share', 'not a function')
+        for workers in (0, -1, 'abc'):
+            with pytest.raises(RangeError):
+                ShareGroup('amqp://host', '/foo', 'share', _on_message,
+                           workers)
+        with pytest.raises(RangeError):
+            ShareGroup('amqp://host', '/foo', 'share', _on_message, 1,
+                       restart_delay=0)
+
+    def test_sharegroup_start_stop(self):
+        """
+        Test that the workers are started, and exit when the group is stopped
+        """
+        group = ShareGroup('amqp://host', '/foo', 'share', _on_message, 2,
+                           client_id_prefix='test_sharegroup_start_stop',
+                           drain_timeout=5)
+        assert group.metrics()['alive'] == 0
+        group.start()
+        try:
+            with pytest.raises(InvalidArgumentError):
+                group.start()
+            metrics = group.metrics()
+            assert metrics['workers'] == 2
+            assert metrics['alive'] == 2
+            assert metrics['messages'] == 0
+        finally:
+            assert group.stop()
+        assert group.metrics()['alive'] == 0
+
+    def test_sharegroup_restart(self):
+        """
+        Test that a worker that exits is restarted by the supervisor
+        """
+        group = ShareGroup('amqp://host', '/foo', 'share', _on_message, 1,
+                           client_id_prefix='test_sharegroup_restart',
+                           restart_delay=0.1, drain_timeout=5)
+        group.start()
+        try:
+            pid = group.metrics()['per_worker'][0]['pid']
+            os.kill(pid, signal.SIGKILL)
+            deadline = time.time() + self.TEST_TIMEOUT
+            while time.time() < deadline:
+                metrics = group.metrics()
+                if metrics['restarts'] and metrics['alive']:
+                    break
+                time.sleep(0.1)
+            assert metrics['restarts'] == 1
+            assert metrics['per_worker'][0]['pid'] != pid
+        finally:
+            group.stop()
@@ -18,6 +18,7 @@ IBM Corp.
 # pylint: disable=bare-except,broad-except,invalid-name,no-self-use
 # pylint: disable=too-many-public-methods,unused-argument
 import threading
+import time
 import pytest
 from mock import Mock
 import mqlight
@@ -421,3 +422,246 @@ class TestSubscribe(object):
                                 on_started=started)
         test_is_done.wait(self.TEST_TIMEOUT)
         assert test_is_done.is_set()
+
+    def test_subscribe_pull(self):
+        """
+        Test a variety of valid and invalid pull options. Invalid pull values
+        should result in the client.subscribe(...) method throwing a TypeError
+        """
+        test_is_done = threading.Event()
+        data = [
+            {'valid': False, 'opts': {'pull': ''}},
+            {'valid': False, 'opts': {'pull': None}},
+            {'valid': False, 'opts': {'pull': 'True'}},
+            {'valid': True, 'opts': {'pull': True}},
+            {'valid': True, 'opts': {'pull': False}},
+            {'valid': True, 'opts': {'qos': 1, 'pull': True}},
+            {'valid': True, 'opts': {'qos': 1, 'auto_confirm': False,
+                                     'pull': True}}
+        ]
+
+        def started(client):
+            """started listener"""
+            try:
+                for i in range(len(data)):
+                    test = data[i]
+                    if test['valid']:
+                        client.subscribe('/foo' + str(i), options=test['opts'])
+                    else:
+                        with pytest.raises(TypeError):
+                            client.subscribe('/foo' + str(i),
+                                             options=test['opts'])
+            except Exception as exc:
+                pytest.fail('Unexpected Exception ' + str(exc))
+            finally:
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_subscribe_pull',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_subscribe_max_prefetch_bytes(self):
+        """
+        Test a variety of valid and invalid max_prefetch_bytes options.
+        Invalid values should result in the client.subscribe(...) method
+        throwing a RangeError
+        """
+        test_is_done = threading.Event()
+        func = Mock()
+        data = [
+            {'valid': False, 'bytes': ''},
+            {'valid': False, 'bytes': func},
+            {'valid': False, 'bytes': 0},
+            {'valid': False, 'bytes': -1},
+            {'valid': False, 'bytes': float('nan')},
+            {'valid': True, 'bytes': None},
+            {'valid': True, 'bytes': 1},
+            {'valid': True, 'bytes': 10 * 1024 * 1024}
+        ]
+
+        def started(client):
+            """started listener"""
+            try:
+                for i in range(len(data)):
+                    test = data[i]
+                    opts = {'max_prefetch_bytes': test['bytes']}
+                    if test['valid']:
+                        client.subscribe('/foo' + str(i), options=opts)
+                    else:
+                        with pytest.raises(RangeError):
+                            client.subscribe('/foo' + str(i), options=opts)
+            except Exception as exc:
+                pytest.fail('Unexpected Exception ' + str(exc))
+            finally:
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_subscribe_max_prefetch_bytes',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_subscribe_dedup(self):
+        """
+        Test a variety of valid and invalid dedup options. Invalid dedup
+        values should result in the client.subscribe(...) method throwing a
+        TypeError
+        """
+        test_is_done = threading.Event()
+        data = [
+            {'valid': False, 'opts': {'dedup': ''}},
+            {'valid': False, 'opts': {'dedup': 'True'}},
+            {'valid': False, 'opts': {'dedup': 100}},
+            {'valid': True, 'opts': {'dedup': None}},
+            {'valid': True, 'opts': {'qos': 1, 'dedup': True}},
+            {'valid': True, 'opts': {'dedup': False}},
+            {'valid': True, 'opts': {'qos': 1,
+                                     'dedup': mqlight.DuplicateFilter(10)}}
+        ]
+
+        def started(client):
+            """started listener"""
+            try:
+                for i in range(len(data)):
+                    test = data[i]
+                    if test['valid']:
+                        client.subscribe('/foo' + str(i), options=test['opts'])
+                    else:
+                        with pytest.raises(TypeError):
+                            client.subscribe('/foo' + str(i),
+                                             options=test['opts'])
+            except Exception as exc:
+                pytest.fail('Unexpected Exception ' + str(exc))
+            finally:
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_subscribe_dedup',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_subscribe_waits_for_attach(self):
+        """
+        Test that the subscribe callback is not called until the MQ Light
+        service has attached the link, and that credit is only then flowed
+        """
+        test_is_done = threading.Event()
+        subscribed = threading.Event()
+
+        def started(client):
+            """started listener"""
+            messenger = client._messenger
+            client._messenger = Mock()
+            client._messenger.subscribed.return_value = False
+            try:
+                client.subscribe('/foo',
+                                 on_subscribed=lambda *args: subscribed.set())
+                assert not subscribed.wait(0.5)
+                assert client._messenger.flow.call_count == 0
+                client._messenger.subscribed.return_value = True
+                client._check_pending_links()
+                assert subscribed.wait(self.TEST_TIMEOUT)
+                assert client._messenger.flow.call_count == 1
+                assert len(client._pending_links) == 0
+            except Exception as exc:
+                pytest.fail('Unexpected Exception ' + str(exc))
+            finally:
+                client._messenger = messenger
+                client.stop()
+                test_is_done.set()
+        client = mqlight.Client('amqp://host',
+                                'test_subscribe_waits_for_attach',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_subscribe_many(self):
+        """
+        Test that subscribe_many makes every subscription, passes errors for
+        invalid subscriptions to their own callback, and calls on_subscribed
+        once they are all done
+        """
+        test_is_done = threading.Event()
+        bad_subscribed = threading.Event()
+
+        def started(client):
+            """started listener"""
+            def bad_callback(err, topic_pattern, share):
+                """subscribe callback for the invalid subscription"""
+                if isinstance(err, RangeError):
+                    bad_subscribed.set()
+
+            def all_subscribed(err, subscriptions):
+                """subscribe_many callback"""
+                try:
+                    assert isinstance(err, RangeError)
+                    assert bad_subscribed.is_set()
+                    assert len(subscriptions) == 3
+                    assert sorted(sub['topic_pattern']
+                                  for sub in client._subscriptions) == \
+                        ['/foo1', '/foo2']
+                finally:
+                    client.stop()
+                    test_is_done.set()
+            try:
+                with pytest.raises(TypeError):
+                    client.subscribe_many('/foo')
+                with pytest.raises(TypeError):
+                    client.subscribe_many(['/foo'])
+                with pytest.raises(TypeError):
+                    client.subscribe_many([], on_subscribed='bad')
+                client.subscribe_many([
+                    {'topic_pattern': '/foo1'},
+                    {'topic_pattern': '/foo2', 'share': 'share',
+                     'options': {'qos': 1}},
+                    {'topic_pattern': '/foo3', 'options': {'qos': 9},
+                     'on_subscribed': bad_callback}
+                ], all_subscribed)
+            except Exception as exc:
+                client.stop()
+                test_is_done.set()
+                pytest.fail('Unexpected Exception ' + str(exc))
+        client = mqlight.Client('amqp://host',
+                                'test_subscribe_many',
+                                on_started=started)
+        test_is_done.wait(self.TEST_TIMEOUT)
+        assert test_is_done.is_set()
+
+    def test_resubscribe_after_reconnect(self):
+        """
+        Test that the subscriptions are made again after a reconnect, keeping
+        their existing records, and that the time taken is measured
+        """
+        subscribed = threading.Event()
+        on_message = Mock()
+
+        def started(client):
+            """started listener"""
+            client.subscribe('/foo', options={'qos': 1, 'dedup': True},
+                             on_subscribed=lambda *args: subscribed.set(),
+                             on_message=on_message)
+        client = mqlight.Client('amqp://host',
+                                'test_resubscribe_after_reconnect',
+                                on_started=started)
+        try:
+            subscribed.wait(self.TEST_TIMEOUT)
+            assert subscribed.is_set()
+            assert client.get_resubscribe_time() is None
+            subscription = client._subscriptions[0]
+            client._reconnect()
+            # wait from the test's own thread, so that the client's threads
+            # are free to reconnect and subscribe again
+            deadline = time.time() + self.TEST_TIMEOUT
+            while client.get_resubscribe_time() is None and \
+                    time.time() < deadline:
+                time.sleep(0.01)
+            assert client.get_resubscribe_time() >= 0
+            assert client._subscriptions == [subscription]
+            assert client._subscriptions[0] is subscription
+            assert subscription['on_message'] is on_message
+            assert client._queued_subscriptions == []
+        finally:
+            client.stop()
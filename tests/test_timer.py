@@ -0,0 +1,119 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import threading
+import time
+from mqlight.timer import call_later, get_scheduler, Worker
+
+
+class TestTimer(object):
+
+    """
+    Unit tests for the timer scheduler
+    """
+    TEST_TIMEOUT = 10.0
+
+    def test_timer_order(self):
+        """
+        Test that timers run in the order they are due, not the order they
+        were scheduled
+        """
+        ran = []
+        done = threading.Event()
+        call_later(0.3, lambda: (ran.append(3), done.set()))
+        call_later(0.1, ran.append, [1])
+        call_later(0.2, ran.append, [2])
+        assert done.wait(self.TEST_TIMEOUT)
+        assert ran == [1, 2, 3]
+
+    def test_timer_cancel(self):
+        """
+        Test that a cancelled timer does not run, and that joining it returns
+        straight away
+        """
+        ran = []
+        handle = call_later(0.1, ran.append, [1])
+        handle.cancel()
+        assert handle.cancelled()
+        handle.join(self.TEST_TIMEOUT)
+        time.sleep(0.2)
+        assert ran == []
+
+    def test_timer_join(self):
+        """
+        Test that joining a timer waits for its function to run, and that an
+        error raised by one timer does not stop the others
+        """
+        ran = []
+        call_later(0.05, lambda: 1 / 0)
+        handle = call_later(0.1, ran.append, [1])
+        handle.join(self.TEST_TIMEOUT)
+        assert ran == [1]
+
+    def test_timer_threads(self):
+        """
+        Test that scheduling many timers does not start any more threads
+        """
+        get_scheduler()
+        threads = threading.active_count()
+        done = threading.Event()
+        count = [0]
+
+        def tick():
+            """timer function"""
+            count[0] += 1
+            if count[0] == 100:
+                done.set()
+        for i in range(100):
+            call_later(0.001 * i, tick)
+        assert threading.active_count() == threads
+        assert done.wait(self.TEST_TIMEOUT)
+        assert threading.active_count() == threads
+
+    def test_worker(self):
+        """
+        Test that a worker runs the functions posted to it in order on a
+        single thread, which exits once there is no work left, and that an
+        error raised by one function does not stop the others
+        """
+        worker = Worker('test_worker')
+        threads = threading.active_count()
+        ran = []
+        done = threading.Event()
+        release = threading.Event()
+
+        def run(value):
+            """worker function"""
+            release.wait(self.TEST_TIMEOUT)
+            ran.append((value, threading.current_thread().name,
+                        worker.is_current()))
+        for i in range(10):
+            worker.post(run, i)
+        worker.post(lambda: 1 / 0)
+        worker.post(done.set)
+        assert threading.active_count() == threads + 1
+        assert not worker.is_current()
+        release.set()
+        assert done.wait(self.TEST_TIMEOUT)
+        assert ran == [(i, 'test_worker', True) for i in range(10)]
+        for _ in range(100):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.01)
+        assert threading.active_count() == threads
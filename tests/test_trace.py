@@ -0,0 +1,106 @@
+"""
+<copyright
+notice="lm-source-program"
+pids="5725-P60"
+years="2013,2015"
+crc="3568777996" >
+Licensed Materials - Property of IBM
+
+5725-P60
+
+(C) Copyright IBM Corp. 2013, 2015
+
+US Government Users Restricted Rights - Use, duplication or
+disclosure restricted by GSA ADP Schedule Contract with
+IBM Corp.
+</copyright>
+"""
+# pylint: disable=bare-except,broad-except,invalid-name,no-self-use
+# pylint: disable=too-many-public-methods,unused-argument,protected-access
+import os
+import shutil
+import tempfile
+from mock import patch
+import mqlight.logging
+from mqlight import trace
+from mqlight.trace import TraceBuffer, read_dump, format_dump
+
+
+class TestTrace(object):
+
+    """
+    Unit tests for the trace ring buffer
+    """
+
+    def test_ring_buffer(self):
+        """
+        Test that only the most recent records are kept, oldest first, and
+        that the buffer size is rounded up to a power of two
+        """
+        buf = TraceBuffer(6)
+        assert buf._size == 8
+        for index in range(20):
+            buf.record(trace.SEND, 'client', index)
+        records = buf.snapshot()
+        assert [record[0] for record in records] == list(range(12, 20))
+        assert [record[5] for record in records] == list(range(12, 20))
+        assert TraceBuffer(0).snapshot() == []
+
+    def test_dump(self):
+        """
+        Test that a dump can be read back, and that values that are not
+        integers are written as 0
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            buf = TraceBuffer(16)
+            buf.record(trace.READ, 'client1', 1024)
+            buf.record(trace.WRITE, '*', 512, 'not a number')
+            buf.record(trace.STATE, 'client2', 2, 1 << 70)
+            path = buf.dump(tmp)
+            assert os.path.dirname(path) == tmp
+            records = read_dump(path)
+            assert [(record[3], record[4], record[5], record[6])
+                    for record in records] == [
+                        (trace.READ, 'client1', 1024, 0),
+                        (trace.WRITE, '*', 512, 0),
+                        (trace.STATE, 'client2', 2, 0x7FFFFFFFFFFFFFFF)]
+            assert format_dump(path)[0].split()[3:] == [
+                'READ', 'client1', '1024', '0']
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_dump_files(self):
+        """
+        Test that each dump is written to a new file that only its owner can
+        read, and that only the most recent dumps are kept
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            buf = TraceBuffer(16, max_dumps=2)
+            buf.record(trace.READ, 'client1', 1024)
+            paths = [buf.dump(tmp) for _ in range(3)]
+            assert len(set(paths)) == 3
+            assert sorted(os.listdir(tmp)) == sorted(
+                os.path.basename(path) for path in paths[1:])
+            assert os.stat(paths[2]).st_mode & 0o777 == 0o600
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_ffdc_dump(self):
+        """
+        Test that an FFDC writes the trace buffer to a file
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            log = mqlight.logging.get_logger('test_ffdc_dump')
+            log._log.disabled = True
+            trace.record(trace.MESSAGE, 'test_ffdc_dump')
+            with patch.dict(os.environ, {'MQLIGHT_PYTHON_TRACE_DIR': tmp}):
+                log.ffdc('test_ffdc_dump', 1, None, 'test')
+            dumps = os.listdir(tmp)
+            assert len(dumps) == 1
+            records = read_dump(os.path.join(tmp, dumps[0]))
+            assert records[-1][3:5] == (trace.MESSAGE, 'test_ffdc_dump')
+        finally:
+            shutil.rmtree(tmp)